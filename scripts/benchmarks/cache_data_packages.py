@@ -0,0 +1,113 @@
+"""Microbenchmark for matching tables against a bucket listing in cache_data_packages
+
+Run from the repo root with `python -m scripts.benchmarks.cache_data_packages`.
+
+Compares the original approach (a substring scan of the whole listing per table,
+followed by a scan of the data package's column type entries) to building a set of
+table ids from the listing once and doing dict lookups into the column types.
+"""
+
+import argparse
+import timeit
+
+from rich import console, table
+
+from src.shared import enums, functions
+
+
+def generate_listing(table_count: int, key_count: int) -> tuple[list[str], list[str], dict]:
+    """Builds table names, a bucket listing, and column types for `table_count` tables
+
+    Aggregates and flat tables are split evenly; each table gets its share of
+    `key_count` keys, as would happen with multiple parquet files per table.
+    """
+    tables = []
+    files = []
+    column_types = {}
+    studies = [f"study_{i}" for i in range(20)]
+    sites = [f"site_{i}" for i in range(25)]
+    keys_per_table = max(key_count // table_count, 1)
+    for i in range(table_count):
+        study = studies[i % len(studies)]
+        site = sites[(i // len(studies)) % len(sites)]
+        dp = f"table_{i // 2}"
+        version = f"{i % 10:03d}"
+        if i % 2 == 0:
+            name = f"{study}__{dp}__{version}"
+            folder = f"{enums.BucketPath.AGGREGATE}/{study}/{study}__{dp}/{name}"
+            filename = f"{study}__{dp}__aggregate"
+            column_name = dp
+        else:
+            name = f"{study}__{dp}__{site}__{version}"
+            folder = f"{enums.BucketPath.FLAT}/{study}/{site}/{name}"
+            filename = f"{study}__{dp}__{site}__flat"
+            column_name = f"{dp}__{site}"
+        tables.append(name)
+        files += [f"{folder}/{filename}.{j}.parquet" for j in range(keys_per_table)]
+        column_types.setdefault(study, {}).setdefault(column_name, {})[name] = {
+            "s3_path": f"s3://bucket/{folder}/{filename}.parquet"
+        }
+    return tables, files, column_types
+
+
+def _get_entry_name(table_name: str) -> tuple[str, str]:
+    parts = table_name.split("__")
+    if len(parts) == 4:
+        return parts[0], f"{parts[1]}__{parts[2]}"
+    return parts[0], parts[1]
+
+
+def run_benchmark(table_count: int, key_count: int, passes: int):
+    tables, files, column_types = generate_listing(table_count, key_count)
+
+    def match_scan():
+        matches = []
+        for dp in tables:
+            if not any([f"/{dp}" in x for x in files]):
+                continue
+            study, name = _get_entry_name(dp)
+            dp_ids = column_types[study][name]
+            for dp_id in dp_ids:
+                if dp_id not in dp:
+                    continue
+                matches.append(dp_ids[dp_id])
+        return matches
+
+    def match_indexed():
+        table_ids = {
+            functions.parse_s3_key(file).get_tablename(enums.BucketPath(file.split("/")[0]))
+            for file in files
+        }
+        matches = []
+        for dp in tables:
+            if dp not in table_ids:
+                continue
+            study, name = _get_entry_name(dp)
+            if (dp_info := column_types[study][name].get(dp)) is not None:
+                matches.append(dp_info)
+        return matches
+
+    c = console.Console()
+    if match_scan() != match_indexed():
+        c.print("Matching approaches returned different results")
+        exit(1)
+    # the scan is quadratic, so it only gets timed once
+    scan = timeit.timeit(match_scan, number=1)
+    functions.parse_s3_key.cache_clear()
+    indexed = min(timeit.repeat(match_indexed, number=1, repeat=passes))
+    t = table.Table(title=f"{len(tables)} tables matched against {len(files)} keys")
+    t.add_column("Mode")
+    t.add_column("Total (ms)")
+    t.add_column("Per table (µs)")
+    for mode, elapsed in [("substring scan", scan), ("indexed", indexed)]:
+        t.add_row(mode, f"{elapsed * 1000:.1f}", f"{elapsed / len(tables) * 1_000_000:.2f}")
+    c.print(t)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""Benchmarks data package table matching. """)
+    parser.add_argument("-t", "--tables", type=int, default=5_000, help="number of tables")
+    parser.add_argument("-n", "--count", type=int, default=50_000, help="number of keys")
+    parser.add_argument("-p", "--passes", type=int, default=5, help="timing passes")
+    args = parser.parse_args()
+    run_benchmark(args.tables, args.count, args.passes)
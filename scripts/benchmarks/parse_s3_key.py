@@ -0,0 +1,83 @@
+"""Microbenchmark for functions.parse_s3_key over a synthetic bucket listing
+
+Run from the repo root with `python -m scripts.benchmarks.parse_s3_key`.
+
+The listing is shaped like a production bucket: a mix of aggregates, flat tables,
+last_valid/latest/study_metadata uploads, and manifests, spread over a number of
+studies, sites, and versions.
+"""
+
+import argparse
+import sys
+import timeit
+
+from rich import console, table
+
+from src.shared import enums, functions
+
+
+def generate_keys(count: int) -> list[str]:
+    """Builds a list of roughly `count` keys across the data package subbuckets"""
+    keys = []
+    studies = [f"study_{i}" for i in range(20)]
+    sites = [f"site_{i}" for i in range(25)]
+    i = 0
+    while len(keys) < count:
+        study = studies[i % len(studies)]
+        site = sites[(i // len(studies)) % len(sites)]
+        dp = f"table_{i % 50}"
+        version = f"{(i // 1000) % 10:03d}"
+        keys += [
+            f"{enums.BucketPath.AGGREGATE}/{study}/{study}__{dp}/{study}__{dp}__{version}/"
+            f"{study}__{dp}__aggregate.parquet",
+            f"{enums.BucketPath.LAST_VALID}/{study}/{study}__{dp}/{site}/{version}/"
+            f"{study}__{dp}.cube.parquet",
+            f"{enums.BucketPath.LATEST}/{study}/{study}__{dp}/{site}/{version}/"
+            f"{study}__{dp}.cube.parquet",
+            f"{enums.BucketPath.FLAT}/{study}/{site}/{study}__{dp}__{site}__{version}/"
+            f"{study}__{dp}__{site}__flat.parquet",
+            f"{enums.BucketPath.STUDY_META}/{study}/{study}__meta_date/{site}/{version}/"
+            f"{study}__meta_date.parquet",
+            f"{enums.BucketPath.MANIFEST}/{study}/{version}/manifest.json",
+        ]
+        i += 1
+    return keys[:count]
+
+
+def run_benchmark(count: int, passes: int):
+    keys = generate_keys(count)
+    uncached_parse = functions.parse_s3_key.__wrapped__
+
+    def parse_uncached():
+        for key in keys:
+            uncached_parse(key)
+
+    def parse_cached():
+        for key in keys:
+            functions.parse_s3_key(key)
+
+    functions.parse_s3_key.cache_clear()
+    uncached = min(timeit.repeat(parse_uncached, number=1, repeat=passes))
+    # one warmup pass to populate the cache, as would happen in the first loop
+    # over a listing in a lambda
+    parse_cached()
+    cached = min(timeit.repeat(parse_cached, number=1, repeat=passes))
+    sample = uncached_parse(keys[0])
+    t = table.Table(title=f"parse_s3_key over {len(keys)} keys (best of {passes})")
+    t.add_column("Mode")
+    t.add_column("Total (ms)")
+    t.add_column("Per key (µs)")
+    for mode, elapsed in [("uncached", uncached), ("memoized", cached)]:
+        t.add_row(mode, f"{elapsed * 1000:.1f}", f"{elapsed / len(keys) * 1_000_000:.2f}")
+    c = console.Console()
+    c.print(t)
+    c.print(f"PackageMetadata instance size: {sys.getsizeof(sample)} bytes")
+    c.print(functions.parse_s3_key.cache_info())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="""Benchmarks S3 key parsing. """)
+    parser.add_argument("-n", "--count", type=int, default=100_000, help="number of keys")
+    parser.add_argument("-p", "--passes", type=int, default=5, help="timing passes")
+    args = parser.parse_args()
+    run_benchmark(args.count, args.passes)
@@ -3,32 +3,32 @@ import argparse
 import boto3
 from rich import console, progress, table
 
-from src.shared import enums
+from src.shared import enums, functions
 
 site_artifacts = [enums.BucketPath.LAST_VALID.value]
 aggregates = [enums.BucketPath.AGGREGATE.value]
 
 
-def get_subbucket_contents(client, bucket, prefix):
-    res = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    if "Contents" not in res.keys():
-        return []
-    files = [x["Key"] for x in res["Contents"]]
-    while res["IsTruncated"]:
-        res = client.list_objects_v2(
-            Bucket=bucket, Prefix=prefix, ContinuationToken=res["NextContinuationToken"]
-        )
-        files += [x["Key"] for x in res["Contents"]]
-    return files
+def _get_version_folder(key: str) -> str:
+    """Returns the data package version folder of an aggregate or aggregate generation"""
+    return key.removeprefix(f"{enums.BucketPath.GENERATION.value}/").split("/")[3]
 
 
 def remove_aggregate_data(bucket: str, target: str, version: str):
     client = boto3.client("s3")
-    aggregates = get_subbucket_contents(
-        client, bucket, f"{enums.BucketPath.AGGREGATE.value}/{target}"
+    # Aggregates written before generations existed are kept in the aggregates folder
+    aggregates = functions.iter_s3_keys_from_prefixes(
+        client,
+        bucket,
+        [
+            f"{enums.BucketPath.AGGREGATE.value}/{target}",
+            f"{enums.BucketPath.GENERATION.value}/{enums.BucketPath.AGGREGATE.value}/{target}",
+        ],
     )
     if version:
-        aggregates = [a for a in aggregates if a.split("/")[3].endswith(f"__{version}")]
+        aggregates = [a for a in aggregates if _get_version_folder(a).endswith(f"__{version}")]
+    else:
+        aggregates = list(aggregates)
     c = console.Console()
     if len(aggregates) == 0:
         c.print(f"No data found for {target}.")
@@ -49,7 +49,7 @@ def remove_aggregate_data(bucket: str, target: str, version: str):
         t = table.Table()
         t.add_column("File to remove")
         for file in aggregates:
-            t.add_row(file.split("/")[3])
+            t.add_row(_get_version_folder(file))
         c.print(t)
         c.print("Proceed with cleanup? Y to proceed, any other value to quit.")
         response = input()
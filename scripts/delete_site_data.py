@@ -2,27 +2,14 @@ import argparse
 from collections import defaultdict
 
 import boto3
-from rich import console, progress, table
+from rich import console, table
 
-from src.shared import enums
+from src.shared import enums, functions
 
 site_artifacts = [enums.BucketPath.LAST_VALID.value]
 aggregates = [enums.BucketPath.AGGREGATE.value]
 
 
-def get_subbucket_contents(client, bucket, prefix):
-    res = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    if "Contents" not in res.keys():
-        return []
-    files = [x["Key"] for x in res["Contents"]]
-    while res["IsTruncated"]:
-        res = client.list_objects_v2(
-            Bucket=bucket, Prefix=prefix, ContinuationToken=res["NextContinuationToken"]
-        )
-        files += [x["Key"] for x in res["Contents"]]
-    return files
-
-
 def cleanup_target(tree: dict, target: str, data_packages: str, site: str, version: str):
     other_sites = list(tree[data_packages].keys())
     other_sites.remove(site)
@@ -38,7 +25,7 @@ def cleanup_target(tree: dict, target: str, data_packages: str, site: str, versi
 
 def remove_site_data(bucket: str, target: str, site: str, version: str):
     client = boto3.client("s3")
-    contents = get_subbucket_contents(client, bucket, enums.BucketPath.LAST_VALID.value)
+    contents = functions.iter_s3_keys(client, bucket, enums.BucketPath.LAST_VALID.value)
     tree = defaultdict(lambda: defaultdict(dict))
     for path in contents:
         s3_key = path.split("/")
@@ -98,16 +85,38 @@ def remove_site_data(bucket: str, target: str, site: str, version: str):
     if response.lower() != "y":
         c.print("Skipping cleanup")
         exit()
-    for file in progress.track(data_packages_to_prune, description="Deleting objects..."):
-        client.delete_object(Bucket=bucket, Key=file[0])
-    for key in progress.track(regen_targets, description="Regenerating objects"):
-        client.copy(
-            CopySource={"Bucket": bucket, "Key": key},
-            Bucket=bucket,
-            Key=key.replace(enums.BucketPath.LAST_VALID.value, enums.BucketPath.UPLOAD.value, 1),
+    with c.status("Deleting objects..."):
+        failures = functions.delete_s3_files(
+            client, bucket, [file[0] for file in data_packages_to_prune]
         )
-    for key in delete_targets:
-        client.delete_object(Bucket=bucket, Key=key)
+    with c.status("Regenerating objects..."):
+        failures.update(
+            functions.copy_s3_files(
+                client,
+                bucket,
+                [
+                    (
+                        key,
+                        key.replace(
+                            enums.BucketPath.LAST_VALID.value, enums.BucketPath.UPLOAD.value, 1
+                        ),
+                    )
+                    for key in regen_targets
+                ],
+            )
+        )
+    # Aggregates published as generations are removed along with any earlier file
+    delete_targets += functions.iter_s3_keys_from_prefixes(
+        client, bucket, [f"{functions.get_generation_prefix(key)}/" for key in delete_targets]
+    )
+    failures.update(functions.delete_s3_files(client, bucket, delete_targets))
+    if failures:
+        t = table.Table(title="Failed operations")
+        t.add_column("File")
+        t.add_column("Error")
+        for key, error in failures.items():
+            t.add_row(key, error)
+        c.print(t)
     c.print("""Cleanup complete.
 
 You may need to run this again due to bucket backup policy reasons.
@@ -5,25 +5,12 @@ import boto3
 import rich
 from rich import console, progress, table
 
-from src.shared import enums
+from src.shared import enums, functions
 
 meta = enums.BucketPath.META.value
 study_meta = enums.BucketPath.AGGREGATE.value
 
 
-def get_subbucket_contents(client, bucket, prefix):
-    res = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    if "Contents" not in res.keys():
-        return []
-    files = [x["Key"] for x in res["Contents"]]
-    while res["IsTruncated"]:
-        res = client.list_objects_v2(
-            Bucket=bucket, Prefix=prefix, ContinuationToken=res["NextContinuationToken"]
-        )
-        files += [x["Key"] for x in res["Contents"]]
-    return files
-
-
 def remove_site_metadata(bucket: str, target: str, site: str, version: str | None):
     client = boto3.client("s3")
     meta_versions = []
@@ -42,7 +29,7 @@ def remove_site_metadata(bucket: str, target: str, site: str, version: str | Non
     except client.exceptions.NoSuchKey:
         rich.print(f"{meta}/study_periods.json not found, skipping study period update")
     for data_type in ["meta_date", "meta_version"]:
-        found_files = get_subbucket_contents(
+        found_files = functions.iter_s3_keys(
             client, bucket, f"{study_meta}/{target}/{target}__{data_type}"
         )
         if version:
@@ -76,10 +63,17 @@ def remove_site_metadata(bucket: str, target: str, site: str, version: str | Non
         client.delete_object(Bucket=bucket, Key=file[0])
     for version in progress.track(meta_versions, description="Removing metadata"):
         study_periods[site][target].pop(version)
-    if study_periods[site][target].keys() == {}:
+    if not study_periods[site][target]:
         study_periods[site].pop(target)
     client.put_object(
-        Bucket=bucket, Key=f"{meta}/study_periods.json", Body=json.dump(study_periods)
+        Bucket=bucket, Key=f"{meta}/study_periods.json", Body=json.dumps(study_periods)
+    )
+    functions.write_metadata_subdocuments(
+        client,
+        bucket,
+        study_periods,
+        meta_type=enums.JsonFilename.STUDY_PERIODS,
+        sites=[site],
     )
     c.print("Cleanup complete.")
 
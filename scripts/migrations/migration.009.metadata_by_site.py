@@ -0,0 +1,44 @@
+import argparse
+import io
+import json
+
+import boto3
+from rich import progress
+
+
+def _put_s3_data(key: str, bucket_name: str, client, data: dict) -> None:
+    """Convenience class for writing a dict to S3"""
+    b_data = io.BytesIO(json.dumps(data, default=str, indent=2).encode())
+    client.upload_fileobj(Bucket=bucket_name, Key=key, Fileobj=b_data)
+
+
+def write_metadata_by_site(bucket):
+    """Writes the per site and per site/study parts of site keyed metadata documents"""
+    client = boto3.client("s3")
+    for meta_type in ["transactions", "study_periods"]:
+        try:
+            res = client.get_object(Bucket=bucket, Key=f"metadata/{meta_type}.json")
+        except client.exceptions.NoSuchKey:
+            print(f"metadata/{meta_type}.json not found, skipping")
+            continue
+        metadata = json.loads(res["Body"].read())
+        for site in progress.track(metadata.keys(), description=f"Splitting {meta_type}..."):
+            _put_s3_data(
+                f"metadata/by_site/{meta_type}/{site}.json", bucket, client, metadata[site]
+            )
+            for study, study_metadata in metadata[site].items():
+                _put_s3_data(
+                    f"metadata/by_site/{meta_type}/{site}/{study}.json",
+                    bucket,
+                    client,
+                    study_metadata,
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Writes per site copies of transaction and study period metadata. """
+    )
+    parser.add_argument("-b", "--bucket", help="bucket name")
+    args = parser.parse_args()
+    write_metadata_by_site(args.bucket)
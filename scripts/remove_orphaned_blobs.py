@@ -0,0 +1,105 @@
+"""Removes count data blobs that are no longer referenced by any pointer
+
+Only relevant to deployments using the pointer storage layout (STORAGE_LAYOUT=pointer),
+where uploaded count data lives in the blobs subbucket and the state folders hold
+pointers to it. Pointers are removed when data is superseded or deleted, which can
+leave blobs that nothing refers to.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+
+import boto3
+from rich import console, table
+
+from src.shared import enums, functions
+
+pointer_subbuckets = [
+    enums.BucketPath.UPLOAD.value,
+    enums.BucketPath.LATEST.value,
+    enums.BucketPath.LAST_VALID.value,
+    enums.BucketPath.TEMP.value,
+    enums.BucketPath.ERROR.value,
+    enums.BucketPath.ARCHIVE.value,
+]
+
+
+def get_pointer_target(client, bucket: str, key: str) -> str | None:
+    head = client.head_object(Bucket=bucket, Key=key)
+    return head.get("Metadata", {}).get(functions.POINTER_METADATA_KEY)
+
+
+def is_older_than(client, bucket: str, key: str, cutoff: datetime.datetime) -> bool:
+    return client.head_object(Bucket=bucket, Key=key)["LastModified"] < cutoff
+
+
+def remove_orphaned_blobs(bucket: str, grace_hours: int):
+    client = boto3.client("s3")
+    c = console.Console()
+    with c.status("Finding referenced blobs..."):
+        pointers = [
+            key
+            for key in functions.iter_s3_keys_from_prefixes(client, bucket, pointer_subbuckets)
+            if key.endswith(".parquet")
+        ]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            referenced = set(
+                executor.map(lambda key: get_pointer_target(client, bucket, key), pointers)
+            )
+        candidates = [
+            key
+            for key in functions.iter_s3_keys(client, bucket, enums.BucketPath.BLOB.value)
+            if key not in referenced
+        ]
+        # A blob is written just before its pointer, so recent blobs may belong to
+        # an upload that is still being unpacked
+        cutoff = datetime.datetime.now(datetime.UTC) - datetime.timedelta(hours=grace_hours)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            old = list(
+                executor.map(lambda key: is_older_than(client, bucket, key, cutoff), candidates)
+            )
+        orphans = [key for key, is_old in zip(candidates, old, strict=True) if is_old]
+    if len(orphans) == 0:
+        c.print("No orphaned blobs found.")
+        exit()
+    c.print(f"{len(orphans)} orphaned blobs found (of {len(referenced)} referenced).")
+    c.print("Proceed with cleanup? Y to proceed, D for details, any other value to quit.")
+    response = input()
+    if response.lower() == "d":
+        t = table.Table()
+        t.add_column("Blob to remove")
+        for key in orphans:
+            t.add_row(key)
+        c.print(t)
+        c.print("Proceed with cleanup? Y to proceed, any other value to quit.")
+        response = input()
+    if response.lower() != "y":
+        c.print("Skipping cleanup")
+        exit()
+    with c.status("Deleting objects..."):
+        failures = functions.delete_s3_files(client, bucket, orphans)
+    if failures:
+        t = table.Table(title="Failed operations")
+        t.add_column("File")
+        t.add_column("Error")
+        for key, error in failures.items():
+            t.add_row(key, error)
+        c.print(t)
+    c.print("Cleanup complete.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Removes unreferenced blobs from a pointer layout bucket. """
+    )
+    parser.add_argument("-b", "--bucket", help="bucket name", required=True)
+    parser.add_argument(
+        "-g",
+        "--grace-hours",
+        type=int,
+        default=24,
+        help="ignore blobs newer than this many hours (default: 24)",
+    )
+    args = parser.parse_args()
+    remove_orphaned_blobs(args.bucket, args.grace_hours)
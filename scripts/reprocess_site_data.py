@@ -4,20 +4,7 @@ from collections import defaultdict
 import boto3
 from rich import console, progress, table
 
-from src.shared import enums
-
-
-def get_subbucket_contents(client, bucket, prefix):
-    res = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    if "Contents" not in res.keys():
-        return []
-    files = [x["Key"] for x in res["Contents"]]
-    while res["IsTruncated"]:
-        res = client.list_objects_v2(
-            Bucket=bucket, Prefix=prefix, ContinuationToken=res["NextContinuationToken"]
-        )
-        files += [x["Key"] for x in res["Contents"]]
-    return files
+from src.shared import enums, functions
 
 
 def reprocess_site_data(
@@ -35,7 +22,7 @@ def reprocess_site_data(
     client = boto3.client("s3")
     data_packages_to_reprocess = []
     for source in [enums.BucketPath.STUDY_META.value, subfolder]:
-        contents = get_subbucket_contents(client, bucket, source)
+        contents = functions.iter_s3_keys(client, bucket, source)
         tree = defaultdict(lambda: defaultdict(dict))
         for path in contents:
             s3_key = path.split("/")
@@ -1,6 +1,7 @@
 """Util script for regenerating the list of data packages from data"""
 
 import argparse
+import datetime
 import io
 import json
 import os
@@ -10,7 +11,7 @@ import boto3
 import pandas
 from rich import progress
 
-from src.shared import enums, pandas_functions
+from src.shared import enums, functions, pandas_functions
 from src.site_upload.cache_api import cache_api
 
 
@@ -27,10 +28,9 @@ def update_column_type_metadata(bucket: str, client):
     """
     output = {}
     for subbucket in ["aggregates", "flat"]:
-        res = client.list_objects_v2(Bucket=bucket, Prefix=f"{subbucket}/")
-        contents = res.get("Contents", [])
-        for resource in progress.track(contents, description=f"Processing {subbucket}"):
-            dirs = resource["Key"].split("/")
+        contents = list(functions.iter_s3_keys(client, bucket, f"{subbucket}/"))
+        for key in progress.track(contents, description=f"Processing {subbucket}"):
+            dirs = key.split("/")
             study = dirs[1]
             if subbucket == "aggregates":
                 data_package = dirs[2].split("__")[1]
@@ -38,7 +38,7 @@ def update_column_type_metadata(bucket: str, client):
                 data_package = "__".join([dirs[3].split("__")[1], dirs[3].split("__")[2]])
             version = dirs[3]
             bytes_buffer = io.BytesIO()
-            client.download_fileobj(Bucket=bucket, Key=resource["Key"], Fileobj=bytes_buffer)
+            client.download_fileobj(Bucket=bucket, Key=key, Fileobj=bytes_buffer)
             df = pandas.read_parquet(bytes_buffer)
             type_dict = pandas_functions.get_column_datatypes(df)
             output.setdefault(study, {})
@@ -47,9 +47,9 @@ def update_column_type_metadata(bucket: str, client):
             output[study][data_package][version]["column_types_format_version"] = "3"
             output[study][data_package][version]["columns"] = type_dict
             output[study][data_package][version]["last_data_update"] = (
-                resource["LastModified"].now().isoformat()
+                datetime.datetime.now().isoformat()
             )
-            output[study][data_package][version]["s3_path"] = f"s3://{bucket}/{resource['Key']}"
+            output[study][data_package][version]["s3_path"] = f"s3://{bucket}/{key}"
             if subbucket == "aggregates":
                 output[study][data_package][version]["total"] = int(df["cnt"][0])
             elif subbucket == "flat":
@@ -2,21 +2,28 @@
 This is intended to provide an implementation of the logic described in docs/api.md
 """
 
+import hashlib
+import json
 import logging
 import os
 import pathlib
 
 import awswrangler
 import boto3
+import botocore
 import jinja2
 import pandas
 
-from shared import decorators, enums, errors, functions
+from shared import decorators, document_cache, enums, errors, functions
 
 log_level = os.environ.get("LAMBDA_LOG_LEVEL", "INFO")
 logger = logging.getLogger()
 logger.setLevel(log_level)
 
+# Query results are cached here, keyed by the request and the version of the aggregate
+# they were computed from
+CHART_CACHE_PREFIX = f"{enums.BucketPath.CACHE}/chart_data"
+
 # These constants are specified by the dashboard API and should not be changed
 # unless a corresponding change is made on that side.
 INLINE_FILTERS = (
@@ -110,28 +117,82 @@ NONE_FILTERS = (
 )
 
 
+def _get_table_details(dp_id: str) -> dict:
+    """Returns the column_types metadata associated with a table."""
+    column_types = document_cache.get_s3_json(
+        os.environ.get("BUCKET_NAME"),
+        f"{enums.BucketPath.META}/{enums.JsonFilename.COLUMN_TYPES.value}.json",
+    )
+    for study in column_types.keys():
+        if study in dp_id:
+            for data_package in column_types[study].keys():
+                if dp_id in column_types[study][data_package].keys():
+                    return column_types[study][data_package][dp_id]
+    raise errors.AggregatorS3Error
+
+
 def _get_table_cols(dp_id: str) -> list:
     """Returns the columns associated with a table.
 
     Since running an athena query takes a decent amount of time due to queueing
     a query with the execution engine, and we already have this data in the
     column_types metadata, we're getting table cols directly from S3 for speed reasons.
-
-    TODO: Read from column_types instead
     """
+    return list(_get_table_details(dp_id)["columns"].keys())
+
+
+def _get_table_version(dp_id: str) -> str | None:
+    """Returns an identifier for the current contents of a table's data in S3
 
+    This is the published generation of an aggregate, or the ETag of tables without
+    one (i.e. flat tables). Returns None if the table's data can't be found.
+    """
     s3_bucket_name = os.environ.get("BUCKET_NAME")
-    s3_client = boto3.client("s3")
-    column_types = functions.read_metadata(
-        s3_client, s3_bucket_name, meta_type=enums.JsonFilename.COLUMN_TYPES.value
-    )
-    for study in column_types.keys():
-        if study in dp_id:
-            for data_package in column_types[study].keys():
-                if dp_id in column_types[study][data_package].keys():
-                    details = column_types[study][data_package][dp_id]
-                    return list(details["columns"].keys())
-    raise errors.AggregatorS3Error
+    try:
+        key = functions.get_s3_key_from_path(_get_table_details(dp_id)["s3_path"])
+        record = document_cache.get_s3_json(
+            s3_bucket_name,
+            f"{functions.get_generation_prefix(key)}/{functions.GENERATION_RECORD_FILENAME}",
+            default=None,
+        )
+        if record is not None:
+            return record["generation"]
+        return boto3.client("s3").head_object(Bucket=s3_bucket_name, Key=key)["ETag"]
+    except (errors.AggregatorS3Error, botocore.exceptions.ClientError):
+        return None
+
+
+def _get_cache_key(query_params: dict, filter_groups: list, dp_id: str, version: str) -> str:
+    """Returns the key a chart query's results are cached at
+
+    Filters are ANDed within a group and groups are ORed, so the order of either
+    doesn't change the result, and requests differing only in order share a key.
+    """
+    filters = sorted({",".join(sorted(set(group.split(",")))) for group in filter_groups})
+    request = {
+        "column": query_params.get("column"),
+        "stratifier": query_params.get("stratifier"),
+        "filters": filters,
+        "version": version,
+    }
+    digest = hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+    return f"{CHART_CACHE_PREFIX}/{dp_id}/{digest}.json"
+
+
+def _get_cached_payload(s3_bucket_name: str, cache_key: str) -> dict | None:
+    """Returns the cached results of a chart query, or None if there aren't any
+
+    Results for a version of a table never change, and there are too many of them
+    to be worth keeping in memory, so they're read directly rather than through
+    document_cache, which is for the small documents that are read on every request.
+    """
+    try:
+        res = boto3.client("s3").get_object(Bucket=s3_bucket_name, Key=cache_key)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+    return json.loads(res["Body"].read())
 
 
 def _build_query(
@@ -304,6 +365,19 @@ def _format_payload(
     return payload
 
 
+def _chart_response(event: dict, payload: dict) -> dict:
+    body = json.dumps(payload, default=str)
+    return functions.http_response(
+        200,
+        body,
+        skip_convert=True,
+        alt_log="Chart data succesfully retrieved",
+        etag=functions.make_etag(body),
+        if_none_match=functions.get_request_header(event, "If-None-Match"),
+    )
+
+
+@decorators.emit_document_cache_metrics
 @decorators.generic_error_handler(msg="Error retrieving chart data")
 def chart_data_handler(event, context):
     """manages event from dashboard api call and retrieves data"""
@@ -314,6 +388,15 @@ def chart_data_handler(event, context):
         filter_groups = [query_params["filter"]]
     path_params = event["pathParameters"]
     boto3.setup_default_session(region_name="us-east-1")
+    s3_bucket_name = os.environ.get("BUCKET_NAME")
+    cache_key = None
+    if version := _get_table_version(path_params["data_package_id"]):
+        cache_key = _get_cache_key(
+            query_params, filter_groups, path_params["data_package_id"], version
+        )
+        cached = _get_cached_payload(s3_bucket_name, cache_key)
+        if cached is not None:
+            return _chart_response(event, {**cached, "filters": filter_groups})
     try:
         main_query, count_col = _build_query(query_params, filter_groups, path_params)
         df = awswrangler.athena.read_sql_query(
@@ -341,8 +424,14 @@ def chart_data_handler(event, context):
             )
         else:
             total_df = None
-        res = _format_payload(df, total_df, query_params, filter_groups, count_col)
-        res = functions.http_response(200, res, alt_log="Chart data succesfully retrieved")
+        payload = _format_payload(df, total_df, query_params, filter_groups, count_col)
+        if cache_key is not None:
+            boto3.client("s3").put_object(
+                Bucket=s3_bucket_name,
+                Key=cache_key,
+                Body=json.dumps(payload, default=str, separators=(",", ":")),
+            )
+        res = _chart_response(event, payload)
     except errors.AggregatorS3Error:  # pragma: no cover
         # while the API is publicly accessible, we've been asked to not pass
         # helpful error messages back. revisit when dashboard is in AWS.
@@ -1,39 +1,88 @@
 """Lambda for retrieving list of available data packages"""
 
+import concurrent.futures
 import os
 
-from shared import decorators, enums, functions
+import boto3
 
+from shared import decorators, document_cache, enums, functions
 
+s3_client = boto3.client("s3")
+
+
+def _get_data_packages(bucket: str) -> tuple[list[dict], str]:
+    """Returns the full list of data packages, and its ETag"""
+    return document_cache.get_s3_json_with_etag(
+        bucket,
+        f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}.json",
+        s3_client=s3_client,
+    )
+
+
+def _get_package_entry(bucket: str, dp_id: str) -> tuple[dict | None, str | None]:
+    return document_cache.get_s3_json_with_etag(
+        bucket, functions.get_data_package_cache_key(dp_id), s3_client=s3_client, default=None
+    )
+
+
+def _get_data_packages_by_name(bucket: str, name: str) -> tuple[list[dict], str]:
+    """Returns the data packages with a given name, without the full list if possible"""
+    index, index_etag = document_cache.get_s3_json_with_etag(
+        bucket,
+        f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGE_NAMES.value}.json",
+        s3_client=s3_client,
+        default=None,
+    )
+    if index is not None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            entries = list(
+                executor.map(lambda dp_id: _get_package_entry(bucket, dp_id), index.get(name, []))
+            )
+        if all(entry is not None for entry, _ in entries):
+            return (
+                [entry for entry, _ in entries],
+                functions.make_etag(index_etag, *(etag for _, etag in entries)),
+            )
+    # The per package cache hasn't been built, or was mid-update
+    data_packages, etag = _get_data_packages(bucket)
+    return [package for package in data_packages if package["name"] == name], etag
+
+
+def _get_data_package(bucket: str, dp_id: str) -> tuple[dict | None, str]:
+    """Returns a single data package, without the full list if possible"""
+    found, etag = _get_package_entry(bucket, dp_id)
+    if found:
+        return found, etag
+    # The id may be unknown, or the per package cache may not have been built yet
+    data_packages, etag = _get_data_packages(bucket)
+    return next((package for package in data_packages if package["id"] == dp_id), None), etag
+
+
+@decorators.emit_document_cache_metrics
 @decorators.generic_error_handler(msg="Error retrieving data packages")
 def data_packages_handler(event, context):
     """Retrieves list of data packages from S3."""
     del context
     status = 200
-    data_packages = functions.get_s3_json_as_dict(
-        os.environ.get("BUCKET_NAME"),
-        f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}.json",
-    )
-    payload = data_packages
+    bucket = os.environ.get("BUCKET_NAME")
     if event.get("queryStringParameters"):
-        filtered_packages = []
-        for package in data_packages:
-            if package["name"] == event["queryStringParameters"]["name"]:
-                filtered_packages.append(package)
-        payload = filtered_packages
+        payload, etag = _get_data_packages_by_name(bucket, event["queryStringParameters"]["name"])
     elif event.get("pathParameters"):
-        found = None
-        for package in data_packages:
-            if event["pathParameters"]["data_package_id"] == package["id"]:
-                found = package
-        if found:
-            payload = found
-        else:
+        payload, etag = _get_data_package(bucket, event["pathParameters"]["data_package_id"])
+        if payload is None:
             status = 404
-            payload = None
+    else:
+        payload, etag = _get_data_packages(bucket)
     if status == 200:
         alt_log = "List of data packages retrieved"
     else:
         alt_log = None
-    res = functions.http_response(status, payload, allow_cors=True, alt_log=alt_log)
+    res = functions.http_response(
+        status,
+        payload,
+        allow_cors=True,
+        alt_log=alt_log,
+        etag=etag,
+        if_none_match=functions.get_request_header(event, "If-None-Match"),
+    )
     return res
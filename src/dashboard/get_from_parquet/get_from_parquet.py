@@ -12,7 +12,9 @@ def from_parquet_handler(event, context):
     del context
     try:
         s3_path = event["queryStringParameters"]["s3_path"]
-        df = awswrangler.s3.read_parquet(s3_path)
+        # Reading the published generation, rather than the aggregate key, means a merge
+        # finishing mid-read can't change the file out from under us
+        df = awswrangler.s3.read_parquet(functions.resolve_s3_generation(s3_path))
     except (KeyError, FileNotFoundError, pyarrow.lib.ArrowInvalid):
         res = functions.http_response(404, "S3_path not found")
         return res
@@ -4,25 +4,32 @@ import os
 
 import boto3
 
-from shared.decorators import generic_error_handler
-from shared.functions import http_response, read_metadata
+from shared import document_cache, enums
+from shared.decorators import emit_document_cache_metrics, generic_error_handler
+from shared.functions import get_request_header, http_response
 
+s3_client = boto3.client("s3")
 
+
+@emit_document_cache_metrics
 @generic_error_handler(msg="Error retrieving metadata")
 def metadata_handler(event, context):
     """Retrieves the upload metadata from S3"""
     del context
     s3_bucket = os.environ.get("BUCKET_NAME")
-    s3_client = boto3.client("s3")
-    metadata = read_metadata(s3_client, s3_bucket)
-    if params := event["pathParameters"]:
-        if "site" in params:
-            metadata = metadata[params["site"]]
-        if "study" in params:
-            metadata = metadata[params["study"]]
-        if "data_package" in params:
-            metadata = metadata[params["data_package"]]
-        if "version" in params:
-            metadata = metadata[params["version"]]
-    res = http_response(200, metadata)
+    params = event["pathParameters"] or {}
+    metadata, etag = document_cache.get_site_metadata(
+        s3_bucket,
+        enums.JsonFilename.TRANSACTIONS.value,
+        site=params.get("site"),
+        study=params.get("study"),
+        s3_client=s3_client,
+    )
+    if "data_package" in params:
+        metadata = metadata[params["data_package"]]
+    if "version" in params:
+        metadata = metadata[params["version"]]
+    res = http_response(
+        200, metadata, etag=etag, if_none_match=get_request_header(event, "If-None-Match")
+    )
     return res
@@ -1,19 +1,20 @@
 """Lambda for retrieving static json files"""
 
-import json
 import os
 
 import boto3
 
-from shared import decorators, enums, functions
+from shared import decorators, document_cache, enums, functions
 
+s3_client = boto3.client("s3")
 
+
+@decorators.emit_document_cache_metrics
 @decorators.generic_error_handler(msg="Error retrieving static file")
 def static_handler(event, context):
     """Retrieves static json files from S3"""
     del context
     s3_bucket = os.environ.get("BUCKET_NAME")
-    s3_client = boto3.client("s3")
     if params := event["pathParameters"]:
         path = params["path"]
     else:
@@ -26,12 +27,13 @@ def static_handler(event, context):
             items.append(f"{k}={v}")
         items = "&".join(items)
         path += items
-    try:
-        res = s3_client.get_object(Bucket=s3_bucket, Key=f"{enums.BucketPath.STATIC.value}/{path}")
-
-        data = json.loads(res["Body"].read())
-        res = functions.http_response(200, data)
-        return res
-    except s3_client.exceptions.NoSuchKey:
+    data, etag = document_cache.get_s3_json_with_etag(
+        s3_bucket, f"{enums.BucketPath.STATIC.value}/{path}", s3_client=s3_client, default=None
+    )
+    if data is None:
         res = functions.http_response(404, f"{path} not found")
         return res
+    res = functions.http_response(
+        200, data, etag=etag, if_none_match=functions.get_request_header(event, "If-None-Match")
+    )
+    return res
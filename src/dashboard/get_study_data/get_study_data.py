@@ -4,11 +4,12 @@ import os
 
 import boto3
 
-from shared import decorators, enums, functions
+from shared import decorators, document_cache, enums, functions
 
 s3_client = boto3.client("s3")
 
 
+@decorators.emit_document_cache_metrics
 @decorators.generic_error_handler(msg="Error retrieving study data")
 def study_data_handler(event, context):
     """Retrieves the upload metadata from S3"""
@@ -23,9 +24,9 @@ def study_data_handler(event, context):
         version = None
         table = None
 
-    payload = functions.get_s3_json_as_dict(
-        bucket=s3_bucket,
-        key=f"{enums.BucketPath.CACHE}/{enums.JsonFilename.STUDIES.value}.json",
+    payload, etag = document_cache.get_s3_json_with_etag(
+        s3_bucket,
+        f"{enums.BucketPath.CACHE}/{enums.JsonFilename.STUDIES.value}.json",
         s3_client=s3_client,
     )
     try:
@@ -45,5 +46,11 @@ def study_data_handler(event, context):
                         payload = payload[table]
     except KeyError:
         return functions.http_response(404, "Not found", allow_cors=True)
-    res = functions.http_response(200, payload, allow_cors=True)
+    res = functions.http_response(
+        200,
+        payload,
+        allow_cors=True,
+        etag=etag,
+        if_none_match=functions.get_request_header(event, "If-None-Match"),
+    )
     return res
@@ -4,22 +4,29 @@ import os
 
 import boto3
 
-from shared import decorators, enums, functions
+from shared import decorators, document_cache, enums, functions
 
+s3_client = boto3.client("s3")
 
+
+@decorators.emit_document_cache_metrics
 @decorators.generic_error_handler(msg="Error retrieving study period")
 def study_periods_handler(event, context):
     """Retrieves the study period from S3"""
     del context
     s3_bucket = os.environ.get("BUCKET_NAME")
-    s3_client = boto3.client("s3")
-    metadata = functions.read_metadata(
-        s3_client, s3_bucket, meta_type=enums.JsonFilename.STUDY_PERIODS.value
+    params = event["pathParameters"] or {}
+    metadata, etag = document_cache.get_site_metadata(
+        s3_bucket,
+        enums.JsonFilename.STUDY_PERIODS.value,
+        site=params.get("site"),
+        study=params.get("study"),
+        s3_client=s3_client,
+    )
+    res = functions.http_response(
+        200,
+        metadata,
+        etag=etag,
+        if_none_match=functions.get_request_header(event, "If-None-Match"),
     )
-    if params := event["pathParameters"]:
-        if "site" in params:
-            metadata = metadata[params["site"]]
-        if "study" in params:
-            metadata = metadata[params["study"]]
-    res = functions.http_response(200, metadata)
     return res
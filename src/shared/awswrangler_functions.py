@@ -16,6 +16,24 @@ def get_s3_data_package_list(
     site: str | None = None,
 ):
     """Retrieves a list of data packages for a given S3 path post-upload processing"""
+    return awswrangler.s3.list_objects(
+        path=get_s3_data_package_path(
+            bucket_root, s3_bucket_name, study, data_package, version=version, site=site
+        ),
+        suffix=extension,
+    )
+
+
+def get_s3_data_package_path(
+    bucket_root: str,
+    s3_bucket_name: str,
+    study: str,
+    data_package: str,
+    *,
+    version: str | None = None,
+    site: str | None = None,
+) -> str:
+    """Returns the S3 folder holding a study's data packages post-upload processing"""
     if bucket_root == enums.BucketPath.FLAT.value:
         path = f"s3://{s3_bucket_name}/{bucket_root}/{study}/"
         if site:
@@ -33,10 +51,7 @@ def get_s3_data_package_list(
             path += f"{version}/"
     else:
         raise errors.AggregatorS3Error(f"{bucket_root} does not contain data packages")
-    return awswrangler.s3.list_objects(
-        path=path,
-        suffix=extension,
-    )
+    return path
 
 
 def get_s3_study_meta_list(
@@ -56,3 +71,24 @@ def get_s3_study_meta_list(
         path=path,
         suffix=extension,
     )
+
+
+def register_parquet_table(df, database: str, table: str, path: str) -> None:
+    """Creates or updates the Glue table for a folder of parquet data
+
+    The table matches what the Glue crawler would create for the folder, so that new
+    data is queryable without waiting on a crawl.
+
+    :param df: a dataframe with the same schema as the data in the folder
+    :param database: the Glue database name
+    :param table: the table name
+    :param path: the S3 folder the table reads from
+    """
+    columns_types, _ = awswrangler.catalog.extract_athena_types(df, index=False)
+    awswrangler.catalog.create_parquet_table(
+        database=database,
+        table=table,
+        path=path,
+        columns_types=columns_types,
+        mode="overwrite",
+    )
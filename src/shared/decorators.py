@@ -3,6 +3,7 @@
 import functools
 import logging
 
+from . import document_cache
 from .functions import http_response
 
 
@@ -41,3 +42,16 @@ def generic_error_handler(msg="Internal server error"):
         return wrapper
 
     return error_decorator
+
+
+def emit_document_cache_metrics(func):
+    """reports a handler's document cache lookups once it finishes"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            document_cache.emit_metrics()
+
+    return wrapper
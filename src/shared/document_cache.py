@@ -0,0 +1,221 @@
+"""In-process cache of JSON documents read from S3
+
+The API lambdas serve documents (caches, metadata, static files) that only change
+when an upload or cache refresh finishes, but are requested far more often than
+that. Warm lambdas keep the documents they have read at module level, and answer
+from memory while a document is younger than the configured max staleness. Older
+documents are revalidated with a conditional GET on their ETag, so an unchanged
+document is not downloaded or parsed again.
+
+Documents are shared between invocations, so callers must not modify them.
+Lookups are counted, and reported once per invocation by handlers wrapped with
+decorators.emit_document_cache_metrics.
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import boto3
+import botocore
+
+from . import enums, functions
+
+logger = logging.getLogger()
+
+# How long, in seconds, a cached document is served without checking S3 for changes.
+# This can be overridden per lambda with the DOCUMENT_CACHE_MAX_STALENESS env var.
+DEFAULT_MAX_STALENESS = 60
+# Documents beyond this many are evicted, least recently used first
+MAX_DOCUMENTS = 256
+# Documents are also evicted once their total size, as JSON, passes this fraction of
+# the lambda's memory. Parsed documents take several times their JSON size in memory.
+MAX_MEMORY_FRACTION = 1 / 16
+METRICS_NAMESPACE = "CumulusAggregator/DocumentCache"
+
+
+# (bucket, key): (time last checked, etag, document, size of the document's JSON)
+_documents: collections.OrderedDict[tuple[str, str], tuple[float, str, dict | list, int]] = (
+    collections.OrderedDict()
+)
+_size = 0
+# lookup results since the process started, and since metrics were last emitted
+stats = collections.Counter()
+_unreported = collections.Counter()
+# lookups may come from several threads, i.e. when fetching documents concurrently
+_lock = threading.Lock()
+
+
+def get_max_staleness() -> float:
+    return float(os.environ.get("DOCUMENT_CACHE_MAX_STALENESS", DEFAULT_MAX_STALENESS))
+
+
+def get_max_size() -> int:
+    """Returns the most bytes of JSON to keep cached, based on the lambda's memory"""
+    memory = int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", 128)) * 1024 * 1024
+    return int(memory * MAX_MEMORY_FRACTION)
+
+
+_RAISE = object()
+
+
+def get_s3_json(bucket: str, key: str, s3_client=None, *, default=_RAISE) -> dict | list:
+    """Returns a JSON document from S3, from memory if it is known to be current
+
+    Errors from S3 are raised as ClientErrors, as they would be from an uncached read.
+
+    :param default: if specified, returned instead of raising when the document
+        does not exist
+    """
+    document, _ = get_s3_json_with_etag(bucket, key, s3_client, default=default)
+    return document
+
+
+def get_s3_json_with_etag(
+    bucket: str, key: str, s3_client=None, *, default=_RAISE
+) -> tuple[dict | list, str | None]:
+    """Returns a JSON document from S3 along with its S3 ETag, as with get_s3_json
+
+    If the default is returned for a missing document, its ETag is None.
+    """
+    now = time.monotonic()
+    with _lock:
+        cached = _documents.get((bucket, key))
+        if cached is not None:
+            _documents.move_to_end((bucket, key))
+    if cached is not None:
+        checked_at, etag, document, size = cached
+        if now - checked_at < get_max_staleness():
+            _record(enums.DocumentCacheResult.HIT, key)
+            return document, etag
+    s3_client = s3_client or boto3.client("s3")
+    request = {"Bucket": bucket, "Key": key}
+    if cached is not None:
+        request["IfNoneMatch"] = etag
+    try:
+        res = s3_client.get_object(**request)
+    except botocore.exceptions.ClientError as e:
+        if cached is not None and e.response["Error"]["Code"] in ("304", "NotModified"):
+            _store(bucket, key, (now, etag, document, size))
+            _record(enums.DocumentCacheResult.REVALIDATED, key)
+            return document, etag
+        _remove(bucket, key)
+        if default is not _RAISE and e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return default, None
+        raise
+    body = res["Body"].read()
+    document = json.loads(body)
+    _store(bucket, key, (now, res["ETag"], document, len(body)))
+    _record(enums.DocumentCacheResult.MISS, key)
+    return document, res["ETag"]
+
+
+def get_site_metadata(
+    bucket: str,
+    meta_type: str,
+    site: str | None = None,
+    study: str | None = None,
+    s3_client=None,
+) -> tuple[dict, str | None]:
+    """Returns a site keyed metadata document, or just the part for a site or study
+
+    The parts are written alongside the full document. If one hasn't been written
+    (i.e. for a site that hasn't been updated since they were introduced), it is
+    taken from the full document instead. Unknown sites and studies raise a KeyError.
+    """
+    if site is not None:
+        document, etag = get_s3_json_with_etag(
+            bucket,
+            functions.get_metadata_subdocument_key(meta_type, site, study),
+            s3_client,
+            default=None,
+        )
+        if document is not None:
+            return document, etag
+    document, etag = get_s3_json_with_etag(
+        bucket, f"{enums.BucketPath.META}/{meta_type}.json", s3_client, default={}
+    )
+    if site is not None:
+        document = document[site]
+        if study is not None:
+            document = document[study]
+    return document, etag
+
+
+def clear() -> None:
+    """Drops all cached documents and resets the hit/miss counts"""
+    global _size
+    with _lock:
+        _documents.clear()
+        _size = 0
+        stats.clear()
+        _unreported.clear()
+
+
+def _store(bucket: str, key: str, entry: tuple[float, str, dict | list, int]) -> None:
+    global _size
+    max_size = get_max_size()
+    with _lock:
+        if (previous := _documents.pop((bucket, key), None)) is not None:
+            _size -= previous[3]
+        if entry[3] > max_size:
+            # it would push everything else out, and still not fit
+            return
+        _documents[(bucket, key)] = entry
+        _size += entry[3]
+        while len(_documents) > MAX_DOCUMENTS or _size > max_size:
+            _, evicted = _documents.popitem(last=False)
+            _size -= evicted[3]
+
+
+def _remove(bucket: str, key: str) -> None:
+    global _size
+    with _lock:
+        if (previous := _documents.pop((bucket, key), None)) is not None:
+            _size -= previous[3]
+
+
+def _record(result: enums.DocumentCacheResult, key: str) -> None:
+    with _lock:
+        stats[result] += 1
+        _unreported[result] += 1
+    logger.debug("Document cache %s for %s", result.lower(), key)
+
+
+def emit_metrics() -> None:
+    """Reports the lookups since the last call as one CloudWatch metric record
+
+    The record is written to stdout in the embedded metric format, which CloudWatch
+    extracts from lambda logs without any extra API calls. It has to be a log line of
+    its own, so it is printed rather than going through logging's formatting.
+    """
+    with _lock:
+        counts = dict(_unreported)
+        _unreported.clear()
+    if not counts:
+        return
+    print(
+        json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": METRICS_NAMESPACE,
+                            "Dimensions": [["Function"]],
+                            "Metrics": [
+                                {"Name": result.value, "Unit": "Count"}
+                                for result in enums.DocumentCacheResult
+                            ],
+                        }
+                    ],
+                },
+                "Function": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local"),
+                **{result.value: counts.get(result, 0) for result in enums.DocumentCacheResult},
+            }
+        ),
+        flush=True,
+    )
@@ -9,9 +9,11 @@ class BucketPath(enum.StrEnum):
     ADMIN = "admin"
     AGGREGATE = "aggregates"
     ARCHIVE = "archive"
+    BLOB = "blobs"
     CACHE = "cache"
     ERROR = "error"
     FLAT = "flat"
+    GENERATION = "generations"
     LAST_VALID = "last_valid"
     LATEST_FLAT = "latest_flat"
     LATEST = "latest"
@@ -32,12 +34,21 @@ class ColumnTypesKeys(enum.StrEnum):
     LAST_DATA_UPDATE = "last_data_update"
 
 
+class DocumentCacheResult(enum.StrEnum):
+    """stores the outcomes of a lookup in the in-process S3 document cache"""
+
+    HIT = "Hit"
+    REVALIDATED = "Revalidated"
+    MISS = "Miss"
+
+
 class JsonFilename(enum.StrEnum):
     """stores names of expected kinds of persisted S3 JSON files"""
 
     COLUMN_TYPES = "column_types"
     TRANSACTIONS = "transactions"
     DATA_PACKAGES = "data_packages"
+    DATA_PACKAGE_NAMES = "data_package_names"
     FLAT_PACKAGES = "flat_packages"
     STUDY_PERIODS = "study_periods"
     STUDIES = "studies"
@@ -6,6 +6,10 @@ class AggregatorS3Error(Exception):
     """Errors related to accessing files in S3"""
 
 
+class AggregatorSnsError(Exception):
+    """Errors related to publishing SNS notifications"""
+
+
 class AggregatorFilterError(Exception):
     """Errors related to SQL filters"""
 
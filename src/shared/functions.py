@@ -1,16 +1,23 @@
 """Functions used across different lambdas"""
 
+import concurrent.futures
 import copy
 import dataclasses
 import enum
+import functools
+import hashlib
 import io
 import json
 import logging
 import os
+import time
 import tomllib
+import uuid
+from collections.abc import Iterable, Iterator
 from datetime import UTC, datetime
 
 import boto3
+import botocore
 
 from . import enums, errors
 
@@ -39,6 +46,31 @@ COLUMN_TYPES_METADATA_TEMPLATE = {
     enums.ColumnTypesKeys.LAST_DATA_UPDATE: None,
 }
 
+# Objects larger than this are moved with a concurrent multipart copy rather than a
+# single copy_object request (which is also capped at 5 GB by S3)
+MULTIPART_COPY_THRESHOLD = 256 * 1024 * 1024
+MULTIPART_COPY_PART_SIZE = 64 * 1024 * 1024
+
+# Under the pointer storage layout, count data is written once to the content addressed
+# blobs subbucket, and the objects moving through the pipeline's state folders are
+# small pointer records naming the blob, stored in this user metadata field
+STORAGE_LAYOUT_POINTER = "pointer"
+POINTER_METADATA_KEY = "cumulus-pointer-target"
+
+# Metadata documents keyed by site are also written as a document per site, and per
+# site and study, so that views of one site don't need the whole document
+SITE_KEYED_METADATA = (enums.JsonFilename.TRANSACTIONS, enums.JsonFilename.STUDY_PERIODS)
+
+# Aggregates are written as immutable generations, alongside a record of the
+# currently published one; a few old generations are kept for in-flight readers
+GENERATION_RECORD_FILENAME = "current.json"
+GENERATIONS_KEPT = 3
+
+# How long, in seconds, a warm lambda reuses a listing of the Glue catalog's tables
+GLUE_TABLE_CACHE_TTL = 300
+# database: (time fetched, table names, expected names known to be missing at that time)
+_glue_table_names: dict[str, tuple[float, set[str], set[str]]] = {}
+
 
 def http_response(
     status: int,
@@ -47,6 +79,8 @@ def http_response(
     extra_headers: dict | None = None,
     skip_convert: bool = False,
     alt_log: str | None = None,
+    etag: str | None = None,
+    if_none_match: str | None = None,
 ) -> dict:
     """Generates the payload AWS lambda expects as a return value
 
@@ -58,6 +92,10 @@ def http_response(
         otherwise leaves the body as is
     :alt_log: if true, writes the contents of alt_log to cloudwatch logs, otherwise
         writes the contents of the body.
+    :etag: an ETag identifying the version of the body. Clients are asked to
+        revalidate with it, rather than reusing the body without asking.
+    :if_none_match: the If-None-Match header of the request. If it matches etag,
+        a 304 is returned without the body.
 
     """
     headers = {"Content-Type": "application/json"}
@@ -69,6 +107,13 @@ def http_response(
                 "Access-Control-Allow-Methods": "GET",
             }
         )
+    if etag and status == 200:
+        headers.update({"ETag": etag, "Cache-Control": "no-cache"})
+        if allow_cors:
+            headers["Access-Control-Expose-Headers"] = "ETag"
+        if etag_matches(if_none_match, etag):
+            logging.info("Not modified: %s", etag)
+            return {"isBase64Encoded": False, "statusCode": 304, "body": "", "headers": headers}
     if extra_headers:
         headers.update(extra_headers)
     if status >= 200 and status < 300:
@@ -83,6 +128,36 @@ def http_response(
     }
 
 
+def get_request_header(event: dict, name: str) -> str | None:
+    """Returns a header from an API Gateway event, regardless of its capitalization"""
+    name = name.lower()
+    for header, value in (event.get("headers") or {}).items():
+        if header.lower() == name:
+            return value
+    return None
+
+
+def make_etag(*parts: str) -> str:
+    """Creates an ETag from the strings that identify a version of a response
+
+    :param parts: i.e. the ETags of the S3 objects a response was built from, or the
+        serialized response itself
+    """
+    digest = hashlib.sha256("\n".join(parts).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Checks whether an If-None-Match header includes an ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison, per RFC 9110
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in candidates
+
+
 # S3 json processing
 
 
@@ -182,6 +257,55 @@ def _update_or_clone_template(meta_dict: dict, version, template: str):
     return meta_dict.setdefault(version, copy.deepcopy(template))
 
 
+def get_metadata_subdocument_key(meta_type: str, site: str, study: str | None = None) -> str:
+    """Returns the key of the part of a site keyed metadata document for a site or study"""
+    check_meta_type(meta_type)
+    key = f"{enums.BucketPath.META}/by_site/{meta_type}/{site}"
+    if study is not None:
+        key = f"{key}/{study}"
+    return f"{key}.json"
+
+
+def write_metadata_subdocuments(
+    s3_client,
+    s3_bucket_name: str,
+    metadata: dict,
+    *,
+    meta_type: str,
+    sites: Iterable[str] | None = None,
+) -> None:
+    """Writes the per site, and per site and study, parts of a site keyed metadata document
+
+    Parts for studies no longer in a site's metadata are deleted.
+
+    :param metadata: the full metadata document
+    :param sites: the sites to write parts for. If None, parts are written for all sites.
+    """
+    for site in metadata.keys() if sites is None else sites:
+        site_metadata = metadata.get(site, {})
+        put_s3_file(
+            s3_client,
+            s3_bucket_name,
+            get_metadata_subdocument_key(meta_type, site),
+            site_metadata,
+        )
+        study_keys = set()
+        for study, study_metadata in site_metadata.items():
+            study_key = get_metadata_subdocument_key(meta_type, site, study)
+            study_keys.add(study_key)
+            put_s3_file(s3_client, s3_bucket_name, study_key, study_metadata)
+        study_prefix = get_metadata_subdocument_key(meta_type, site).removesuffix(".json") + "/"
+        delete_s3_files(
+            s3_client,
+            s3_bucket_name,
+            [
+                key
+                for key in iter_s3_keys(s3_client, s3_bucket_name, study_prefix)
+                if key not in study_keys
+            ],
+        )
+
+
 def write_metadata(
     *,
     sqs_client,
@@ -204,6 +328,62 @@ def write_metadata(
     )
 
 
+# SNS notifications
+
+
+def publish_sns_batch(sns_client, topic_arn: str, messages: list[str], subject: str) -> None:
+    """Publishes a notification per message, in batches of up to 10 per request
+
+    :param topic_arn: the ARN of the topic to publish to
+    :param messages: the message bodies (i.e. S3 keys) to send
+    :param subject: the subject line of every notification
+    """
+    failed = []
+    for i in range(0, len(messages), 10):
+        batch = messages[i : i + 10]
+        res = sns_client.publish_batch(
+            TopicArn=topic_arn,
+            PublishBatchRequestEntries=[
+                {"Id": str(j), "Message": message, "Subject": subject}
+                for j, message in enumerate(batch)
+            ],
+        )
+        failed += [batch[int(failure["Id"])] for failure in res.get("Failed", [])]
+    if failed:
+        logger.error("error publishing notifications for %s", failed)
+        raise errors.AggregatorSnsError(f"Could not publish notifications for {failed}")
+
+
+def get_upload_message(
+    key: str, *, uploaded_at: datetime, size: int, etag: str | None = None
+) -> str:
+    """Builds the message announcing a file unpacked from a site upload
+
+    Carrying the details of the new object means consumers don't need to look it up.
+
+    :param key: the S3 key of the file
+    :param uploaded_at: when the file was written
+    :param size: the size of the file, in bytes
+    :param etag: the ETag of the file, if known
+    """
+    return json.dumps(
+        {"key": key, "uploaded_at": uploaded_at.isoformat(), "size": size, "etag": etag}
+    )
+
+
+def parse_upload_message(message: str) -> dict:
+    """Reads a message built by get_upload_message
+
+    A bare S3 key (as sent before these messages had a payload) is also accepted,
+    in which case only the key is returned.
+    """
+    if not message.startswith("{"):
+        return {"key": message}
+    payload = json.loads(message)
+    payload["uploaded_at"] = datetime.fromisoformat(payload["uploaded_at"])
+    return payload
+
+
 # S3 data management
 
 
@@ -223,16 +403,491 @@ def delete_s3_file(s3_client, s3_bucket_name: str, key: str) -> None:
         raise errors.S3UploadError
 
 
-def move_s3_file(s3_client, s3_bucket_name: str, old_key: str, new_key) -> None:
-    """Move file to different S3 location"""
+def multipart_copy_s3_file(
+    s3_client,
+    s3_bucket_name: str,
+    old_key: str,
+    new_key: str,
+    *,
+    size: int,
+    etag: str,
+    part_size: int | None = None,
+    max_workers: int = 8,
+) -> None:
+    """Copies a file via a server side multipart upload, copying parts concurrently
+
+    Every part is copied with CopySourceIfMatch, so a source modified mid-copy causes
+    the copy to fail rather than producing a mixed object. The completed object is
+    checked against the source size and the ETag returned on completion.
+
+    :param size: the size of the source object, in bytes
+    :param etag: the ETag of the source object
+    :param part_size: the size of each copied part (default: MULTIPART_COPY_PART_SIZE)
+    :param max_workers: the maximum number of parts to copy at once
+    """
+    # S3 allows at most 10000 parts in an upload
+    part_size = max(part_size or MULTIPART_COPY_PART_SIZE, -(-size // 10000))
+    source = {"Bucket": s3_bucket_name, "Key": old_key}
+    upload_id = s3_client.create_multipart_upload(Bucket=s3_bucket_name, Key=new_key)["UploadId"]
+
+    def copy_part(part_number: int) -> dict:
+        start = (part_number - 1) * part_size
+        end = min(start + part_size, size) - 1
+        res = s3_client.upload_part_copy(
+            Bucket=s3_bucket_name,
+            Key=new_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            CopySource=source,
+            CopySourceRange=f"bytes={start}-{end}",
+            CopySourceIfMatch=etag,
+        )
+        return {"PartNumber": part_number, "ETag": res["CopyPartResult"]["ETag"]}
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            parts = list(executor.map(copy_part, range(1, -(-size // part_size) + 1)))
+        complete_response = s3_client.complete_multipart_upload(
+            Bucket=s3_bucket_name,
+            Key=new_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=s3_bucket_name, Key=new_key, UploadId=upload_id)
+        raise
+    head = s3_client.head_object(Bucket=s3_bucket_name, Key=new_key)
+    if head["ContentLength"] != size or head["ETag"] != complete_response["ETag"]:
+        logger.error("error verifying multipart copy of %s to %s", old_key, new_key)
+        raise errors.S3UploadError(f"Copy of {old_key} to {new_key} could not be verified")
+
+
+def copy_s3_file(
+    s3_client,
+    s3_bucket_name: str,
+    old_key: str,
+    new_key: str,
+    size: int | None = None,
+    etag: str | None = None,
+) -> None:
+    """Copies a file to a different S3 location, using a multipart copy for large files
+
+    :param size: the size of the source object in bytes, if known. Files larger than
+        MULTIPART_COPY_THRESHOLD are copied in parts. If the size is not supplied, a
+        single request copy is tried first, and only sources too large for one are
+        looked up and copied in parts.
+    :param etag: the expected ETag of the source object, if known. The copy fails if
+        the source doesn't match it.
+    """
+    if size is not None and size > MULTIPART_COPY_THRESHOLD:
+        _head_and_multipart_copy(s3_client, s3_bucket_name, old_key, new_key, size, etag)
+        return
     source = {"Bucket": s3_bucket_name, "Key": old_key}
-    copy_response = s3_client.copy_object(CopySource=source, Bucket=s3_bucket_name, Key=new_key)
-    if copy_response["ResponseMetadata"]["HTTPStatusCode"] != 200:
+    copy_args = {"CopySourceIfMatch": etag} if etag else {}
+    try:
+        copy_response = s3_client.copy_object(
+            CopySource=source, Bucket=s3_bucket_name, Key=new_key, **copy_args
+        )
+    except botocore.exceptions.ClientError as e:
+        # S3 rejects single request copies of sources over 5GB
+        if size is not None or not _is_copy_size_error(e):
+            raise
+        _head_and_multipart_copy(s3_client, s3_bucket_name, old_key, new_key, None, etag)
+        return
+    status = copy_response["ResponseMetadata"]["HTTPStatusCode"]
+    if status != 200:
         logger.error("error copying file %s to %s", old_key, new_key)
-        raise errors.S3UploadError
+        raise errors.S3UploadError(f"copy returned HTTP {status}")
+
+
+def _is_copy_size_error(e: botocore.exceptions.ClientError) -> bool:
+    error = e.response.get("Error", {})
+    return error.get("Code") == "InvalidRequest" and "maximum allowable size" in error.get(
+        "Message", ""
+    )
+
+
+def _head_and_multipart_copy(
+    s3_client,
+    s3_bucket_name: str,
+    old_key: str,
+    new_key: str,
+    size: int | None,
+    etag: str | None,
+) -> None:
+    """Runs a multipart copy, looking up the size and ETag of the source if needed"""
+    if size is None or etag is None:
+        head = s3_client.head_object(Bucket=s3_bucket_name, Key=old_key)
+        if etag is not None and head["ETag"] != etag:
+            raise errors.S3UploadError(f"{old_key} was modified before it could be copied")
+        size, etag = head["ContentLength"], head["ETag"]
+    multipart_copy_s3_file(s3_client, s3_bucket_name, old_key, new_key, size=size, etag=etag)
+
+
+def move_s3_file(
+    s3_client,
+    s3_bucket_name: str,
+    old_key: str,
+    new_key,
+    size: int | None = None,
+    etag: str | None = None,
+) -> None:
+    """Move file to different S3 location
+
+    :param size: the size of the source object in bytes, if known (see copy_s3_file)
+    :param etag: the ETag of the source object, if known (see copy_s3_file)
+    """
+    copy_s3_file(s3_client, s3_bucket_name, old_key, new_key, size=size, etag=etag)
     delete_s3_file(s3_client, s3_bucket_name, old_key)
 
 
+def use_pointer_layout() -> bool:
+    """Returns true if this deployment stores count data as blobs behind pointers"""
+    return os.environ.get("STORAGE_LAYOUT") == STORAGE_LAYOUT_POINTER
+
+
+def put_s3_blob(
+    s3_client, s3_bucket_name: str, study: str, filename: str, payload: bytes | io.IOBase
+) -> str:
+    """Writes a payload to the content addressed blob store, returning its key
+
+    Blobs are keyed by the sha256 of their contents, so a reupload of an unchanged
+    file is not written a second time.
+
+    :param payload: the contents of the blob, or a file object to stream them from.
+        Streamed payloads are hashed while they're uploaded to a staging key in temp,
+        which is then copied to the blob key, so large files aren't held in memory.
+    """
+    suffix = filename.split(".", 1)[1] if "." in filename else "bin"
+    if isinstance(payload, bytes):
+        key = f"{enums.BucketPath.BLOB}/{study}/{hashlib.sha256(payload).hexdigest()}.{suffix}"
+        try:
+            s3_client.put_object(Bucket=s3_bucket_name, Key=key, Body=payload, IfNoneMatch="*")
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] not in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+            ):
+                raise
+        return key
+    reader = _HashingReader(payload)
+    staging_key = f"{enums.BucketPath.TEMP}/{enums.BucketPath.BLOB}/{uuid.uuid4().hex}"
+    s3_client.upload_fileobj(reader, Bucket=s3_bucket_name, Key=staging_key)
+    key = f"{enums.BucketPath.BLOB}/{study}/{reader.hash.hexdigest()}.{suffix}"
+    try:
+        s3_client.head_object(Bucket=s3_bucket_name, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+        copy_s3_file(s3_client, s3_bucket_name, staging_key, key, size=reader.size)
+    delete_s3_file(s3_client, s3_bucket_name, staging_key)
+    return key
+
+
+class _HashingReader(io.RawIOBase):
+    """Wraps a file object, computing the sha256 and size of what is read from it"""
+
+    def __init__(self, fileobj: io.IOBase):
+        super().__init__()
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+
+def put_s3_pointer(s3_client, s3_bucket_name: str, key: str, target_key: str) -> tuple[int, str]:
+    """Writes a pointer record at key, referring to the blob at target_key
+
+    The target is stored in the object metadata, which is carried along by copies,
+    so pointers can be moved between state folders with the usual move functions.
+
+    :returns: the size and ETag of the pointer object
+    """
+    body = json.dumps({"target": target_key}).encode("UTF-8")
+    res = s3_client.put_object(
+        Bucket=s3_bucket_name,
+        Key=key,
+        Body=body,
+        ContentType="application/json",
+        Metadata={POINTER_METADATA_KEY: target_key},
+    )
+    return len(body), res["ETag"]
+
+
+def resolve_s3_pointer(s3_path: str, s3_client=None) -> str:
+    """Given an s3 path or key, returns the location of the data it refers to
+
+    Outside of the pointer layout, or for an object that is not a pointer (i.e. data
+    uploaded before the layout was enabled), the input is returned unchanged. Keys
+    are resolved against the BUCKET_NAME bucket; paths keep their bucket.
+    """
+    if not use_pointer_layout():
+        return s3_path
+    s3_client = s3_client or boto3.client("s3")
+    bucket = _get_bucket_from_s3_path(s3_path)
+    head = s3_client.head_object(Bucket=bucket, Key=get_s3_key_from_path(s3_path))
+    target = head.get("Metadata", {}).get(POINTER_METADATA_KEY)
+    if target is None:
+        return s3_path
+    if s3_path.startswith("s3://"):
+        return f"s3://{bucket}/{target}"
+    return target
+
+
+def get_generation_prefix(key: str) -> str:
+    """Given an aggregate key, returns the prefix its generations are stored under"""
+    return f"{enums.BucketPath.GENERATION}/{get_folder_from_s3_path(key)}"
+
+
+def get_data_package_cache_key(dp_id: str) -> str:
+    """Returns the key of the cached entry for a single data package"""
+    return f"{enums.BucketPath.CACHE}/{enums.JsonFilename.DATA_PACKAGES}/{dp_id}.json"
+
+
+def get_s3_generation(s3_bucket_name: str, key: str, s3_client=None) -> dict | None:
+    """Returns the record of the published generation of an aggregate
+
+    The record contains the generation id, the key of the generation's file, and the
+    time it was published. Aggregates written before generations existed have none.
+    """
+    s3_client = s3_client or boto3.client("s3")
+    try:
+        return get_s3_json_as_dict(
+            s3_bucket_name, f"{get_generation_prefix(key)}/{GENERATION_RECORD_FILENAME}", s3_client
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+
+
+def resolve_s3_generation(s3_path: str, s3_client=None) -> str:
+    """Given an aggregate s3 path or key, returns the location of its published generation
+
+    If the aggregate has no generation record, the input is returned unchanged.
+    Keys are resolved against the BUCKET_NAME bucket; paths keep their bucket.
+    """
+    bucket = _get_bucket_from_s3_path(s3_path)
+    record = get_s3_generation(bucket, get_s3_key_from_path(s3_path), s3_client)
+    if record is None:
+        return s3_path
+    if s3_path.startswith("s3://"):
+        return f"s3://{bucket}/{record['key']}"
+    return record["key"]
+
+
+def get_transaction_completion_prefix(site: str, study: str, transaction_id: str) -> str:
+    """Returns the prefix under which an upload transaction's finished files are marked"""
+    return f"{enums.BucketPath.META}/transactions/{site}__{study}/{transaction_id}"
+
+
+def get_incomplete_transaction_files(
+    s3_client, s3_bucket_name: str, site: str, study: str, transaction: dict
+) -> set[str]:
+    """Returns the files of an upload transaction which have not finished processing
+
+    Each processed file leaves an empty marker object, named after the file, under
+    the transaction's completion prefix, so this is a single listing regardless of
+    how many files are in the upload.
+    """
+    expected = {
+        file
+        for upload_type in (
+            enums.UploadTypes.CUBE,
+            enums.UploadTypes.ANNOTATED_CUBE,
+            enums.UploadTypes.FLAT,
+        )
+        for file in transaction.get(f"{upload_type}", [])
+    }
+    prefix = get_transaction_completion_prefix(site, study, transaction["id"])
+    finished = {
+        get_filename_from_s3_path(key) for key in iter_s3_keys(s3_client, s3_bucket_name, prefix)
+    }
+    return expected - finished
+
+
+def delete_transaction_completion(
+    s3_client, s3_bucket_name: str, site: str, study: str, transaction_id: str
+) -> None:
+    """Removes the finished file markers of an upload transaction"""
+    prefix = get_transaction_completion_prefix(site, study, transaction_id)
+    delete_s3_files(s3_client, s3_bucket_name, iter_s3_keys(s3_client, s3_bucket_name, prefix))
+
+
+def _copy_s3_file_for_bulk(
+    s3_client, s3_bucket_name: str, old_key: str, new_key: str, size: int | None = None
+) -> str | None:
+    """Copies a file, returning an error message (or None on success) instead of raising"""
+    try:
+        copy_s3_file(s3_client, s3_bucket_name, old_key, new_key, size=size)
+    except (botocore.exceptions.ClientError, errors.S3UploadError) as e:
+        return str(e)
+    return None
+
+
+def copy_s3_files(
+    s3_client,
+    s3_bucket_name: str,
+    copies: Iterable[tuple[str, str]],
+    max_workers: int = 16,
+    sizes: dict[str, int] | None = None,
+) -> dict[str, str]:
+    """Copies many files concurrently inside of a bucket
+
+    :param copies: (old_key, new_key) pairs to copy
+    :param max_workers: the maximum number of copies to run at once
+    :param sizes: the sizes of the source objects in bytes, by old_key, where known
+        (see copy_s3_file)
+    :returns: a dict of old_key: error message for any copies that failed
+    """
+    copies = list(copies)
+    sizes = sizes or {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            lambda copy_pair: _copy_s3_file_for_bulk(
+                s3_client, s3_bucket_name, *copy_pair, size=sizes.get(copy_pair[0])
+            ),
+            copies,
+        )
+        failures = {
+            old_key: error for (old_key, _), error in zip(copies, results) if error is not None
+        }
+    for old_key, error in failures.items():
+        logger.error("error copying file %s: %s", old_key, error)
+    return failures
+
+
+def delete_s3_files(s3_client, s3_bucket_name: str, keys: Iterable[str]) -> dict[str, str]:
+    """Deletes many files, using delete_objects to remove up to 1000 keys per request
+
+    :param keys: the keys to delete
+    :returns: a dict of key: error message for any deletes that failed
+    """
+    keys = list(keys)
+    failures = {}
+    for i in range(0, len(keys), 1000):
+        batch = keys[i : i + 1000]
+        try:
+            res = s3_client.delete_objects(
+                Bucket=s3_bucket_name,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+            )
+        except botocore.exceptions.ClientError as e:
+            failures.update({key: str(e) for key in batch})
+            continue
+        for error in res.get("Errors", []):
+            failures[error["Key"]] = f"{error.get('Code')}: {error.get('Message')}"
+    for key, error in failures.items():
+        logger.error("error deleting file %s: %s", key, error)
+    return failures
+
+
+def move_s3_files(
+    s3_client,
+    s3_bucket_name: str,
+    moves: Iterable[tuple[str, str]],
+    max_workers: int = 16,
+    sizes: dict[str, int] | None = None,
+) -> dict[str, str]:
+    """Moves many files to different S3 locations
+
+    Copies are run concurrently; only the sources of successful copies are then
+    deleted, in batches.
+
+    :param moves: (old_key, new_key) pairs to move
+    :param max_workers: the maximum number of copies to run at once
+    :param sizes: the sizes of the source objects in bytes, by old_key, where known
+        (see copy_s3_file)
+    :returns: a dict of old_key: error message for any moves that failed
+    """
+    moves = list(moves)
+    failures = copy_s3_files(s3_client, s3_bucket_name, moves, max_workers=max_workers, sizes=sizes)
+    failures.update(
+        delete_s3_files(
+            s3_client, s3_bucket_name, [old_key for old_key, _ in moves if old_key not in failures]
+        )
+    )
+    return failures
+
+
+def iter_s3_keys(
+    s3_client,
+    s3_bucket_name: str,
+    prefix: str,
+    token: str | None = None,
+    max_keys: int | None = None,
+) -> Iterator[str]:
+    """Lazily yields all keys in S3 starting with the prefix, one listing page at a time"""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    pagination_config = {"PageSize": max_keys or 1000}
+    if token:
+        pagination_config["StartingToken"] = token
+    for page in paginator.paginate(
+        Bucket=s3_bucket_name, Prefix=prefix, PaginationConfig=pagination_config
+    ):
+        for record in page.get("Contents", []):
+            yield record["Key"]
+
+
+def iter_s3_objects(s3_client, s3_bucket_name: str, prefix: str) -> Iterator[tuple[str, int]]:
+    """Lazily yields the (key, size in bytes) of all objects in S3 starting with the prefix"""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=prefix):
+        for record in page.get("Contents", []):
+            yield record["Key"], record["Size"]
+
+
+def iter_s3_folders(
+    s3_client,
+    s3_bucket_name: str,
+    prefix: str,
+    delimiter: str = "/",
+) -> Iterator[str]:
+    """Lazily yields the immediate subfolders of a prefix from the S3 CommonPrefixes
+
+    This only returns one level of the folder hierarchy, so it is much cheaper than
+    listing every key under a prefix when you only need to know what folders exist.
+    """
+    if prefix and not prefix.endswith(delimiter):
+        prefix = prefix + delimiter
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=prefix, Delimiter=delimiter):
+        for common_prefix in page.get("CommonPrefixes", []):
+            yield common_prefix["Prefix"]
+
+
+def iter_s3_keys_from_prefixes(
+    s3_client,
+    s3_bucket_name: str,
+    prefixes: Iterable[str],
+    *,
+    folders: bool = False,
+    max_workers: int = 8,
+) -> Iterator[str]:
+    """Lists several prefixes concurrently, yielding results in prefix order
+
+    :param prefixes: the S3 prefixes to list
+    :param folders: if True, yields the subfolders of each prefix (via iter_s3_folders)
+        rather than every key under it
+    :param max_workers: the maximum number of listings to run at once
+    """
+    lister = iter_s3_folders if folders else iter_s3_keys
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings = executor.map(
+            lambda prefix: list(lister(s3_client, s3_bucket_name, prefix)), prefixes
+        )
+        for listing in listings:
+            yield from listing
+
+
 def get_s3_keys(
     s3_client,
     s3_bucket_name: str,
@@ -241,20 +896,7 @@ def get_s3_keys(
     max_keys: int | None = None,
 ) -> list[str]:
     """Gets the list of all keys in S3 starting with the prefix"""
-    if max_keys is None:
-        max_keys = 1000
-    if token:
-        res = s3_client.list_objects_v2(
-            Bucket=s3_bucket_name, Prefix=prefix, ContinuationToken=token, MaxKeys=max_keys
-        )
-    else:
-        res = s3_client.list_objects_v2(Bucket=s3_bucket_name, Prefix=prefix, MaxKeys=max_keys)
-    if "Contents" not in res:
-        return []
-    contents = [record["Key"] for record in res["Contents"]]
-    if res["IsTruncated"]:
-        contents += get_s3_keys(s3_client, s3_bucket_name, prefix, res["NextContinuationToken"])
-    return contents
+    return list(iter_s3_keys(s3_client, s3_bucket_name, prefix, token=token, max_keys=max_keys))
 
 
 def get_filename_from_s3_path(s3_path: str):
@@ -268,6 +910,13 @@ def get_folder_from_s3_path(s3_path: str):
     return s3_path.rsplit("/", 1)[0]
 
 
+def _get_bucket_from_s3_path(s3_path: str) -> str:
+    """returns the bucket of an S3 path, or the BUCKET_NAME bucket for a key"""
+    if s3_path.startswith("s3://"):
+        return s3_path.split("/")[2]
+    return os.environ.get("BUCKET_NAME")
+
+
 def get_s3_key_from_path(s3_path: str):
     """returns a valid S3 key given an S3 path (or given a key, returns the key)"""
     if s3_path.startswith("s3"):
@@ -275,6 +924,80 @@ def get_s3_key_from_path(s3_path: str):
     return s3_path
 
 
+class S3RangeReader(io.RawIOBase):
+    """A read only, seekable file object over an S3 object, using ranged GETs
+
+    This lets things like zipfile work with an object without downloading all of it;
+    wrap it in an io.BufferedReader to control how many bytes each request fetches.
+    Every request is pinned to the ETag the object had when opened, so a concurrent
+    overwrite causes an error rather than a mix of old and new bytes.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        s3_bucket_name: str,
+        key: str,
+        *,
+        size: int | None = None,
+        etag: str | None = None,
+    ):
+        """
+        :param size: the size of the object, in bytes
+        :param etag: the ETag of the object. If size and etag are both provided (i.e.
+            from another reader of the same object), the object isn't looked up.
+        """
+        super().__init__()
+        self.s3_client = s3_client
+        self.s3_bucket_name = s3_bucket_name
+        self.key = key
+        if size is None or etag is None:
+            head = s3_client.head_object(Bucket=s3_bucket_name, Key=key)
+            size, etag = head["ContentLength"], head["ETag"]
+        self.size = size
+        self.etag = etag
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        match whence:
+            case io.SEEK_SET:
+                position = offset
+            case io.SEEK_CUR:
+                position = self._position + offset
+            case io.SEEK_END:
+                position = self.size + offset
+            case _:
+                raise ValueError(f"Invalid whence value {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def readinto(self, buffer) -> int:
+        if self._position >= self.size or len(buffer) == 0:
+            return 0
+        end = min(self._position + len(buffer), self.size) - 1
+        res = self.s3_client.get_object(
+            Bucket=self.s3_bucket_name,
+            Key=self.key,
+            Range=f"bytes={self._position}-{end}",
+            IfMatch=self.etag,
+        )
+        data = res["Body"].read()
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
 def get_s3_json_as_dict(bucket, key: str, s3_client=None):
     """reads a json object as dict (typically metadata in this case)"""
     s3_client = s3_client or boto3.client("s3")
@@ -299,28 +1022,63 @@ def get_s3_toml_as_dict(bucket, key: str, s3_client=None):
     return tomllib.loads(bytes_buffer.getvalue().decode())
 
 
-def get_latest_data_package_version(bucket, prefix):
-    """Returns the newest version in a data package folder"""
-    s3_client = boto3.client("s3")
+def get_latest_data_package_version(bucket, prefix, s3_client=None):
+    """Returns the newest version in an aggregate study or data package folder
+
+    Rather than listing every file under the prefix, this walks the folder structure
+    (study -> data package -> version) via delimiter listings, so only the folder names
+    are retrieved from S3.
+    """
+    s3_client = s3_client or boto3.client("s3")
     if not prefix.endswith("/"):
         prefix = prefix + "/"
-    s3_res = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+    folders = list(iter_s3_folders(s3_client, bucket, prefix))
+    # If we were handed a study folder, we need to go one level deeper to find
+    # the version folders inside each data package
+    if folders and len(folders[0].rstrip("/").split("/")[-1].split("__")) == 2:
+        folders = list(iter_s3_keys_from_prefixes(s3_client, bucket, folders, folders=True))
     highest_ver = None
-    if "Contents" in s3_res:
-        for item in s3_res["Contents"]:
-            ver_str = parse_s3_key(item["Key"]).version
-            if ver_str.isdigit():
-                if highest_ver is None:
-                    highest_ver = ver_str
-                else:
-                    if int(highest_ver) < int(ver_str):
-                        highest_ver = ver_str
-    if "Contents" not in s3_res or highest_ver is None:
+    for folder in folders:
+        ver_str = folder.rstrip("/").split("/")[-1].split("__")[-1]
+        if ver_str.isdigit():
+            if highest_ver is None or int(highest_ver) < int(ver_str):
+                highest_ver = ver_str
+    if highest_ver is None:
         logger.error("No data package versions found for %s", prefix)
     return highest_ver
 
 
-@dataclasses.dataclass(kw_only=True)
+def get_glue_table_names(
+    database: str, *, expected: Iterable[str] = (), glue_client=None
+) -> set[str]:
+    """Returns the names of the tables in a Glue database
+
+    The listing is read directly from the catalog, and kept for GLUE_TABLE_CACHE_TTL
+    seconds. A cached listing missing any of the expected tables is refreshed, so
+    that recently registered tables are found without waiting out the TTL. Tables
+    that were still missing after a refresh (i.e. for a folder that failed to crawl)
+    don't cause another one until the TTL is up.
+
+    :param database: the Glue database name
+    :param expected: table names the caller is looking for
+    """
+    expected = set(expected)
+    if cached := _glue_table_names.get(database):
+        fetched_at, names, missing = cached
+        if time.monotonic() - fetched_at < GLUE_TABLE_CACHE_TTL and names | missing >= expected:
+            return names
+    glue_client = glue_client or boto3.client("glue")
+    paginator = glue_client.get_paginator("get_tables")
+    names = {
+        table["Name"]
+        for page in paginator.paginate(DatabaseName=database)
+        for table in page["TableList"]
+    }
+    _glue_table_names[database] = (time.monotonic(), names, expected - names)
+    return names
+
+
+@dataclasses.dataclass(kw_only=True, frozen=True, slots=True)
 class PackageMetadata:
     study: str
     site: str | None = None
@@ -356,84 +1114,71 @@ class PackageMetadata:
                 )
 
 
+def _match_aggregate_key(key_parts: list[str]) -> tuple:
+    return (key_parts[1], None, key_parts[2].split("__")[1], key_parts[3], key_parts[4])
+
+
+def _match_site_data_package_key(key_parts: list[str]) -> tuple:
+    return (key_parts[1], key_parts[3], key_parts[2].split("__")[1], key_parts[4], key_parts[5])
+
+
+def _match_flat_key(key_parts: list[str]) -> tuple:
+    table_parts = key_parts[3].split("__")
+    return (key_parts[1], key_parts[2], table_parts[1], table_parts[3], key_parts[4])
+
+
+def _match_manifest_key(key_parts: list[str]) -> tuple:
+    if key_parts[-1] == "manifest.json":
+        return (key_parts[1], None, None, key_parts[2], key_parts[3])
+    return (key_parts[1], key_parts[2], None, key_parts[3].split("__")[2], key_parts[4])
+
+
+def _match_upload_key(key_parts: list[str]) -> tuple:
+    return (key_parts[1], key_parts[3], key_parts[2], key_parts[4], key_parts[5])
+
+
+def _match_upload_staging_key(key_parts: list[str]) -> tuple:
+    return (key_parts[1], key_parts[2], None, key_parts[3], key_parts[4])
+
+
+# Maps the root folder of a key to a function returning the
+# (study, site, data_package, version, filename) fields for that folder's layout
+S3_KEY_MATCHERS = {
+    enums.BucketPath.AGGREGATE: _match_aggregate_key,
+    enums.BucketPath.ARCHIVE: _match_site_data_package_key,
+    enums.BucketPath.ERROR: _match_site_data_package_key,
+    enums.BucketPath.LAST_VALID: _match_site_data_package_key,
+    enums.BucketPath.LATEST: _match_site_data_package_key,
+    enums.BucketPath.STUDY_META: _match_site_data_package_key,
+    enums.BucketPath.FLAT: _match_flat_key,
+    enums.BucketPath.LATEST_FLAT: _match_flat_key,
+    enums.BucketPath.MANIFEST: _match_manifest_key,
+    enums.BucketPath.UPLOAD: _match_upload_key,
+    enums.BucketPath.UPLOAD_STAGING: _match_upload_staging_key,
+}
+
+
+@functools.lru_cache(maxsize=65536)
 def parse_s3_key(key: str) -> PackageMetadata:
-    """Handles extraction of package metadata from an s3 key"""
-    try:
-        # did we get a full path instead?
-        key_parts = get_s3_key_from_path(key)
-        key_parts = key_parts.split("/")
-        match key_parts[0]:
-            case enums.BucketPath.AGGREGATE:
-                package = PackageMetadata(
-                    study=key_parts[1],
-                    site=None,
-                    data_package=key_parts[2].split("__")[1],
-                    version=key_parts[3],
-                    filename=key_parts[4],
-                )
-            case (
-                enums.BucketPath.ARCHIVE
-                | enums.BucketPath.ERROR
-                | enums.BucketPath.LAST_VALID
-                | enums.BucketPath.LATEST
-                | enums.BucketPath.STUDY_META
-            ):
-                package = PackageMetadata(
-                    study=key_parts[1],
-                    site=key_parts[3],
-                    data_package=key_parts[2].split("__")[1],
-                    version=key_parts[4],
-                    filename=key_parts[5],
-                )
-            case enums.BucketPath.FLAT | enums.BucketPath.LATEST_FLAT:
-                package = PackageMetadata(
-                    study=key_parts[1],
-                    site=key_parts[2],
-                    data_package=key_parts[3].split("__")[1],
-                    version=key_parts[3].split("__")[3],
-                    filename=key_parts[4],
-                )
-            case enums.BucketPath.MANIFEST:
-                if key_parts[-1] == "manifest.json":
-                    package = PackageMetadata(
-                        study=key_parts[1],
-                        site=None,
-                        data_package=None,
-                        version=key_parts[2],
-                        filename=key_parts[3],
-                    )
-                else:
-                    package = PackageMetadata(
-                        study=key_parts[1],
-                        site=key_parts[2],
-                        data_package=None,
-                        version=key_parts[3].split("__")[2],
-                        filename=key_parts[4],
-                    )
-            case enums.BucketPath.UPLOAD:
-                package = PackageMetadata(
-                    study=key_parts[1],
-                    site=key_parts[3],
-                    data_package=key_parts[2],
-                    version=key_parts[4],
-                    filename=key_parts[5],
-                )
-            case enums.BucketPath.UPLOAD_STAGING | enums.BucketPath.ARCHIVE:
-                package = PackageMetadata(
-                    study=key_parts[1],
-                    site=key_parts[2],
-                    data_package=None,
-                    version=key_parts[3],
-                    filename=key_parts[4],
-                )
-            case _:
-                raise errors.AggregatorS3Error(f" {key} does not correspond to a data package")
-        if "__" in package.version:
-            package.version = package.version.split("__")[-1]
+    """Handles extraction of package metadata from an s3 key
 
-        return package
+    Since PackageMetadata is immutable, results are memoized, so repeated parsing of
+    the same key (i.e. when walking a bucket listing more than once) is a dict lookup.
+    """
+    # did we get a full path instead?
+    key_parts = get_s3_key_from_path(key).split("/")
+    matcher = S3_KEY_MATCHERS.get(key_parts[0])
+    if matcher is None:
+        raise errors.AggregatorS3Error(f" {key} does not correspond to a data package")
+    try:
+        study, site, data_package, version, filename = matcher(key_parts)
     except IndexError:
         raise errors.AggregatorS3Error(f"{key} is not an expected S3 key")
+    if "__" in version:
+        version = version.split("__")[-1]
+    return PackageMetadata(
+        study=study, site=site, data_package=data_package, version=version, filename=filename
+    )
 
 
 def construct_s3_key(
@@ -476,12 +1221,14 @@ def construct_s3_key(
             filename=filename,
         )
     else:
-        dp_meta = dataclasses.replace(dp_meta)
-        dp_meta.site = site or dp_meta.site
-        dp_meta.study = study or dp_meta.study
-        dp_meta.data_package = data_package or dp_meta.data_package
-        dp_meta.version = version or dp_meta.version
-        dp_meta.filename = filename or dp_meta.filename
+        dp_meta = dataclasses.replace(
+            dp_meta,
+            site=site or dp_meta.site,
+            study=study or dp_meta.study,
+            data_package=data_package or dp_meta.data_package,
+            version=version or dp_meta.version,
+            filename=filename or dp_meta.filename,
+        )
     match subbucket:
         case enums.BucketPath.AGGREGATE:
             key = (
@@ -22,6 +22,50 @@ logger = logging.getLogger()
 logger.setLevel(log_level)
 
 
+class DataPackageIndex:
+    """An index of the files of a data package in a subbucket, keyed by (site, version)
+
+    Each path is run through functions.parse_s3_key once at construction, so that
+    subsequent lookups of a given site's data for a given version don't need to
+    rescan the whole listing.
+    """
+
+    def __init__(self, paths: list[str], sizes: dict[str, int] | None = None):
+        """
+        :param paths: full S3 paths of the data package files
+        :param sizes: the size of each file in bytes, by path, where known
+        """
+        self.paths = paths
+        self.sizes = sizes or {}
+        self._index = {}
+        for path in paths:
+            dp_meta = functions.parse_s3_key(path)
+            self._index.setdefault((dp_meta.site, dp_meta.version), []).append((path, dp_meta))
+
+    def __contains__(self, site_version: tuple[str | None, str]) -> bool:
+        return site_version in self._index
+
+    def get(self, site: str | None, version: str) -> list[tuple[str, functions.PackageMetadata]]:
+        """Returns the (path, metadata) pairs for a given site and version
+
+        :param site: the site name (None for data not associated with a site)
+        :param version: the data package version
+        """
+        return self._index.get((site, version), [])
+
+    def get_version(self, version: str) -> list[tuple[str, functions.PackageMetadata]]:
+        """Returns the (path, metadata) pairs for every site's data for a given version
+
+        :param version: the data package version
+        """
+        return [
+            item
+            for (_, item_version), items in self._index.items()
+            if item_version == version
+            for item in items
+        ]
+
+
 class S3Manager:
     """Class for managing S3 paramaters/access from AWS events, or manual definition.
 
@@ -49,6 +93,7 @@ class S3Manager:
         self.version = None
         self.transaction = None
         self.dp_meta = None
+        self._data_package_indexes = {}
         # If the event is an SNS type event, we're in the aggregation pipeline and set up
         # some convenience values, overriding other input values
         if event is not None and "Records" in event and "Sns" in event["Records"][0]:
@@ -130,23 +175,16 @@ class S3Manager:
             s3_client=self.s3_client, s3_bucket_name=self.s3_bucket_name, key=path, payload=payload
         )
 
-    def copy_file(self, from_path: str, to_path: str) -> None:
+    def copy_file(self, from_path: str, to_path: str, size: int | None = None) -> None:
         """Copies a file from one location to another in S3.
 
         :param from_path: the data source S3 path or key
         :param to_path: the data destinationS3 path or key
+        :param size: the size of the source in bytes, if known (see functions.copy_s3_file)
         """
         from_path = functions.get_s3_key_from_path(from_path)
         to_path = functions.get_s3_key_from_path(to_path)
-        source = {
-            "Bucket": self.s3_bucket_name,
-            "Key": from_path,
-        }
-        self.s3_client.copy_object(
-            CopySource=source,
-            Bucket=self.s3_bucket_name,
-            Key=to_path,
-        )
+        functions.copy_s3_file(self.s3_client, self.s3_bucket_name, from_path, to_path, size=size)
 
     def write_data_to_file(self, data: str, path: str) -> None:
         """Creates a file in s3 from a string
@@ -158,16 +196,16 @@ class S3Manager:
         data = data.encode(encoding="utf-8")
         self.s3_client.put_object(Bucket=self.s3_bucket_name, Key=path, Body=data)
 
-    def move_file(self, from_path: str, to_path: str) -> None:
+    def move_file(self, from_path: str, to_path: str, size: int | None = None) -> None:
         """Moves file from one location to another in s3
 
         :param from_path: the data source S3 path or key
         :param to_path: the data destination S3 path or key
-
+        :param size: the size of the source in bytes, if known (see functions.copy_s3_file)
         """
         from_path = functions.get_s3_key_from_path(from_path)
         to_path = functions.get_s3_key_from_path(to_path)
-        functions.move_s3_file(self.s3_client, self.s3_bucket_name, from_path, to_path)
+        functions.move_s3_file(self.s3_client, self.s3_bucket_name, from_path, to_path, size=size)
 
     def delete_file(self, path: str) -> None:
         """Deletes a file at the speicified location in S3
@@ -178,6 +216,48 @@ class S3Manager:
         path = functions.get_s3_key_from_path(path)
         functions.delete_s3_file(self.s3_client, self.s3_bucket_name, path)
 
+    def move_files(
+        self, moves: list[tuple[str, str]], sizes: dict[str, int] | None = None
+    ) -> dict[str, str]:
+        """Moves many files from one location to another in s3
+
+        Copies are run concurrently, and the sources are deleted in batches.
+
+        :param moves: (from_path, to_path) pairs of S3 paths or keys
+        :param sizes: the sizes of the sources in bytes, by from_path, where known
+            (see functions.copy_s3_file)
+        :returns: a dict of from_path: error message for any moves that failed
+        """
+        sizes = sizes or {}
+        key_moves = {
+            functions.get_s3_key_from_path(from_path): (
+                from_path,
+                functions.get_s3_key_from_path(to_path),
+            )
+            for from_path, to_path in moves
+        }
+        failures = functions.move_s3_files(
+            self.s3_client,
+            self.s3_bucket_name,
+            [(from_key, to_key) for from_key, (_, to_key) in key_moves.items()],
+            sizes={
+                from_key: sizes[from_path]
+                for from_key, (from_path, _) in key_moves.items()
+                if from_path in sizes
+            },
+        )
+        return {key_moves[key][0]: error for key, error in failures.items()}
+
+    def delete_files(self, paths: list[str]) -> dict[str, str]:
+        """Deletes many files in S3, in batches
+
+        :param paths: the data S3 paths or keys
+        :returns: a dict of path: error message for any deletes that failed
+        """
+        keys = {functions.get_s3_key_from_path(path): path for path in paths}
+        failures = functions.delete_s3_files(self.s3_client, self.s3_bucket_name, keys.keys())
+        return {keys[key]: error for key, error in failures.items()}
+
     def get_last_modified_timestamp(self, path: str):
         path = functions.get_s3_key_from_path(path)
         return self.s3_client.head_object(Bucket=self.s3_bucket_name, Key=path)["LastModified"]
@@ -211,9 +291,96 @@ class S3Manager:
             bucket_root, self.s3_bucket_name, self.study, self.data_package
         )
 
+    def get_data_package_sizes(self, bucket_root) -> dict[str, int]:
+        """Gets the data packages associated with the study from the SNS event payload,
+        along with their sizes
+
+        :param bucket_root: the top level directory name in the root of the S3 bucket
+        :returns: a dict of full s3 file paths to their sizes in bytes
+        """
+        path = awswrangler_functions.get_s3_data_package_path(
+            bucket_root, self.s3_bucket_name, self.study, self.data_package
+        )
+        return {
+            f"s3://{self.s3_bucket_name}/{key}": size
+            for key, size in functions.iter_s3_objects(
+                self.s3_client, self.s3_bucket_name, functions.get_s3_key_from_path(path)
+            )
+            if key.endswith("parquet")
+        }
+
+    def get_data_package_index(self, bucket_root) -> DataPackageIndex:
+        """Gets an index of the data packages associated with the study from the SNS event.
+
+        The listing is only performed the first time a given bucket root is requested;
+        later calls reuse it for the rest of the lifetime of this manager.
+
+        :param bucket_root: the top level directory name in the root of the S3 bucket
+        :returns: a DataPackageIndex of full s3 file paths
+        """
+        if bucket_root not in self._data_package_indexes:
+            sizes = self.get_data_package_sizes(bucket_root)
+            self._data_package_indexes[bucket_root] = DataPackageIndex(list(sizes), sizes)
+        return self._data_package_indexes[bucket_root]
+
     # parquet output creation
+    def register_table(self, df: pandas.DataFrame, key: str, location: str | None = None) -> None:
+        """Registers the Glue table for a published aggregate or flat table
+
+        The table is named after the folder the key is in, as the crawler would do, and
+        reads from that folder unless given another location. If registering a table
+        in its own folder fails, the table is left for the crawler to pick up; the
+        crawler can't find tables anywhere else, so other failures are raised.
+
+        :param df: the dataframe that was written to the key
+        :param key: the S3 key of the published data
+        :param location: the S3 key of the folder the table reads from, if not the key's
+        """
+        database = os.environ.get("GLUE_DB_NAME")
+        if database is None:
+            return
+        folder = functions.get_folder_from_s3_path(key)
+        try:
+            awswrangler_functions.register_parquet_table(
+                df,
+                database=database,
+                table=folder.split("/")[-1],
+                path=f"s3://{self.s3_bucket_name}/{location or folder}/",
+            )
+        except Exception:
+            if location is not None:
+                raise
+            logger.exception("Error registering table for %s, deferring to crawler", key)
+
+    def complete_transaction_file(self) -> bool:
+        """Marks the file being processed as finished in the site/study's transaction
+
+        Since each file's marker is written before the completion set is listed, exactly
+        the last file of an upload to finish (or, at worst, a couple finishing at the
+        same moment) will see the whole set.
+
+        :returns: True if every file of the upload has now been processed
+        """
+        try:
+            transaction = self.get_transaction()
+        except botocore.exceptions.ClientError:
+            # The transaction has already been resolved or cleaned up
+            return False
+        prefix = functions.get_transaction_completion_prefix(
+            self.site, self.study, transaction["id"]
+        )
+        self.s3_client.put_object(
+            Bucket=self.s3_bucket_name, Key=f"{prefix}/{self.dp_meta.filename}", Body=b""
+        )
+        return not functions.get_incomplete_transaction_files(
+            self.s3_client, self.s3_bucket_name, self.site, self.study, transaction
+        )
+
     def cache_api(self):
-        """Sends an SNS cache event"""
+        """Marks the current file as processed, and sends an SNS completeness event
+        if it was the last file of its upload"""
+        if self.dp_meta is not None and not self.complete_transaction_file():
+            return
         topic_sns_arn = os.environ.get("TOPIC_COMPLETENESS_ARN")
         self.sns_client.publish(
             TopicArn=topic_sns_arn,
@@ -221,16 +388,57 @@ class S3Manager:
             Subject="check_completeness",
         )
 
-    def write_parquet(self, df: pandas.DataFrame, key=None) -> None:
-        """Writes a dataframe as parquet to s3 and sends an SNS cache event if new
+    def write_parquet(self, df: pandas.DataFrame, key=None) -> str:
+        """Writes a dataframe as a new aggregate generation, publishes it, registers its
+        Glue table, and sends a cache event
+
+        The data is written to a new, immutable generation folder. The Glue table is
+        then pointed at that folder, and the generation record other readers resolve
+        is updated. A failed write leaves the previous generation published, and
+        neither Athena queries nor readers that resolve a generation see a file
+        change under them.
 
         :param df: pandas dataframe
-        :param is_new_data_package: if true, will dispatch a cache SNS event after copy is completed
-        :param path: an S3 path to write to (default: aggregate path)"""
+        :param key: the S3 key the data is published as (default: aggregate path). Data
+            is no longer written to the key itself; any file there from before
+            generations existed is removed, so the crawler doesn't find stale data.
+        :returns: the id of the new generation"""
         if key is None:
             key = self.parquet_aggregate_key
-        awswrangler.s3.to_parquet(df, f"s3://{self.s3_bucket_name}/{key}", index=False)
+        timestamp = datetime.datetime.now(datetime.UTC).strftime("%Y%m%dT%H%M%S%fZ")
+        generation = f"{timestamp}-{uuid.uuid4().hex[:8]}"
+        prefix = functions.get_generation_prefix(key)
+        generation_key = f"{prefix}/{generation}/{functions.get_filename_from_s3_path(key)}"
+        awswrangler.s3.to_parquet(df, f"s3://{self.s3_bucket_name}/{generation_key}", index=False)
+        self.register_table(df, key, location=functions.get_folder_from_s3_path(generation_key))
+        self.put_file(
+            f"{prefix}/{functions.GENERATION_RECORD_FILENAME}",
+            {
+                "generation": generation,
+                "key": generation_key,
+                "published_at": datetime.datetime.now(datetime.UTC).isoformat(),
+            },
+        )
+        self.delete_file(key)
+        self._prune_generations(prefix, generation)
         self.cache_api()
+        return generation
+
+    def _prune_generations(self, prefix: str, current: str) -> None:
+        """Removes all but the newest functions.GENERATIONS_KEPT generations"""
+        generations = sorted(
+            folder
+            for folder in functions.iter_s3_folders(self.s3_client, self.s3_bucket_name, prefix)
+            if not folder.endswith(f"/{current}/")
+        )
+        stale = generations[: max(len(generations) - (functions.GENERATIONS_KEPT - 1), 0)]
+        if not stale:
+            return
+        failures = self.delete_files(
+            list(functions.iter_s3_keys_from_prefixes(self.s3_client, self.s3_bucket_name, stale))
+        )
+        if failures:
+            logger.warning("Could not remove old generations: %s", failures)
 
     # metadata
     def update_local_metadata(
@@ -344,7 +552,16 @@ class S3Manager:
         )
 
     def delete_transaction(self):
+        try:
+            transaction_id = self.get_transaction()["id"]
+        except Exception:
+            # Missing or malformed, so there are no completion markers to find
+            transaction_id = None
         self.delete_file(self.transaction)
+        if transaction_id is not None:
+            functions.delete_transaction_completion(
+                self.s3_client, self.s3_bucket_name, self.site, self.study, transaction_id
+            )
 
     def get_manifest(self):
         try:
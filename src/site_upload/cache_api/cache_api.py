@@ -1,37 +1,165 @@
 """Lambda for running and caching query results"""
 
+import concurrent.futures
 import json
 import os
 
-import awswrangler
 import boto3
+import botocore
 
-from shared import decorators, enums, functions
+from shared import decorators, enums, errors, functions
 
 
-def cache_data_packages(s3_client, s3_bucket_name: str, db: str):
-    """Creates a cache of data package metadata information"""
-    df = awswrangler.athena.read_sql_query(
-        (
-            f"SELECT table_name FROM information_schema.tables "  # noqa: S608
-            f"WHERE table_schema = '{db}'"  # nosec
-        ),
-        database=db,
-        s3_output=f"s3://{s3_bucket_name}/awswrangler",
-        workgroup=os.environ.get("WORKGROUP_NAME"),
+def _get_cache(s3_client, s3_bucket_name: str, target: str) -> dict | list | None:
+    """Returns the current contents of a cache document, or None if there isn't one"""
+    try:
+        return functions.get_s3_json_as_dict(
+            s3_bucket_name, f"{enums.BucketPath.CACHE.value}/{target}.json", s3_client
+        )
+    except botocore.exceptions.ClientError:
+        return None
+
+
+def _get_study_prefix(subbucket: str, study: str | None) -> str:
+    """Returns the prefix to list for a subbucket, limited to one study if specified"""
+    return subbucket if study is None else f"{subbucket}/{study}/"
+
+
+def _get_manifests(
+    s3_client, s3_bucket_name: str, study: str | None, max_workers: int = 16
+) -> dict[str, dict]:
+    """Downloads study manifests concurrently, keyed by their S3 key"""
+    manifest_keys = [
+        x
+        for x in functions.iter_s3_keys(
+            s3_client=s3_client,
+            s3_bucket_name=s3_bucket_name,
+            prefix=_get_study_prefix(enums.BucketPath.MANIFEST.value, study),
+        )
+        if x.endswith(".json")
+    ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        manifests = executor.map(
+            lambda key: functions.get_s3_json_as_dict(
+                bucket=s3_bucket_name, key=key, s3_client=s3_client
+            ),
+            manifest_keys,
+        )
+        return dict(zip(manifest_keys, manifests, strict=True))
+
+
+def _get_table_ids(files: list[str]) -> set[str]:
+    """Returns the names of the tables that the files in a bucket listing belong to"""
+    table_ids = set()
+    for file in files:
+        if file.startswith(f"{enums.BucketPath.GENERATION}/"):
+            # published aggregates are tabled under the name of their folder
+            if file.endswith(f"/{functions.GENERATION_RECORD_FILENAME}"):
+                table_ids.add(file.split("/")[-2])
+            continue
+        try:
+            table_ids.add(
+                functions.parse_s3_key(file).get_tablename(enums.BucketPath(file.split("/")[0]))
+            )
+        except errors.AggregatorS3Error:
+            continue
+    return table_ids
+
+
+def _get_data_package_entry_ids(s3_client, s3_bucket_name: str) -> set[str]:
+    """Returns the ids of all data packages with their own cache object"""
+    prefix = f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}/"
+    return {
+        key.removeprefix(prefix).removesuffix(".json")
+        for key in functions.iter_s3_keys(s3_client, s3_bucket_name, prefix)
+    }
+
+
+def _write_data_package_entries(
+    s3_client,
+    s3_bucket_name: str,
+    updated: list[dict],
+    replaced: set[str],
+    max_workers: int = 16,
+) -> None:
+    """Writes each data package to its own cache object, for single package lookups
+
+    :param updated: the data packages to write
+    :param replaced: the ids of the previous entries for the updated packages. Any of
+        these without an updated counterpart are removed.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(
+            executor.map(
+                lambda dp: functions.put_s3_file(
+                    s3_client, s3_bucket_name, functions.get_data_package_cache_key(dp["id"]), dp
+                ),
+                updated,
+            )
+        )
+    removed = replaced - {dp["id"] for dp in updated}
+    if removed:
+        failures = functions.delete_s3_files(
+            s3_client,
+            s3_bucket_name,
+            [functions.get_data_package_cache_key(dp_id) for dp_id in sorted(removed)],
+        )
+        if failures:
+            raise errors.AggregatorS3Error(f"Error removing cached data packages {list(failures)}")
+
+
+def cache_data_packages(s3_client, s3_bucket_name: str, db: str, study: str | None = None):
+    """Creates a cache of data package metadata information
+
+    Alongside the full list, each data package is cached individually, with an index
+    of data package ids by name, so that the API can look up packages without
+    downloading the whole list.
+
+    :param study: if specified, only this study's entries are recomputed, and are
+        replaced in the existing cache. This relies on runs not overlapping (the
+        lambda's reserved concurrency is 1), as concurrent updates would be lost.
+    """
+    dp_details = []
+    existing = _get_cache(s3_client, s3_bucket_name, enums.JsonFilename.DATA_PACKAGES.value)
+    if existing is None:
+        study = None
+    elif study is not None:
+        dp_details = [dp for dp in existing if dp["study"] != study]
+    # entries computed by this run, and which previous entries they replace
+    updated_from = len(dp_details)
+    if study is None:
+        # A full rebuild replaces everything, including entries left over from a
+        # list that has since gone missing
+        replaced = _get_data_package_entry_ids(s3_client, s3_bucket_name)
+    else:
+        replaced = {dp["id"] for dp in existing if dp["study"] == study}
+    files = list(
+        functions.iter_s3_keys_from_prefixes(
+            s3_client,
+            s3_bucket_name,
+            [
+                _get_study_prefix(enums.BucketPath.AGGREGATE.value, study),
+                _get_study_prefix(
+                    f"{enums.BucketPath.GENERATION}/{enums.BucketPath.AGGREGATE}", study
+                ),
+                _get_study_prefix(enums.BucketPath.FLAT.value, study),
+            ],
+        )
     )
+    table_ids = _get_table_ids(files)
+    tables = functions.get_glue_table_names(db, expected=table_ids)
     # this filters out system tables
-    data_packages = df[df["table_name"].str.contains("__")].iloc[:, 0]
+    data_packages = sorted(
+        table
+        for table in tables
+        if "__" in table and (study is None or table.startswith(f"{study}__"))
+    )
     column_types = functions.get_s3_json_as_dict(
         os.environ.get("BUCKET_NAME"),
         f"{enums.BucketPath.META.value}/{enums.JsonFilename.COLUMN_TYPES.value}.json",
     )
-    dp_details = []
-    files = functions.get_s3_keys(s3_client, s3_bucket_name, enums.BucketPath.AGGREGATE.value)
-    flat_files = functions.get_s3_keys(s3_client, s3_bucket_name, enums.BucketPath.FLAT.value)
-    files += flat_files
-    for dp in list(data_packages):
-        if not any([f"/{dp}" in x for x in files]):
+    for dp in data_packages:
+        if dp not in table_ids:
             continue
         dp_detail = {}
         dp_parts = dp.split("__")
@@ -45,55 +173,40 @@ def cache_data_packages(s3_client, s3_bucket_name: str, db: str):
         dp_ids = studies.get(dp_detail["name"], None)
         if dp_ids is None:  # pragma: no cover
             continue
-        for dp_id in dp_ids:
-            if dp_id not in dp:
-                continue
-
-            metadata = functions.parse_s3_key(
-                functions.get_s3_key_from_path(dp_ids[dp_id]["s3_path"])
+        # column types are keyed by table name
+        dp_info = dp_ids.get(dp)
+        if dp_info is None:
+            continue
+        metadata = functions.parse_s3_key(functions.get_s3_key_from_path(dp_info["s3_path"]))
+        dp_dict = {
+            **dp_detail,
+            **dp_info,
+            "version": metadata.version,
+            "id": f"{metadata.study}__{metadata.data_package}__{metadata.version}",
+        }
+        if "__flat" in dp_dict["s3_path"]:
+            dp_dict["site"] = metadata.site
+            dp_dict["type"] = "flat"
+            dp_dict["id"] = (
+                f"{metadata.study}__{metadata.data_package}__{metadata.site}__{metadata.version}"
             )
-            dp_dict = {
-                **dp_detail,
-                **dp_ids[dp_id],
-                "version": metadata.version,
-                "id": f"{metadata.study}__{metadata.data_package}__{metadata.version}",
-            }
-            if "__flat" in dp_dict["s3_path"]:
-                dp_dict["site"] = metadata.site
-                dp_dict["type"] = "flat"
-                dp_dict["id"] = (
-                    f"{metadata.study}__{metadata.data_package}__"
-                    f"{metadata.site}__{metadata.version}"
-                )
-            dp_details.append(dp_dict)
+        dp_details.append(dp_dict)
+    _write_data_package_entries(s3_client, s3_bucket_name, dp_details[updated_from:], replaced)
+    names = {}
+    for dp in dp_details:
+        names.setdefault(dp["name"], []).append(dp["id"])
+    functions.put_s3_file(
+        s3_client,
+        s3_bucket_name,
+        f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGE_NAMES.value}.json",
+        names,
+    )
     s3_client.put_object(
         Bucket=s3_bucket_name,
         Key=f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}.json",
         Body=json.dumps(dp_details, indent=2),
     )
 
-    # TODO: move the above into the following study-level endpoint
-    manifest_keys = functions.get_s3_keys(
-        s3_bucket_name=s3_bucket_name, prefix=enums.BucketPath.MANIFEST.value, s3_client=s3_client
-    )
-    manifest_keys = [x for x in manifest_keys if x.endswith(".json")]
-    studies = {}
-    for key in manifest_keys:
-        dp = functions.parse_s3_key(key)
-        if dp.study not in studies.keys():
-            studies[dp.study] = {}
-        studies[dp.study][dp.version] = functions.get_s3_json_as_dict(
-            bucket=s3_bucket_name, key=key, s3_client=s3_client
-        )
-        # For now, we'll exclude the build stages, but we may pull it back in the future
-        # if we have a use case for it.
-        studies[dp.study][dp.version].pop("stages", None)
-    s3_client.put_object(
-        Bucket=s3_bucket_name,
-        Key=f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.STUDIES.value}.json",
-        Body=json.dumps(studies, indent=2),
-    )
-
 
 def _get_metadata_from_table(table: dict, study_cols: dict, dp: dict, data_dict: dict) -> dict:
     output = {"description": table["description"], "columns": {}}
@@ -111,11 +224,20 @@ def _get_metadata_from_table(table: dict, study_cols: dict, dp: dict, data_dict:
     return output
 
 
-def cache_study_data(s3_client, s3_bucket_name: str, db: str) -> None:
-    """Creates a cache of study metadata information"""
-    manifest_keys = functions.get_s3_keys(
-        s3_bucket_name=s3_bucket_name, prefix=enums.BucketPath.MANIFEST.value, s3_client=s3_client
-    )
+def cache_study_data(s3_client, s3_bucket_name: str, db: str, study: str | None = None) -> None:
+    """Creates a cache of study metadata information
+
+    :param study: if specified, only this study's entry is recomputed, and is
+        replaced in the existing cache
+    """
+    studies = {}
+    if study is not None:
+        existing = _get_cache(s3_client, s3_bucket_name, enums.JsonFilename.STUDIES.value)
+        if existing is None:
+            study = None
+        else:
+            studies = existing
+            studies.pop(study, None)
     column_types = functions.get_s3_json_as_dict(
         os.environ.get("BUCKET_NAME"),
         f"{enums.BucketPath.META.value}/{enums.JsonFilename.COLUMN_TYPES.value}.json",
@@ -124,16 +246,11 @@ def cache_study_data(s3_client, s3_bucket_name: str, db: str) -> None:
         os.environ.get("BUCKET_NAME"),
         f"{enums.BucketPath.ADMIN.value}/metadata.json",
     )
-    manifest_keys = [x for x in manifest_keys if x.endswith(".json")]
-    studies = {}
-    for key in manifest_keys:
+    for key, manifest in _get_manifests(s3_client, s3_bucket_name, study).items():
         dp = functions.parse_s3_key(key)
         if dp.study not in studies.keys():
             studies[dp.study] = {}
         study_cols = column_types[dp.study]
-        manifest = functions.get_s3_json_as_dict(
-            bucket=s3_bucket_name, key=key, s3_client=s3_client
-        )
         owning_site_info = next(
             (
                 site_info[x]
@@ -166,11 +283,16 @@ def cache_study_data(s3_client, s3_bucket_name: str, db: str) -> None:
     )
 
 
-def cache_api_data(s3_client, s3_bucket_name: str, db: str, target: str) -> None:
-    """Performs caching of API data"""
+def cache_api_data(
+    s3_client, s3_bucket_name: str, db: str, target: str, study: str | None = None
+) -> None:
+    """Performs caching of API data
+
+    :param study: if specified, only updates the cache for this study
+    """
     if target == enums.JsonFilename.DATA_PACKAGES.value:
-        cache_data_packages(s3_client, s3_bucket_name, db)
-        cache_study_data(s3_client, s3_bucket_name, db)
+        cache_data_packages(s3_client, s3_bucket_name, db, study=study)
+        cache_study_data(s3_client, s3_bucket_name, db, study=study)
     else:
         raise KeyError("Invalid API caching target")
 
@@ -182,11 +304,15 @@ def cache_api_handler(event, context):
     s3_bucket_name = os.environ.get("BUCKET_NAME")
     s3_client = boto3.client("s3")
     db = os.environ.get("GLUE_DB_NAME")
+    study = None
     if "Records" in event:
         target = event["Records"][0]["Sns"]["Subject"]
+        # Events for a completed upload carry its study, and only it needs updating
+        study = event["Records"][0]["Sns"].get("Message") or None
     elif event.get("detail-type") == "Glue Crawler State Change":
+        # A crawl may have changed tables for any study
         target = enums.JsonFilename.DATA_PACKAGES.value
     else:  # pragma: no cover
         return functions.http_response(500, "Unexpected event source")
-    cache_api_data(s3_client, s3_bucket_name, db, target)
+    cache_api_data(s3_client, s3_bucket_name, db, target, study=study)
     return functions.http_response(200, "Study period update successful")
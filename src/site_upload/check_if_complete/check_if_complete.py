@@ -2,20 +2,22 @@ import datetime
 import json
 import logging
 import os
-import re
-from time import sleep
 
-import awswrangler
 import boto3
 
-from shared import enums, errors, functions
+from shared import enums, functions
 
 logger = logging.getLogger()
 logger.setLevel("INFO")
 s3_client = boto3.client("s3")
 sns_client = boto3.client("sns")
+sqs_client = boto3.client("sqs")
 g_client = boto3.client("glue")
 
+# How long to wait before checking again whether a busy crawler is available
+CRAWL_RETRY_DELAY = 60
+CRAWL_MAX_ATTEMPTS = 10
+
 
 def check_if_complete(message) -> (bool, dict):
     try:
@@ -28,54 +30,16 @@ def check_if_complete(message) -> (bool, dict):
         )
     except Exception:
         return False, None
-    upload_time = datetime.datetime.fromisoformat(transaction["uploaded_at"])
-    for filetype, source, suffix in [
-        ("cube", enums.BucketPath.AGGREGATE, "aggregate"),
-        ("annotated_cube", enums.BucketPath.AGGREGATE, "aggregate"),
-        ("flat", enums.BucketPath.FLAT, "flat"),
-    ]:
-        filenames = transaction.get(filetype, [])
-        for filename in filenames:
-            dp_meta = functions.PackageMetadata(
-                study=message["study"],
-                site=message["site"],
-                data_package=filename.split("__")[1].split(".")[0],
-                version=transaction["version"],
-            )
-            key = functions.construct_s3_key(
-                subbucket=source,
-                dp_meta=dp_meta,
-                filename=dp_meta.get_filename(source),
-            )
-            try:
-                head = s3_client.head_object(Bucket=os.environ.get("BUCKET_NAME"), Key=key)
-            except Exception:
-                return False, None
-            delta = head["LastModified"] - upload_time
-            # an average time to process from an upload to all the files being
-            # processed is a minute, and since this is largely parallel it shouldn't
-            # change by much; we'll set a large buffer just in case, which should
-            # still exclude dangling files from error states
-            if 300 <= delta.total_seconds() or delta.total_seconds() < 0:
-                return False, None
+    incomplete = functions.get_incomplete_transaction_files(
+        s3_client, os.environ.get("BUCKET_NAME"), message["site"], message["study"], transaction
+    )
+    if incomplete:
+        return False, None
     return True, transaction
 
 
 def has_new_packages(message, transaction) -> bool:
-    db = os.environ.get("GLUE_DB_NAME")
-    s3_bucket_name = os.environ.get("BUCKET_NAME")
-    if not re.fullmatch("^[a-zA-Z0-9_]+$", message["study"]):  # pragma: no cover
-        raise errors.AggregatorAthenaError("Invalid study")
-    tables = awswrangler.athena.read_sql_query(
-        (
-            f"SELECT table_name FROM information_schema.tables "  # noqa: S608
-            f"WHERE table_schema = '{db}' "
-            f"AND regexp_like(table_name, '^{message['study']}__')"
-        ),
-        database=db,
-        s3_output=f"s3://{s3_bucket_name}/awswrangler",
-        workgroup=os.environ.get("WORKGROUP_NAME"),
-    )["table_name"].values.tolist()
+    names = []
     for dp_type in ["cube", "annotated_cube", "flat"]:
         filenames = transaction.get(dp_type, [])
 
@@ -87,15 +51,18 @@ def has_new_packages(message, transaction) -> bool:
                 data_package=dp,
                 version=transaction["version"],
             )
-            name = dp_meta.get_tablename(
-                enums.BucketPath.FLAT if dp_type == "FLAT" else enums.BucketPath.AGGREGATE
+            names.append(
+                dp_meta.get_tablename(
+                    enums.BucketPath.FLAT if dp_type == "flat" else enums.BucketPath.AGGREGATE
+                )
             )
-            if name not in tables:
-                return True
-    return False
+    tables = functions.get_glue_table_names(
+        os.environ.get("GLUE_DB_NAME"), expected=names, glue_client=g_client
+    )
+    return not tables.issuperset(names)
 
 
-def cleanup_transaction(message) -> bool:
+def cleanup_transaction(message, transaction) -> bool:
     key = f"{enums.BucketPath.META}/transactions/{message['site']}__{message['study']}.json"
     # The delete_object function :should: be returning a dict with a flag
     # that can be used to determine if the delete was successful or not, but
@@ -107,6 +74,13 @@ def cleanup_transaction(message) -> bool:
     except Exception:
         return False
     s3_client.delete_object(Bucket=os.environ.get("BUCKET_NAME"), Key=key)
+    functions.delete_transaction_completion(
+        s3_client,
+        os.environ.get("BUCKET_NAME"),
+        message["site"],
+        message["study"],
+        transaction["id"],
+    )
     return True
 
 
@@ -123,45 +97,94 @@ def mock_entrypoint():
     pass
 
 
+def request_crawl(requests: list[dict], requested_at: str, attempt: int = 0) -> None:
+    """Queues a crawl covering data written by the requested site/studies
+
+    :param requests: the site/study messages the crawl is for
+    :param requested_at: an ISO timestamp; any crawl starting after this will do
+    :param attempt: the number of times the crawler was previously found busy
+    """
+    sqs_client.send_message(
+        QueueUrl=os.environ.get("QUEUE_CRAWL_REQUESTS"),
+        MessageBody=json.dumps(
+            {"requests": requests, "requested_at": requested_at, "attempt": attempt}
+        ),
+        DelaySeconds=CRAWL_RETRY_DELAY if attempt else 0,
+    )
+
+
+def schedule_crawl(records: list[dict]) -> dict:
+    """Coalesces a batch of queued crawl requests into (at most) one crawl
+
+    If the crawler is busy, the outstanding requests are merged and requeued with a
+    delay, rather than waiting in the lambda for the crawler to become available.
+    """
+    payloads = [json.loads(record["body"]) for record in records]
+    crawler = g_client.get_crawler(Name=os.environ.get("GLUE_CRAWLER_NAME"))["Crawler"]
+    last_crawl = crawler.get("LastCrawl", {}).get("StartTime")
+    pending = [
+        payload
+        for payload in payloads
+        if last_crawl is None
+        or last_crawl <= datetime.datetime.fromisoformat(payload["requested_at"])
+    ]
+    if not pending:
+        requests = [request for payload in payloads for request in payload["requests"]]
+        return functions.http_response(
+            200, f"Crawl requests for {requests!s} covered by subsequent request"
+        )
+    requests = [request for payload in pending for request in payload["requests"]]
+    if crawler["State"] == "READY":
+        try:
+            g_client.start_crawler(Name=os.environ.get("GLUE_CRAWLER_NAME"))
+            return functions.http_response(200, f"Crawl for {requests!s} initiated")
+        except g_client.exceptions.CrawlerRunningException:
+            # Another batch got there first, but that crawl may not cover this data
+            pass
+    attempt = max(payload["attempt"] for payload in pending) + 1
+    if attempt >= CRAWL_MAX_ATTEMPTS:
+        # Parked in the dead letter queue, so the crawl can be redriven once the
+        # crawler is available again
+        logger.error("Crawler unavailable, dead lettering crawl requests for %s", requests)
+        sqs_client.send_message(
+            QueueUrl=os.environ.get("QUEUE_CRAWL_REQUESTS_DEAD_LETTER"),
+            MessageBody=json.dumps(
+                {
+                    "requests": requests,
+                    "requested_at": min(payload["requested_at"] for payload in pending),
+                    "attempt": 0,
+                }
+            ),
+        )
+        return functions.http_response(500, "Error requesting crawl")
+    request_crawl(requests, min(payload["requested_at"] for payload in pending), attempt=attempt)
+    return functions.http_response(202, f"Crawl for {requests!s} deferred")
+
+
 # decorators.generic_error_handler(msg="Error processing metadata events")
 def check_if_complete_handler(event, context):
+    """Handles completeness events from SNS, and queued crawl requests from SQS"""
     del context
+    if "Sns" not in event["Records"][0]:
+        return schedule_crawl(event["Records"])
     message = json.loads(event["Records"][0]["Sns"]["Message"])
     completed, transaction = check_if_complete(message)
     if not completed:
         return functions.http_response(202, "Processing not completed")
     new = has_new_packages(message, transaction)
     mock_entrypoint()
+    cleanup_performed = cleanup_transaction(message, transaction)
+    if not cleanup_performed:
+        return functions.http_response(200, f"Processing request for {message!s} already sent")
     if new:
-        attempts = 0
-        while attempts < 10:
-            crawler = g_client.get_crawler(Name=os.environ.get("GLUE_CRAWLER_NAME"))["Crawler"]
-            if crawler["State"] == "READY":
-                cleanup_performed = cleanup_transaction(message)
-                if not cleanup_performed:
-                    return functions.http_response(
-                        200, f"Processing request for {message!s} already sent"
-                    )
-                eventtime = datetime.datetime.fromisoformat(event["Records"][0]["Sns"]["Timestamp"])
-                if "LastCrawl" in crawler and crawler["LastCrawl"]["StartTime"] > eventtime:
-                    return functions.http_response(
-                        200, f"Recrawl request for {message!s} covered by subsequent request"
-                    )
-                g_client.start_crawler(Name=os.environ.get("GLUE_CRAWLER_NAME"))
-                return functions.http_response(200, f"Crawl for {message!s} initiated")
-            attempts += 1
-            sleep(60)
-        return functions.http_response(500, "Error requesting crawl")
-    else:
-        cleanup_performed = cleanup_transaction(message)
-        if not cleanup_performed:
-            return functions.http_response(200, f"Processing request for {message!s} already sent")
-        topic_sns_arn = os.environ.get("TOPIC_CACHE_API_ARN")
-        sns_client.publish(
-            TopicArn=topic_sns_arn,
-            Message=message["study"],
-            Subject=enums.JsonFilename.DATA_PACKAGES,
-        )
-        return functions.http_response(
-            200, f"Crawl for {message!s} not required, directly invoked caching"
-        )
+        request_crawl([message], event["Records"][0]["Sns"]["Timestamp"])
+        return functions.http_response(200, f"Crawl for {message!s} requested")
+    topic_sns_arn = os.environ.get("TOPIC_CACHE_API_ARN")
+    sns_client.publish(
+        TopicArn=topic_sns_arn,
+        Message=message["study"],
+        Subject=enums.JsonFilename.DATA_PACKAGES,
+    )
+    return functions.http_response(
+        200, f"Crawl for {message!s} not required, directly invoked caching"
+    )
@@ -8,7 +8,7 @@ import awswrangler
 import pandas
 from pandas.core.indexes.range import RangeIndex
 
-from shared import decorators, enums, functions, pandas_functions, s3_manager
+from shared import decorators, enums, errors, functions, pandas_functions, s3_manager
 
 log_level = os.environ.get("LAMBDA_LOG_LEVEL", "INFO")
 logger = logging.getLogger()
@@ -44,7 +44,7 @@ def expand_and_concat_powersets(
         values since the powerset, by definition, contains lots of them.
 
     """
-    site_df = awswrangler.s3.read_parquet(file_path)
+    site_df = awswrangler.s3.read_parquet(functions.resolve_s3_pointer(file_path))
     if site_df.empty:
         raise MergeError("Uploaded data file is empty", filename=file_path)
     df_copy = site_df.copy()
@@ -89,22 +89,19 @@ def merge_powersets(manager: s3_manager.S3Manager) -> None:
     logger.info(f"Proccessing data package at {manager.s3_key}")
     # initializing this early in case an empty file causes us to never set it
     df = pandas.DataFrame()
-    latest_file_list = manager.get_data_package_list(enums.BucketPath.LATEST)
-    last_valid_file_list = manager.get_data_package_list(enums.BucketPath.LAST_VALID)
-    for last_valid_path in last_valid_file_list:
-        if manager.version not in last_valid_path:
-            continue
+    latest_index = manager.get_data_package_index(enums.BucketPath.LATEST)
+    last_valid_index = manager.get_data_package_index(enums.BucketPath.LAST_VALID)
+    for last_valid_path, last_valid_metadata in last_valid_index.get_version(manager.version):
         # If the site data is being updated, don't use the last valid data
-        if manager.site in last_valid_path:
+        if last_valid_metadata.site == manager.site:
             continue
-        last_valid_metadata = functions.parse_s3_key(last_valid_path)
         last_valid_subkey = functions.construct_s3_key(
             subbucket=enums.BucketPath.LAST_VALID, dp_meta=last_valid_metadata, subkey=True
         )
         # If the latest uploads don't include this site, we'll use the last-valid
         # one instead
         try:
-            if not any(last_valid_subkey in x for x in latest_file_list):
+            if (last_valid_metadata.site, last_valid_metadata.version) not in latest_index:
                 df = expand_and_concat_powersets(df, last_valid_path, last_valid_metadata.site)
                 manager.update_local_metadata(
                     enums.TransactionKeys.LAST_AGGREGATION, site=last_valid_metadata.site
@@ -117,10 +114,10 @@ def merge_powersets(manager: s3_manager.S3Manager) -> None:
                 last_valid_subkey,
                 e,
             )
-    for latest_path in latest_file_list:
-        if manager.version not in latest_path:
-            continue
-        latest_metadata = functions.parse_s3_key(latest_path)
+    # Old last_valid data that we've parked in temp while merging, to be removed
+    # once the new aggregate has been written
+    archived_files = []
+    for latest_path, latest_metadata in latest_index.get_version(manager.version):
         latest_subkey = functions.construct_s3_key(
             subbucket=enums.BucketPath.LATEST,
             study=latest_metadata.study,
@@ -129,18 +126,25 @@ def merge_powersets(manager: s3_manager.S3Manager) -> None:
             version=latest_metadata.version,
             subkey=True,
         )
+        last_valid_matches = [
+            path for path, _ in last_valid_index.get(latest_metadata.site, latest_metadata.version)
+        ]
         temp_files = []
         try:
             # if we're going to replace a file in last_valid, remove the old data
             date_str = datetime.datetime.now(datetime.UTC).isoformat()
-            for match in filter(lambda x: latest_subkey in x, last_valid_file_list):
-                match_filename = functions.get_filename_from_s3_path(match)
-                match_timestamped_filename = f"{date_str}.{match_filename}"
-                temp_target = (
-                    f"{enums.BucketPath.TEMP}/{latest_subkey}/{match_timestamped_filename}"
+            temp_moves = [
+                (
+                    match,
+                    f"{enums.BucketPath.TEMP}/{latest_subkey}/"
+                    f"{date_str}.{functions.get_filename_from_s3_path(match)}",
                 )
-                manager.move_file(match, temp_target)
-                temp_files.append((temp_target, match))
+                for match in last_valid_matches
+            ]
+            failures = manager.move_files(temp_moves, sizes=last_valid_index.sizes)
+            temp_files = [(temp, match) for match, temp in temp_moves if match not in failures]
+            if failures:
+                raise errors.S3UploadError(f"Error archiving {list(failures)} to temp")
             # otherwise, this is the first instance - after it's in the database,
             # we'll generate a new list of valid tables for the dashboard
             df = expand_and_concat_powersets(df, latest_path, manager.site)
@@ -153,6 +157,7 @@ def merge_powersets(manager: s3_manager.S3Manager) -> None:
                     subbucket=enums.BucketPath.LAST_VALID,
                     dp_meta=latest_metadata,
                 ),
+                size=latest_index.sizes.get(latest_path),
             )
 
             manager.update_local_metadata(
@@ -168,17 +173,28 @@ def merge_powersets(manager: s3_manager.S3Manager) -> None:
                 e,
             )
             # Undo any archiving we tried to do
-            for archive in temp_files:
-                manager.move_file(archive[0], archive[1])
+            rollback_sizes = {
+                temp: last_valid_index.sizes[match]
+                for temp, match in temp_files
+                if match in last_valid_index.sizes
+            }
+            if rollback_failures := manager.move_files(temp_files, sizes=rollback_sizes):
+                # These last valid files are left in temp, and will need restoring by hand
+                logger.error(
+                    f"Error restoring archived files to {enums.BucketPath.LAST_VALID}: "
+                    f"{rollback_failures}"
+                )
+            temp_files = []
             # if a new file fails, we want to replace it with the last valid
             # for purposes of aggregation
-            for match in filter(lambda x: latest_subkey in x, last_valid_file_list):
+            for match in last_valid_matches:
                 df = expand_and_concat_powersets(
                     df,
                     match,
                     manager.site,
                 )
                 manager.update_local_metadata(enums.TransactionKeys.LAST_AGGREGATION)
+        archived_files += temp_files
 
     if df.empty:
         raise OSError("File not found")
@@ -207,8 +223,7 @@ def merge_powersets(manager: s3_manager.S3Manager) -> None:
 
     # write out the aggregate and send a notification to the metadata queue
     manager.write_parquet(df)
-    for file in temp_files:
-        manager.delete_file(file[0])
+    manager.delete_files([file[0] for file in archived_files])
 
 
 @decorators.generic_error_handler(msg="Error merging powersets")
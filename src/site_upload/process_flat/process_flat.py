@@ -3,7 +3,7 @@ import os
 
 import awswrangler
 
-from shared import decorators, enums, functions, pandas_functions, s3_manager
+from shared import decorators, enums, errors, functions, pandas_functions, s3_manager
 
 log_level = os.environ.get("LAMBDA_LOG_LEVEL", "INFO")
 logger = logging.getLogger()
@@ -12,12 +12,17 @@ logger.setLevel(log_level)
 
 def process_flat(manager: s3_manager.S3Manager):
     flat_path = manager.parquet_flat_key.rsplit("/", 1)[0]
-    for key in manager.get_data_package_list(enums.BucketPath.FLAT.value):
-        if functions.get_s3_key_from_path(key).startswith(flat_path):
-            manager.move_file(
-                key,
-                key.replace(enums.BucketPath.FLAT.value, enums.BucketPath.ARCHIVE.value),
-            )
+    flat_sizes = manager.get_data_package_sizes(enums.BucketPath.FLAT.value)
+    failures = manager.move_files(
+        [
+            (key, key.replace(enums.BucketPath.FLAT.value, enums.BucketPath.ARCHIVE.value))
+            for key in flat_sizes
+            if functions.get_s3_key_from_path(key).startswith(flat_path)
+        ],
+        sizes=flat_sizes,
+    )
+    if failures:
+        raise errors.S3UploadError(f"Error archiving {list(failures)}")
 
     manager.move_file(
         manager.s3_key,
@@ -50,6 +55,7 @@ def process_flat(manager: s3_manager.S3Manager):
     )
     manager.write_local_metadata(meta_type=enums.JsonFilename.COLUMN_TYPES.value)
     manager.write_local_metadata()
+    manager.register_table(df, manager.parquet_flat_key)
     manager.cache_api()
 
 
@@ -1,5 +1,7 @@
 """Lambda for moving data to processing locations"""
 
+import concurrent.futures
+import datetime
 import logging
 import os
 
@@ -11,14 +13,36 @@ log_level = os.environ.get("LAMBDA_LOG_LEVEL", "INFO")
 logger = logging.getLogger()
 logger.setLevel(log_level)
 
+# The number of messages from an SQS batch to process at once
+BATCH_WORKERS = 10
+
 
 class UnexpectedFileTypeError(Exception):
     pass
 
 
-def process_upload(s3_client, sns_client, sqs_client, s3_bucket_name: str, s3_key: str) -> None:
-    """Moves file from upload path to appropriate subfolder and emits SNS event"""
-    last_uploaded_date = s3_client.head_object(Bucket=s3_bucket_name, Key=s3_key)["LastModified"]
+def process_upload(
+    s3_client,
+    sns_client,
+    sqs_client,
+    s3_bucket_name: str,
+    s3_key: str,
+    *,
+    uploaded_at: datetime.datetime | None = None,
+    size: int | None = None,
+    etag: str | None = None,
+) -> None:
+    """Moves file from upload path to appropriate subfolder and emits SNS event
+
+    :param uploaded_at: when the file was uploaded. If not provided, the file is looked
+        up in S3 for this, its size, and its ETag.
+    :param size: the size of the file in bytes, if known
+    :param etag: the ETag of the file, if known
+    """
+    if uploaded_at is None:
+        head = s3_client.head_object(Bucket=s3_bucket_name, Key=s3_key)
+        uploaded_at, size, etag = head["LastModified"], head["ContentLength"], head["ETag"]
+    last_uploaded_date = uploaded_at
 
     logger.info(f"Proccessing upload at {s3_key}")
     dp_meta = functions.parse_s3_key(s3_key)
@@ -53,7 +77,7 @@ def process_upload(s3_client, sns_client, sqs_client, s3_bucket_name: str, s3_ke
             s3_client.delete_object(Bucket=s3_bucket_name, Key=s3_key)
             logging.info(f"Deleted unexpected file at {s3_key}")
             return
-        functions.move_s3_file(s3_client, s3_bucket_name, s3_key, new_key)
+        functions.move_s3_file(s3_client, s3_bucket_name, s3_key, new_key, size=size, etag=etag)
         metadata = functions.update_metadata(
             metadata={},
             site=dp_meta.site,
@@ -77,14 +101,14 @@ def process_upload(s3_client, sns_client, sqs_client, s3_bucket_name: str, s3_ke
         new_key = functions.construct_s3_key(enums.BucketPath.MANIFEST, dp_meta=dp_meta)
         topic_sns_arn = os.environ.get("TOPIC_PROCESS_MANIFEST_ARN")
         sns_subject = "Process manifest event"
-        functions.move_s3_file(s3_client, s3_bucket_name, s3_key, new_key)
+        functions.move_s3_file(s3_client, s3_bucket_name, s3_key, new_key, size=size, etag=etag)
         sns_client.publish(TopicArn=topic_sns_arn, Message=new_key, Subject=sns_subject)
     else:
         new_key = functions.construct_s3_key(
             subbucket=enums.BucketPath.ERROR,
             dp_meta=dp_meta,
         )
-        functions.move_s3_file(s3_client, s3_bucket_name, s3_key, new_key)
+        functions.move_s3_file(s3_client, s3_bucket_name, s3_key, new_key, size=size, etag=etag)
         metadata = functions.update_metadata(
             metadata={},
             site=dp_meta.site,
@@ -109,15 +133,71 @@ def process_upload(s3_client, sns_client, sqs_client, s3_bucket_name: str, s3_ke
         raise UnexpectedFileTypeError
 
 
+def process_upload_message(
+    s3_client, sns_client, sqs_client, s3_bucket_name: str, message: str
+) -> None:
+    """Processes the file described by an upload message (see functions.get_upload_message)"""
+    message = functions.parse_upload_message(message)
+    process_upload(
+        s3_client,
+        sns_client,
+        sqs_client,
+        s3_bucket_name,
+        message["key"],
+        uploaded_at=message.get("uploaded_at"),
+        size=message.get("size"),
+        etag=message.get("etag"),
+    )
+
+
+def _get_clients() -> tuple:
+    """Returns the S3, SNS, and SQS clients used to process uploads"""
+    return (
+        boto3.client("s3"),
+        boto3.client("sns", region_name=os.environ.get("AWS_REGION")),
+        boto3.client("sqs", region_name=os.environ.get("AWS_REGION")),
+    )
+
+
 @decorators.generic_error_handler(msg="Error processing file upload")
-def process_upload_handler(event, context):
-    """manages event from S3, triggers file processing and merge"""
+def process_sns_upload(event, context):
+    """Processes the single upload message in an SNS event"""
     del context
+    process_upload_message(
+        *_get_clients(), os.environ.get("BUCKET_NAME"), event["Records"][0]["Sns"]["Message"]
+    )
+    return functions.http_response(200, "Upload processing successful")
+
+
+def process_upload_handler(event, context):
+    """manages event from SNS or SQS, triggers file processing and merge
+
+    SQS events may contain a batch of messages, which are processed concurrently.
+    Messages that fail are reported back as batch item failures, so only those
+    are retried. Any other error is raised, so that SQS retries the whole batch,
+    rather than the error response being taken as the batch succeeding.
+    """
+    records = event["Records"]
+    if "Sns" in records[0]:
+        return process_sns_upload(event, context)
     s3_bucket = os.environ.get("BUCKET_NAME")
-    s3_client = boto3.client("s3")
-    sns_client = boto3.client("sns", region_name=os.environ.get("AWS_REGION"))
-    sqs_client = boto3.client("sqs", region_name=os.environ.get("AWS_REGION"))
-    s3_key = event["Records"][0]["Sns"]["Message"]
-    process_upload(s3_client, sns_client, sqs_client, s3_bucket, s3_key)
-    res = functions.http_response(200, "Upload processing successful")
-    return res
+    clients = _get_clients()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        futures = {
+            record["messageId"]: executor.submit(
+                process_upload_message, *clients, s3_bucket, record["body"]
+            )
+            for record in records
+        }
+    failures = []
+    for message_id, future in futures.items():
+        try:
+            future.result()
+        except UnexpectedFileTypeError:
+            # The file has already been moved to the error folder, so there's
+            # nothing to retry
+            logger.error("Unexpected file type in message %s", message_id)
+        except Exception:
+            logger.exception("Error processing message %s", message_id)
+            failures.append({"itemIdentifier": message_id})
+    return {"batchItemFailures": failures}
@@ -0,0 +1 @@
+../powerset_merge/powerset_merge.py
\ No newline at end of file
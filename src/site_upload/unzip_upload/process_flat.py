@@ -0,0 +1 @@
+../process_flat/process_flat.py
\ No newline at end of file
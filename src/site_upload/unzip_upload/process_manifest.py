@@ -0,0 +1 @@
+../process_manifest/process_manifest.py
\ No newline at end of file
@@ -0,0 +1 @@
+../process_upload/process_upload.py
\ No newline at end of file
@@ -0,0 +1 @@
+../study_period/study_period.py
\ No newline at end of file
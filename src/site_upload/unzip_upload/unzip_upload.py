@@ -1,11 +1,22 @@
 """Lambda for moving data to processing locations"""
 
+import concurrent.futures
+import dataclasses
+import datetime
+import io
 import logging
 import os
+import threading
 import zipfile
-from io import BytesIO
 
 import boto3
+import powerset_merge
+import process_flat
+import process_manifest
+import process_upload
+import pyarrow
+import pyarrow.parquet
+import study_period
 
 from shared import decorators, enums, functions, s3_manager
 
@@ -13,11 +24,244 @@ log_level = os.environ.get("LAMBDA_LOG_LEVEL", "INFO")
 logger = logging.getLogger()
 logger.setLevel(log_level)
 
+# The size of each ranged read of the archive. Only the zip's central directory and
+# the members being extracted are fetched, so memory use doesn't depend on its size.
+ARCHIVE_READ_SIZE = 8 * 1024 * 1024
+# Members up to this size are written with a single PUT, which returns their ETag
+SINGLE_PUT_SIZE = 8 * 1024 * 1024
+# The number of archive members to extract at once
+EXTRACT_WORKERS = 8
+
+
+class InlineDispatcher:
+    """Stands in for an SNS client, running a topic's subscribed lambda in-process
+
+    This lets upload routing (process_upload) hand files straight to the merge, flat
+    table, study period, and manifest lambdas, with the same events and code paths as
+    when they're invoked through SNS. Since the cost of a merge depends on the data
+    already aggregated, and not just on the size of the upload, count data is only
+    merged inline if the archive and the other sites' last_valid data for its data
+    package version fit under the inline size limit together. Otherwise it is
+    published to the merge lambda as usual.
+    """
+
+    def __init__(self, s3_client, sns_client, s3_bucket_name: str, archive_size: int):
+        self.s3_client = s3_client
+        self.sns_client = sns_client
+        self.s3_bucket_name = s3_bucket_name
+        self.archive_size = archive_size
+        self.handlers = {
+            os.environ.get("TOPIC_PROCESS_COUNTS_ARN"): powerset_merge.powerset_merge_handler,
+            os.environ.get("TOPIC_PROCESS_FLAT_ARN"): process_flat.process_flat_handler,
+            os.environ.get("TOPIC_PROCESS_STUDY_META_ARN"): study_period.study_period_handler,
+            os.environ.get("TOPIC_PROCESS_MANIFEST_ARN"): (
+                process_manifest.process_manifest_handler
+            ),
+        }
+
+    def use_inline_merge(self, s3_key: str) -> bool:
+        """Returns true if the merge of a latest file is small enough to run in-process"""
+        return use_inline_pipeline(
+            self.archive_size + get_merge_input_size(self.s3_client, self.s3_bucket_name, s3_key)
+        )
+
+    def publish(self, *, TopicArn: str, Message: str, Subject: str) -> None:
+        if TopicArn not in self.handlers or (
+            TopicArn == os.environ.get("TOPIC_PROCESS_COUNTS_ARN")
+            and not self.use_inline_merge(Message)
+        ):
+            self.sns_client.publish(TopicArn=TopicArn, Message=Message, Subject=Subject)
+            return
+        event = {
+            "Records": [{"Sns": {"TopicArn": TopicArn, "Message": Message, "Subject": Subject}}]
+        }
+        res = self.handlers[TopicArn](event, None)
+        if res["statusCode"] != 200:
+            logger.error("Inline processing of %s failed: %s", Message, res["body"])
+
+
+def use_inline_pipeline(archive_size: int) -> bool:
+    """Returns true if an archive is small enough to process in this invocation"""
+    return archive_size <= int(os.environ.get("INLINE_PIPELINE_MAX_SIZE", 0))
+
+
+def get_merge_input_size(s3_client, s3_bucket_name: str, s3_key: str) -> int:
+    """Returns the size of the existing data a merge of a latest file would read
+
+    This is the last_valid data of the other sites in the file's data package version.
+    The site's own last_valid data is replaced, rather than read, by the merge. Under
+    the pointer layout, the size is that of the data the pointers refer to.
+    """
+    dp_meta = functions.parse_s3_key(s3_key)
+    total = 0
+    for key, size in functions.iter_s3_objects(
+        s3_client, s3_bucket_name, _get_last_valid_prefix(dp_meta)
+    ):
+        last_valid_meta = functions.parse_s3_key(key)
+        if last_valid_meta.site == dp_meta.site or last_valid_meta.version != dp_meta.version:
+            continue
+        target = functions.resolve_s3_pointer(key, s3_client)
+        if target != key:
+            size = s3_client.head_object(Bucket=s3_bucket_name, Key=target)["ContentLength"]
+        total += size
+    return total
+
+
+def process_inline(
+    s3_client, sns_client, s3_bucket_name: str, messages: list[str], archive_size: int
+) -> list[str]:
+    """Runs the rest of the upload pipeline for the given upload messages in-process
+
+    Metadata updates are still queued to the update_metadata lambda, which
+    serializes writes to the metadata files, and the completeness check is still
+    triggered through SNS.
+
+    :param archive_size: the size of the archive the messages were extracted from
+    :returns: the messages that could not be processed, to be retried through SNS
+    """
+    dispatcher = InlineDispatcher(s3_client, sns_client, s3_bucket_name, archive_size)
+    sqs_client = boto3.client("sqs", region_name=s3_client.meta.region_name)
+    failed = []
+    for message in messages:
+        try:
+            process_upload.process_upload_message(
+                s3_client, dispatcher, sqs_client, s3_bucket_name, message
+            )
+        except process_upload.UnexpectedFileTypeError:
+            logger.error("Unexpected file type in %s", message)
+        except Exception:
+            logger.exception("Error processing %s inline, deferring to SNS", message)
+            failed.append(message)
+    return failed
+
+
+def open_archive(s3_client, s3_bucket_name: str, s3_key: str, **kwargs) -> zipfile.ZipFile:
+    """Opens a zip in S3 for reading, without downloading the whole archive
+
+    :param kwargs: passed through to functions.S3RangeReader
+    """
+    reader = functions.S3RangeReader(s3_client, s3_bucket_name, s3_key, **kwargs)
+    return zipfile.ZipFile(io.BufferedReader(reader, buffer_size=ARCHIVE_READ_SIZE))
+
+
+def validate_member(
+    s3_client,
+    s3_bucket_name: str,
+    file: str,
+    payload: bytes | io.IOBase,
+    dp_meta: functions.PackageMetadata,
+    column_types: dict,
+) -> str | None:
+    """Checks the parquet footer of an archive member, returning why it's invalid, if it is
+
+    Count data is also checked for the things powerset_merge would otherwise reject
+    much later: empty files, and columns that don't match the existing aggregate for
+    this study/data package/version in the column types registry. A site that is the
+    only contributor to an aggregate may change its schema, as the merge allows.
+
+    :param payload: the contents of the member, or a seekable file object over them,
+        from which only the footer is read
+    :param dp_meta: the site, study, data package, and version of the member
+    :param column_types: the column types metadata dictionary
+    """
+    if not file.endswith(".parquet"):
+        return None
+    if isinstance(payload, bytes):
+        payload = io.BytesIO(payload)
+    try:
+        parquet = pyarrow.parquet.ParquetFile(payload)
+        num_rows = parquet.metadata.num_rows
+        schema = parquet.schema_arrow
+    except pyarrow.lib.ArrowException as e:
+        return f"Uploaded data file is not valid parquet: {e}"
+    if not any(
+        f".{upload_type}." in file
+        for upload_type in [enums.UploadTypes.CUBE, enums.UploadTypes.ANNOTATED_CUBE]
+    ):
+        return None
+    if num_rows == 0:
+        return "Uploaded data file is empty"
+    # pandas may have written its index as a column, which isn't part of the data
+    index_columns = (schema.pandas_metadata or {}).get("index_columns", [])
+    columns = set(schema.names) - {col for col in index_columns if isinstance(col, str)}
+    if "cnt" not in columns:
+        return "Uploaded data file has no cnt column"
+    dp_id = f"{dp_meta.study}__{dp_meta.data_package}__{dp_meta.version}"
+    expected = (
+        column_types.get(dp_meta.study, {})
+        .get(dp_meta.data_package, {})
+        .get(dp_id, {})
+        .get(enums.ColumnTypesKeys.COLUMNS)
+    )
+    if (
+        expected is not None
+        and columns | {"site"} != set(expected)
+        and _has_other_contributors(s3_client, s3_bucket_name, dp_meta)
+    ):
+        return "Uploaded data has a different schema than last aggregate"
+    return None
+
+
+def _has_other_contributors(
+    s3_client, s3_bucket_name: str, dp_meta: functions.PackageMetadata
+) -> bool:
+    """Returns true if sites other than dp_meta's have data in this data package version"""
+    for key in functions.iter_s3_keys(s3_client, s3_bucket_name, _get_last_valid_prefix(dp_meta)):
+        last_valid_meta = functions.parse_s3_key(key)
+        if last_valid_meta.site != dp_meta.site and last_valid_meta.version == dp_meta.version:
+            return True
+    return False
+
+
+def _get_last_valid_prefix(dp_meta: functions.PackageMetadata) -> str:
+    """Returns the prefix of the last_valid data of all sites in dp_meta's data package"""
+    prefix = functions.construct_s3_key(
+        subbucket=enums.BucketPath.LAST_VALID, dp_meta=dp_meta
+    ).rsplit("/", 3)[0]
+    return f"{prefix}/"
+
+
+def reject_member(
+    s3_client,
+    sqs_client,
+    s3_bucket_name: str,
+    dp_meta: functions.PackageMetadata,
+    file: str,
+    payload: bytes | None = None,
+    *,
+    source_key: str | None = None,
+) -> None:
+    """Writes an invalid archive member to the error folder, and records the error
+
+    :param payload: the contents of the member
+    :param source_key: the key the member has already been written to, if it's not
+        passed in as a payload
+    """
+    error_key = functions.construct_s3_key(
+        subbucket=enums.BucketPath.ERROR, dp_meta=dp_meta, filename=file
+    )
+    if payload is None:
+        functions.copy_s3_file(s3_client, s3_bucket_name, source_key, error_key)
+    else:
+        s3_client.put_object(Bucket=s3_bucket_name, Key=error_key, Body=payload)
+    metadata = functions.update_metadata(
+        metadata={},
+        site=dp_meta.site,
+        study=dp_meta.study,
+        data_package=dp_meta.data_package,
+        version=f"{dp_meta.study}__{dp_meta.data_package}__{dp_meta.version}",
+        target=enums.TransactionKeys.LAST_ERROR,
+    )
+    functions.write_metadata(
+        sqs_client=sqs_client, s3_bucket_name=s3_bucket_name, metadata=metadata
+    )
+
 
 def unzip_upload(s3_client, sns_client, s3_bucket_name: str, s3_key: str) -> None:
     metadata = functions.parse_s3_key(s3_key)
-    buffer = BytesIO(s3_client.get_object(Bucket=s3_bucket_name, Key=s3_key)["Body"].read())
-    archive = zipfile.ZipFile(buffer)
+    head = s3_client.head_object(Bucket=s3_bucket_name, Key=s3_key)
+    archive_size, archive_etag = head["ContentLength"], head["ETag"]
+    archive = open_archive(s3_client, s3_bucket_name, s3_key, size=archive_size, etag=archive_etag)
     files = archive.namelist()
 
     # We'll update the transaction data with the files we're going to process
@@ -26,30 +270,141 @@ def unzip_upload(s3_client, sns_client, s3_bucket_name: str, s3_key: str) -> Non
     # Since metadata is just copied and not otherwise massaged, we skip it
     manager = s3_manager.S3Manager(site=metadata.site, study=metadata.study)
     transaction = manager.get_transaction()
-    for upload_type in [
+    upload_types = [
         enums.UploadTypes.CUBE,
         enums.UploadTypes.FLAT,
         enums.UploadTypes.ANNOTATED_CUBE,
         enums.UploadTypes.META,
-    ]:
+    ]
+    for upload_type in upload_types:
         transaction[f"{upload_type}"] = [file for file in files if f".{upload_type}." in file]
         transaction["version"] = metadata.version
     manager.put_file(path=manager.transaction, payload=transaction)
 
-    new_keys = []
-    for file_list in [files]:
-        for file in file_list:
-            data_package = file.split(".")[0]
-            if "__" in data_package:
-                data_package = data_package.split("__")[1]
-            key = functions.construct_s3_key(
-                subbucket=enums.BucketPath.UPLOAD,
-                dp_meta=metadata,
-                data_package=data_package,
-                filename=file,
+    use_pointers = functions.use_pointer_layout()
+    sqs_client = boto3.client("sqs", region_name=s3_client.meta.region_name)
+    # zipfile serializes reads of a shared file handle, which would also throw away
+    # the read buffer on every switch between members, so each worker thread gets
+    # its own handle on the archive
+    handles = threading.local()
+    archives = [archive]
+
+    column_types = functions.read_metadata(
+        s3_client, s3_bucket_name, meta_type=enums.JsonFilename.COLUMN_TYPES
+    )
+
+    def validate_written_member(
+        file: str, member_meta: functions.PackageMetadata, written_key: str, size: int
+    ) -> bool:
+        """Checks a member from the footer of its written copy, rejecting it if invalid
+
+        :returns: True if the member is valid
+        """
+        with functions.S3RangeReader(s3_client, s3_bucket_name, written_key, size=size) as reader:
+            error = validate_member(
+                s3_client,
+                s3_bucket_name,
+                file,
+                io.BufferedReader(reader),
+                member_meta,
+                column_types,
+            )
+        if error:
+            logger.error("Error processing file %s: %s", file, error)
+            reject_member(
+                s3_client, sqs_client, s3_bucket_name, member_meta, file, source_key=written_key
             )
-            s3_client.upload_fileobj(archive.open(file), Bucket=s3_bucket_name, Key=key)
-            new_keys.append(key)
+        return error is None
+
+    def extract_member(file: str) -> str | None:
+        """Uploads a member to site_upload, returning its upload message
+
+        Invalid members are written to error instead, and return None.
+        """
+        if not hasattr(handles, "archive"):
+            handles.archive = open_archive(
+                s3_client, s3_bucket_name, s3_key, size=archive_size, etag=archive_etag
+            )
+            archives.append(handles.archive)
+        data_package = file.split(".")[0]
+        if "__" in data_package:
+            data_package = data_package.split("__")[1]
+        member_meta = dataclasses.replace(metadata, data_package=data_package)
+        key = functions.construct_s3_key(
+            subbucket=enums.BucketPath.UPLOAD,
+            dp_meta=member_meta,
+            filename=file,
+        )
+        size = handles.archive.getinfo(file).file_size
+        # Small members are read whole and checked before they're written. Larger ones
+        # are streamed, and checked afterwards from the footer of the written copy, as
+        # the footer is at the end of the member and reading it would mean inflating
+        # everything before it a second time.
+        payload = handles.archive.read(file) if size <= SINGLE_PUT_SIZE else None
+        if payload is not None and (
+            error := validate_member(
+                s3_client, s3_bucket_name, file, payload, member_meta, column_types
+            )
+        ):
+            logger.error("Error processing file %s: %s", file, error)
+            reject_member(s3_client, sqs_client, s3_bucket_name, member_meta, file, payload)
+            return None
+        if use_pointers and any(
+            f".{upload_type}." in file
+            for upload_type in [enums.UploadTypes.CUBE, enums.UploadTypes.ANNOTATED_CUBE]
+        ):
+            # Count data is written once; only the pointer moves through the
+            # site_upload/latest/last_valid/archive states after this
+            if payload is not None:
+                blob_key = functions.put_s3_blob(
+                    s3_client, s3_bucket_name, metadata.study, file, payload
+                )
+            else:
+                with handles.archive.open(file) as member:
+                    blob_key = functions.put_s3_blob(
+                        s3_client, s3_bucket_name, metadata.study, file, member
+                    )
+                # Blobs may be shared with other uploads of the same data, so a rejected
+                # one is left in place, and no pointer is written to it
+                if not validate_written_member(file, member_meta, blob_key, size):
+                    return None
+            size, etag = functions.put_s3_pointer(s3_client, s3_bucket_name, key, blob_key)
+        elif payload is not None:
+            etag = s3_client.put_object(Bucket=s3_bucket_name, Key=key, Body=payload)["ETag"]
+        else:
+            etag = None
+            s3_client.upload_fileobj(handles.archive.open(file), Bucket=s3_bucket_name, Key=key)
+            if not validate_written_member(file, member_meta, key, size):
+                functions.delete_s3_file(s3_client, s3_bucket_name, key)
+                return None
+        return functions.get_upload_message(
+            key, uploaded_at=datetime.datetime.now(datetime.UTC), size=size, etag=etag
+        )
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as executor:
+            messages = list(executor.map(extract_member, files))
+    finally:
+        for opened in archives:
+            opened.close()
+    rejected = [file for file, message in zip(files, messages, strict=True) if message is None]
+    if rejected:
+        # Rejected files will never be aggregated, so they shouldn't hold up the
+        # completeness check
+        for upload_type in upload_types:
+            transaction[f"{upload_type}"] = [
+                file for file in transaction[f"{upload_type}"] if file not in rejected
+            ]
+        manager.put_file(path=manager.transaction, payload=transaction)
+    messages = [message for message in messages if message]
+    if use_inline_pipeline(archive_size):
+        messages = process_inline(s3_client, sns_client, s3_bucket_name, messages, archive_size)
+    if messages:
+        topic_sns_arn = os.environ.get("TOPIC_PROCESS_UPLOADS_ARN")
+        sns_subject = "Process file unzip event"
+        functions.publish_sns_batch(sns_client, topic_sns_arn, messages, sns_subject)
+    # The archive is only moved once everything in it has been handed off, so that
+    # if this invocation fails before then, a retry starts from the archive again
     archive_key = functions.construct_s3_key(
         subbucket=enums.BucketPath.ARCHIVE,
         dp_meta=metadata,
@@ -59,11 +414,9 @@ def unzip_upload(s3_client, sns_client, s3_bucket_name: str, s3_key: str) -> Non
         s3_bucket_name=s3_bucket_name,
         old_key=s3_key,
         new_key=archive_key,
+        size=archive_size,
+        etag=archive_etag,
     )
-    topic_sns_arn = os.environ.get("TOPIC_PROCESS_UPLOADS_ARN")
-    sns_subject = "Process file unzip event"
-    for key in new_keys:
-        sns_client.publish(TopicArn=topic_sns_arn, Message=key, Subject=sns_subject)
 
 
 @decorators.generic_error_handler(msg="Error processing file upload")
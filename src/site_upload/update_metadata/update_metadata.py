@@ -13,7 +13,7 @@ import os
 import boto3
 import botocore
 
-from shared import decorators, functions
+from shared import decorators, enums, functions
 
 s3_client = boto3.client("s3")
 
@@ -48,6 +48,15 @@ def process_event_queue(records):
             metadata[key] = update_source(metadata[key], update)
     for key, metadata in metadata.items():
         functions.put_s3_file(s3_client, os.environ.get("BUCKET_NAME"), key, metadata)
+        meta_type = key.removeprefix(f"{enums.BucketPath.META}/").removesuffix(".json")
+        if meta_type in functions.SITE_KEYED_METADATA:
+            functions.write_metadata_subdocuments(
+                s3_client,
+                os.environ.get("BUCKET_NAME"),
+                metadata,
+                meta_type=meta_type,
+                sites={site for update in sources[key] for site in update},
+            )
 
 
 @decorators.generic_error_handler(msg="Error processing metadata events")
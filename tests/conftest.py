@@ -23,6 +23,7 @@ set of states:
 """
 
 import datetime
+import json
 import os
 import re
 from unittest import mock
@@ -34,7 +35,9 @@ import pytest
 import time_machine
 
 from scripts import credential_management
-from src.shared import enums, functions
+from shared import document_cache as shared_document_cache
+from shared import functions as shared_functions
+from src.shared import document_cache, enums, functions
 from tests import mock_utils
 
 time_machine.naive_mode = time_machine.NaiveMode.UTC
@@ -79,6 +82,18 @@ def _init_mock_data(s3_client, bucket, study, data_package, version, site):
         bucket,
         f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}.json",
     )
+    with open("./tests/test_data/data_packages_cache.json") as f:
+        data_packages = json.load(f)
+    names = {}
+    for dp in data_packages:
+        functions.put_s3_file(s3_client, bucket, functions.get_data_package_cache_key(dp["id"]), dp)
+        names.setdefault(dp["name"], []).append(dp["id"])
+    functions.put_s3_file(
+        s3_client,
+        bucket,
+        f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGE_NAMES.value}.json",
+        names,
+    )
     s3_client.upload_file(
         "./tests/test_data/studies_cache.json",
         bucket,
@@ -103,6 +118,25 @@ def mock_env():
         yield
 
 
+@pytest.fixture(autouse=True)
+def clear_glue_table_cache():
+    """Resets the Glue table listings warm lambdas keep between invocations
+
+    Lambdas import shared as a root level package, which has its own copy of
+    the module state."""
+    yield
+    functions._glue_table_names.clear()
+    shared_functions._glue_table_names.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_document_cache():
+    """Resets the S3 documents warm API lambdas keep between invocations"""
+    yield
+    document_cache.clear()
+    shared_document_cache.clear()
+
+
 @pytest.fixture
 def mock_bucket():
     """Mock for testing S3 usage. Should reset before each individual test."""
@@ -186,6 +220,8 @@ def mock_queue():
     sqs_client = boto3.client("sqs", region_name="us-east-1")
     sqs_client.create_queue(QueueName="test-transaction-cleanup")
     sqs_client.create_queue(QueueName="test-metadata-update")
+    sqs_client.create_queue(QueueName="test-crawl-requests")
+    sqs_client.create_queue(QueueName="test-crawl-requests-dead-letter")
     yield
     sqs.stop()
 
@@ -195,6 +231,7 @@ def mock_glue():
     glue = moto.mock_aws()
     glue.start()
     glue_client = boto3.client("glue", region_name="us-east-1")
+    glue_client.create_database(DatabaseInput={"Name": mock_utils.TEST_GLUE_DB})
     glue_client.create_crawler(
         Name=mock_utils.TEST_GLUE_CRAWLER,
         Role="mock_role",
@@ -1,15 +1,18 @@
 import json
 from unittest import mock
 
+import boto3
 import botocore
 import pandas
 import pytest
 
 from src.dashboard.get_chart_data import get_chart_data
+from src.shared import functions
 from tests.mock_utils import (
     EXISTING_DATA_P,
     EXISTING_STUDY,
     EXISTING_VERSION,
+    TEST_BUCKET,
     TEST_GLUE_DB,
 )
 
@@ -291,6 +294,11 @@ def test_handler(mock_athena, mock_get_cols, mock_db, mock_bucket, event, expect
     mock_get_cols.return_value = list(pandas.read_parquet(file).columns)
     res = get_chart_data.chart_data_handler(event, {})
     assert json.loads(res["body"]) == expected
+    # repeat requests for an unchanged result get an empty 304
+    etag = res["headers"]["ETag"]
+    res = get_chart_data.chart_data_handler({**event, "headers": {"If-None-Match": etag}}, {})
+    assert res["statusCode"] == 304
+    assert res["body"] == ""
 
 
 def mock_get_table_cols_results(name):
@@ -419,3 +427,65 @@ def test_cast_filter(mock_db, mock_bucket):
     )
     assert """cast("nato" AS VARCHAR) != 'cumulus__none'""" in query
     assert """cast("nato" AS VARCHAR) = 'cumulus__none'""" in query
+
+
+@mock.patch("awswrangler.athena")
+def test_handler_result_cache(mock_athena, mock_db, mock_bucket):
+    table_id = f"{EXISTING_STUDY}__{EXISTING_DATA_P}__{EXISTING_VERSION}"
+    file = "./tests/test_data/count_synthea_patient_agg.parquet"
+    mock_db.execute(f'CREATE TABLE "{table_id}" AS SELECT * FROM read_parquet("{file}")')
+    queries = []
+
+    def mock_read(query, database, s3_output, workgroup, ctas_approach):
+        queries.append(query)
+        return mock_db.execute(query.replace(TEST_GLUE_DB, "main")).df()
+
+    mock_athena.read_sql_query = mock_read
+
+    def get_chart(filters):
+        event = {
+            "queryStringParameters": {"column": "gender", "stratifier": "race_display"},
+            "multiValueQueryStringParameters": {"filter": filters},
+            "pathParameters": {"data_package_id": table_id},
+        }
+        res = get_chart_data.chart_data_handler(event, {})
+        assert res["statusCode"] == 200
+        return json.loads(res["body"])
+
+    filters = ["age:gt:10,site:isNotNone", "gender:strEq:female"]
+    expected = get_chart(filters)
+    assert len(queries) == 2
+    # filter order and duplicates don't change the results, so these are all answered
+    # from the cache, but still report the filters that were asked for
+    for reordered in [
+        list(reversed(filters)),
+        ["site:isNotNone,age:gt:10,age:gt:10", "gender:strEq:female", "gender:strEq:female"],
+    ]:
+        assert get_chart(reordered) == {**expected, "filters": reordered}
+    assert len(queries) == 2
+    # results are read from S3 each time, rather than held in the document cache
+    assert not any(
+        key.startswith(get_chart_data.CHART_CACHE_PREFIX)
+        for _, key in get_chart_data.document_cache._documents
+    )
+    s3_client = boto3.client("s3")
+    assert (
+        len(
+            s3_client.list_objects_v2(Bucket=TEST_BUCKET, Prefix=f"cache/chart_data/{table_id}/")[
+                "Contents"
+            ]
+        )
+        == 1
+    )
+
+    # publishing a new generation of the aggregate invalidates the results
+    key = get_chart_data._get_table_details(table_id)["s3_path"]
+    functions.put_s3_file(
+        s3_client,
+        TEST_BUCKET,
+        f"{functions.get_generation_prefix(key)}/{functions.GENERATION_RECORD_FILENAME}",
+        {"generation": "new", "key": key},
+    )
+    get_chart_data.document_cache.clear()
+    assert get_chart(filters) == expected
+    assert len(queries) == 4
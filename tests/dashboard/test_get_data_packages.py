@@ -3,7 +3,12 @@ import os
 import pathlib
 from unittest import mock
 
+import boto3
+import pytest
+
+from shared import document_cache
 from src.dashboard.get_data_packages import get_data_packages
+from src.shared import enums, functions
 from tests.mock_utils import DATA_PACKAGE_COUNT, MOCK_ENV
 
 
@@ -36,3 +41,77 @@ def test_get_data_packages(mock_bucket):
     )
     data = json.loads(res["body"])
     assert res["statusCode"] == 404
+
+
+@mock.patch.dict(os.environ, MOCK_ENV)
+def test_get_data_packages_without_list(mock_bucket):
+    # Lookups of single packages, or packages by name, don't need the full list
+    s3_client = boto3.client("s3")
+    s3_client.delete_object(
+        Bucket=os.environ["BUCKET_NAME"],
+        Key=f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}.json",
+    )
+    res = get_data_packages.data_packages_handler(
+        {"pathParameters": {"data_package_id": "other_study__document__100"}}, {}
+    )
+    assert res["statusCode"] == 200
+    assert json.loads(res["body"])["id"] == "other_study__document__100"
+    res = get_data_packages.data_packages_handler(
+        {"queryStringParameters": {"name": "encounter"}}, {}
+    )
+    assert res["statusCode"] == 200
+    assert [dp["id"] for dp in json.loads(res["body"])] == [
+        "study__encounter__100",
+        "study__encounter__099",
+    ]
+    assert document_cache.stats[enums.DocumentCacheResult.MISS] == 4
+
+
+@mock.patch.dict(os.environ, MOCK_ENV)
+def test_get_data_packages_warm(mock_bucket):
+    get_data_packages.data_packages_handler({}, {})
+    s3_client = boto3.client("s3")
+    s3_client.delete_object(
+        Bucket=os.environ["BUCKET_NAME"],
+        Key=functions.get_data_package_cache_key("other_study__document__100"),
+    )
+    # Packages missing their own cache entry are found in the list, which is already loaded
+    res = get_data_packages.data_packages_handler(
+        {"pathParameters": {"data_package_id": "other_study__document__100"}}, {}
+    )
+    assert res["statusCode"] == 200
+    assert document_cache.stats[enums.DocumentCacheResult.HIT] == 1
+
+
+@mock.patch.dict(os.environ, MOCK_ENV)
+@pytest.mark.parametrize(
+    "event",
+    [
+        {},
+        {"queryStringParameters": {"name": "encounter"}},
+        {"pathParameters": {"data_package_id": "other_study__document__100"}},
+    ],
+)
+def test_get_data_packages_etag(mock_bucket, event):
+    res = get_data_packages.data_packages_handler(event, {})
+    etag = res["headers"]["ETag"]
+    res = get_data_packages.data_packages_handler({**event, "headers": {"If-None-Match": etag}}, {})
+    assert res["statusCode"] == 304
+    # Changing the cache changes the tag
+    document_cache.clear()
+    s3_client = boto3.client("s3")
+    for key in [
+        f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}.json",
+        functions.get_data_package_cache_key("study__encounter__099"),
+        functions.get_data_package_cache_key("other_study__document__100"),
+    ]:
+        s3_client.put_object(
+            Bucket=os.environ["BUCKET_NAME"],
+            Key=key,
+            Body=s3_client.get_object(Bucket=os.environ["BUCKET_NAME"], Key=key)["Body"]
+            .read()
+            .replace(b'"total"', b'"total" '),
+        )
+    res = get_data_packages.data_packages_handler({**event, "headers": {"If-None-Match": etag}}, {})
+    assert res["statusCode"] == 200
+    assert res["headers"]["ETag"] != etag
@@ -1,8 +1,10 @@
 import json
 
+import boto3
 import pytest
 
 from src.dashboard.get_metadata import get_metadata
+from src.shared import enums, functions
 from tests import mock_utils
 
 
@@ -47,7 +49,21 @@ from tests import mock_utils
         ({"site": mock_utils.EXISTING_SITE, "study": mock_utils.NEW_STUDY}, 500, None),
     ],
 )
-def test_get_metadata(mock_bucket, params, status, expected):
+@pytest.mark.parametrize("subdocuments", [False, True])
+def test_get_metadata(mock_bucket, params, status, expected, subdocuments):
+    if subdocuments and params:
+        # site scoped requests only need the site's part of the metadata
+        s3_client = boto3.client("s3")
+        functions.write_metadata_subdocuments(
+            s3_client,
+            mock_utils.TEST_BUCKET,
+            mock_utils.get_mock_metadata(),
+            meta_type=enums.JsonFilename.TRANSACTIONS.value,
+        )
+        s3_client.delete_object(
+            Bucket=mock_utils.TEST_BUCKET,
+            Key=f"{enums.BucketPath.META.value}/{enums.JsonFilename.TRANSACTIONS.value}.json",
+        )
     event = {"pathParameters": params}
 
     res = get_metadata.metadata_handler(event, {})
@@ -1,13 +1,16 @@
 import json
 
+import boto3
 import pytest
 
 from src.dashboard.get_study_periods import get_study_periods
+from src.shared import enums, functions
 from tests.mock_utils import (
     EXISTING_SITE,
     EXISTING_STUDY,
     NEW_SITE,
     NEW_STUDY,
+    TEST_BUCKET,
     get_mock_study_metadata,
 )
 
@@ -30,7 +33,21 @@ from tests.mock_utils import (
         ({"site": EXISTING_SITE, "study": NEW_STUDY}, 500, None),
     ],
 )
-def test_get_study_periods(mock_bucket, params, status, expected):
+@pytest.mark.parametrize("subdocuments", [False, True])
+def test_get_study_periods(mock_bucket, params, status, expected, subdocuments):
+    if subdocuments and params:
+        # site scoped requests only need the site's part of the study periods
+        s3_client = boto3.client("s3")
+        functions.write_metadata_subdocuments(
+            s3_client,
+            TEST_BUCKET,
+            get_mock_study_metadata(),
+            meta_type=enums.JsonFilename.STUDY_PERIODS.value,
+        )
+        s3_client.delete_object(
+            Bucket=TEST_BUCKET,
+            Key=f"{enums.BucketPath.META.value}/{enums.JsonFilename.STUDY_PERIODS.value}.json",
+        )
     event = {"pathParameters": params}
     res = get_study_periods.study_periods_handler(event, {})
     assert res["statusCode"] == status
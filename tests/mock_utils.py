@@ -23,7 +23,11 @@ TEST_TRANSACTION_CLEANUP_URL = (
 TEST_TRANSACTION_CLEANUP_ARN = "arn:aws:sqs:us-east-1:123456789012:transaction-cleanup"
 TEST_METADATA_UPDATE_URL = "https://sqs.us-east-1.amazonaws.com/123456789012/test-metadata-update"
 TEST_METADATA_UPDATE_ARN = "arn:aws:sqs:us-east-1:123456789012:test-metadata-update"
-ITEM_COUNT = 14
+TEST_CRAWL_REQUESTS_URL = "https://sqs.us-east-1.amazonaws.com/123456789012/test-crawl-requests"
+TEST_CRAWL_REQUESTS_DEAD_LETTER_URL = (
+    "https://sqs.us-east-1.amazonaws.com/123456789012/test-crawl-requests-dead-letter"
+)
+ITEM_COUNT = 18
 DATA_PACKAGE_COUNT = 3
 
 EXISTING_SITE = "princeton_plainsboro_teaching_hospital"
@@ -60,6 +64,8 @@ MOCK_ENV = {
     "TOPIC_PROCESS_UPLOADS_ARN": TEST_PROCESS_UPLOADS_ARN,
     "QUEUE_TRANSACTION_CLEANUP": TEST_TRANSACTION_CLEANUP_URL,
     "QUEUE_METADATA_UPDATE": TEST_METADATA_UPDATE_URL,
+    "QUEUE_CRAWL_REQUESTS": TEST_CRAWL_REQUESTS_URL,
+    "QUEUE_CRAWL_REQUESTS_DEAD_LETTER": TEST_CRAWL_REQUESTS_DEAD_LETTER_URL,
 }
 
 
@@ -306,6 +312,12 @@ def get_mock_data_packages_cache():
     return ["study__encounter", "other_study__encounter"]
 
 
+def create_glue_tables(glue_client, names: list[str]):
+    """Registers bare tables in the mock Glue database"""
+    for name in names:
+        glue_client.create_table(DatabaseName=TEST_GLUE_DB, TableInput={"Name": name})
+
+
 def get_mock_env():
     return MOCK_ENV
 
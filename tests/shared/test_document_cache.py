@@ -0,0 +1,102 @@
+import json
+from unittest import mock
+
+import boto3
+import botocore
+import pytest
+
+from src.shared import decorators, document_cache, enums, functions
+from tests import mock_utils
+
+KEY = "static/doc.json"
+
+
+def test_get_s3_json(mock_bucket, capsys):
+    s3_client = boto3.client("s3")
+    functions.put_s3_file(s3_client, mock_utils.TEST_BUCKET, KEY, {"a": 1})
+    assert document_cache.get_s3_json(mock_utils.TEST_BUCKET, KEY, s3_client) == {"a": 1}
+    assert document_cache.get_s3_json(mock_utils.TEST_BUCKET, KEY, s3_client) == {"a": 1}
+    assert document_cache.stats == {
+        enums.DocumentCacheResult.MISS: 1,
+        enums.DocumentCacheResult.HIT: 1,
+    }
+    # Lookups are only reported when metrics are emitted, as a single record
+    assert capsys.readouterr().out == ""
+    document_cache.emit_metrics()
+    metrics = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(metrics) == 1
+    assert metrics[0]["_aws"]["CloudWatchMetrics"][0]["Metrics"] == [
+        {"Name": "Hit", "Unit": "Count"},
+        {"Name": "Revalidated", "Unit": "Count"},
+        {"Name": "Miss", "Unit": "Count"},
+    ]
+    assert (metrics[0]["Hit"], metrics[0]["Revalidated"], metrics[0]["Miss"]) == (1, 0, 1)
+    # and nothing is emitted until there are new lookups
+    document_cache.emit_metrics()
+    assert capsys.readouterr().out == ""
+
+    # Past the max staleness, unchanged documents are revalidated rather than refetched
+    with mock.patch.dict("os.environ", {"DOCUMENT_CACHE_MAX_STALENESS": "0"}):
+        assert document_cache.get_s3_json(mock_utils.TEST_BUCKET, KEY, s3_client) == {"a": 1}
+        assert document_cache.stats[enums.DocumentCacheResult.REVALIDATED] == 1
+        functions.put_s3_file(s3_client, mock_utils.TEST_BUCKET, KEY, {"a": 2})
+        assert document_cache.get_s3_json(mock_utils.TEST_BUCKET, KEY, s3_client) == {"a": 2}
+        assert document_cache.stats[enums.DocumentCacheResult.MISS] == 2
+
+        s3_client.delete_object(Bucket=mock_utils.TEST_BUCKET, Key=KEY)
+        assert (
+            document_cache.get_s3_json(mock_utils.TEST_BUCKET, KEY, s3_client, default=None) is None
+        )
+        with pytest.raises(botocore.exceptions.ClientError):
+            document_cache.get_s3_json(mock_utils.TEST_BUCKET, KEY, s3_client)
+
+
+def test_get_s3_json_eviction(mock_bucket):
+    s3_client = boto3.client("s3")
+    for i in range(3):
+        functions.put_s3_file(s3_client, mock_utils.TEST_BUCKET, f"static/{i}.json", {"i": i})
+    with mock.patch.object(document_cache, "MAX_DOCUMENTS", 2):
+        for key in ["static/0.json", "static/1.json", "static/0.json", "static/2.json"]:
+            document_cache.get_s3_json(mock_utils.TEST_BUCKET, key, s3_client)
+    # the least recently used document was dropped
+    assert list(document_cache._documents) == [
+        (mock_utils.TEST_BUCKET, "static/0.json"),
+        (mock_utils.TEST_BUCKET, "static/2.json"),
+    ]
+
+
+def test_get_s3_json_size_eviction(mock_bucket):
+    s3_client = boto3.client("s3")
+    for i in range(3):
+        functions.put_s3_file(s3_client, mock_utils.TEST_BUCKET, f"static/{i}.json", {"i": i})
+    functions.put_s3_file(s3_client, mock_utils.TEST_BUCKET, "static/big.json", {"i": "x" * 100})
+    # room for two of the small documents, which are each 12 bytes of JSON
+    with mock.patch.object(document_cache, "get_max_size", return_value=30):
+        for key in ["static/0.json", "static/1.json", "static/2.json"]:
+            document_cache.get_s3_json(mock_utils.TEST_BUCKET, key, s3_client)
+        assert list(document_cache._documents) == [
+            (mock_utils.TEST_BUCKET, "static/1.json"),
+            (mock_utils.TEST_BUCKET, "static/2.json"),
+        ]
+        assert document_cache._size == 24
+        # documents too large for the cache are returned, but not kept
+        assert document_cache.get_s3_json(mock_utils.TEST_BUCKET, "static/big.json", s3_client)
+        assert len(document_cache._documents) == 2
+        assert document_cache._size == 24
+
+
+def test_emit_document_cache_metrics(mock_bucket, capsys):
+    s3_client = boto3.client("s3")
+    functions.put_s3_file(s3_client, mock_utils.TEST_BUCKET, KEY, {"a": 1})
+
+    @decorators.emit_document_cache_metrics
+    def handler():
+        document_cache.get_s3_json(mock_utils.TEST_BUCKET, KEY, s3_client)
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        handler()
+    # metrics are still reported when the handler fails
+    metrics = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(metrics) == 1
+    assert metrics[0]["Miss"] == 1
@@ -7,10 +7,14 @@ instead focusing only on edge case scenarios (though in those cases, tests
 should be comprehensive). 1-1 coverage is a desirable long term goal.
 """
 
+import dataclasses
+import io
+import zipfile
 from contextlib import nullcontext as does_not_raise
 from unittest import mock
 
 import boto3
+import botocore
 import pandas
 import pytest
 import time_machine
@@ -35,6 +39,155 @@ def test_move_s3_file(copy_res, del_res, raises):
         functions.move_s3_file(
             s3_client=s3_client, s3_bucket_name="bucket", old_key="old", new_key="new"
         )
+    # small moves with an unknown size don't need a lookup before copying
+    s3_client.head_object.assert_not_called()
+    assert "CopySourceIfMatch" not in s3_client.copy_object.call_args.kwargs
+    s3_client.create_multipart_upload.assert_not_called()
+
+
+def test_copy_s3_file_too_large_for_single_copy():
+    s3_client = mock.MagicMock()
+    s3_client.copy_object.side_effect = botocore.exceptions.ClientError(
+        {
+            "Error": {
+                "Code": "InvalidRequest",
+                "Message": "The specified copy source is larger than the maximum allowable "
+                "size for a copy source: 5368709120",
+            }
+        },
+        "CopyObject",
+    )
+    s3_client.head_object.return_value = {"ContentLength": 10, "ETag": '"abc"'}
+    with mock.patch.object(functions, "multipart_copy_s3_file") as mock_multipart:
+        functions.copy_s3_file(s3_client, "bucket", "old", "new")
+    mock_multipart.assert_called_once_with(s3_client, "bucket", "old", "new", size=10, etag='"abc"')
+
+    # other errors aren't retried
+    s3_client.copy_object.side_effect = botocore.exceptions.ClientError(
+        {"Error": {"Code": "AccessDenied", "Message": "denied"}}, "CopyObject"
+    )
+    with mock.patch.object(functions, "multipart_copy_s3_file") as mock_multipart:
+        with pytest.raises(botocore.exceptions.ClientError):
+            functions.copy_s3_file(s3_client, "bucket", "old", "new")
+    mock_multipart.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "size,multipart",
+    [
+        (1024, False),
+        (11 * 1024 * 1024, True),
+    ],
+)
+def test_move_s3_file_size_aware(mock_bucket, size, multipart):
+    s3_client = boto3.client("s3")
+    body = bytes(range(256)) * (size // 256)
+    s3_client.put_object(Bucket=mock_utils.TEST_BUCKET, Key="temp/old.parquet", Body=body)
+    with (
+        mock.patch.object(functions, "MULTIPART_COPY_THRESHOLD", 10 * 1024 * 1024),
+        mock.patch.object(functions, "MULTIPART_COPY_PART_SIZE", 5 * 1024 * 1024),
+        mock.patch.object(
+            functions, "multipart_copy_s3_file", wraps=functions.multipart_copy_s3_file
+        ) as mock_multipart,
+    ):
+        functions.move_s3_file(
+            s3_client=s3_client,
+            s3_bucket_name=mock_utils.TEST_BUCKET,
+            old_key="temp/old.parquet",
+            new_key="temp/new.parquet",
+            size=size,
+        )
+    assert mock_multipart.called == multipart
+    res = s3_client.get_object(Bucket=mock_utils.TEST_BUCKET, Key="temp/new.parquet")
+    assert res["Body"].read() == body
+    assert functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, "temp") == ["temp/new.parquet"]
+
+
+def test_multipart_copy_verification_failure():
+    s3_client = mock.MagicMock()
+    s3_client.create_multipart_upload.return_value = {"UploadId": "upload"}
+    s3_client.upload_part_copy.return_value = {"CopyPartResult": {"ETag": '"part"'}}
+    s3_client.complete_multipart_upload.return_value = {"ETag": '"new-2"'}
+    s3_client.head_object.return_value = {"ContentLength": 9, "ETag": '"new-2"'}
+    with pytest.raises(errors.S3UploadError):
+        functions.multipart_copy_s3_file(
+            s3_client, "bucket", "old", "new", size=10, etag='"old"', part_size=5
+        )
+    assert s3_client.upload_part_copy.call_count == 2
+    assert {
+        call.kwargs["CopySourceRange"] for call in s3_client.upload_part_copy.call_args_list
+    } == {"bytes=0-4", "bytes=5-9"}
+    s3_client.complete_multipart_upload.side_effect = Exception("failed")
+    with pytest.raises(Exception):
+        functions.multipart_copy_s3_file(
+            s3_client, "bucket", "old", "new", size=10, etag='"old"', part_size=5
+        )
+    s3_client.abort_multipart_upload.assert_called_once()
+
+
+def test_delete_s3_files_batches():
+    s3_client = mock.MagicMock()
+    s3_client.delete_objects.side_effect = [
+        {"Errors": [{"Key": "key_5", "Code": "AccessDenied", "Message": "Access Denied"}]},
+        {},
+        {},
+    ]
+    keys = [f"key_{i}" for i in range(2500)]
+    failures = functions.delete_s3_files(s3_client, "bucket", keys)
+    assert failures == {"key_5": "AccessDenied: Access Denied"}
+    assert [
+        len(call.kwargs["Delete"]["Objects"]) for call in s3_client.delete_objects.call_args_list
+    ] == [1000, 1000, 500]
+
+
+def test_move_s3_files_partial_failure():
+    s3_client = mock.MagicMock()
+    s3_client.head_object.return_value = {"ContentLength": 10, "ETag": '"abc"'}
+    s3_client.copy_object.side_effect = lambda **kwargs: {
+        "ResponseMetadata": {"HTTPStatusCode": 400 if kwargs["Key"] == "new_1" else 200}
+    }
+    s3_client.delete_objects.return_value = {}
+    failures = functions.move_s3_files(
+        s3_client, "bucket", [(f"old_{i}", f"new_{i}") for i in range(3)]
+    )
+    assert failures == {"old_1": "copy returned HTTP 400"}
+    assert s3_client.delete_objects.call_args.kwargs["Delete"]["Objects"] == [
+        {"Key": "old_0"},
+        {"Key": "old_2"},
+    ]
+
+
+@pytest.mark.parametrize(
+    "if_none_match,status",
+    [
+        (None, 200),
+        ('"other"', 200),
+        ('"tag"', 304),
+        ('W/"tag"', 304),
+        ('"other", "tag"', 304),
+        ("*", 304),
+    ],
+)
+def test_http_response_etag(if_none_match, status):
+    res = functions.http_response(
+        200, {"a": 1}, allow_cors=True, etag='"tag"', if_none_match=if_none_match
+    )
+    assert res["statusCode"] == status
+    assert res["headers"]["ETag"] == '"tag"'
+    assert res["headers"]["Cache-Control"] == "no-cache"
+    assert res["body"] == ("" if status == 304 else '{"a": 1}')
+    # errors aren't tagged
+    res = functions.http_response(404, "Not found", etag='"tag"', if_none_match=if_none_match)
+    assert res["statusCode"] == 404
+    assert "ETag" not in res["headers"]
+
+
+def test_get_request_header():
+    event = {"headers": {"if-none-match": '"tag"'}}
+    assert functions.get_request_header(event, "If-None-Match") == '"tag"'
+    assert functions.get_request_header({"headers": None}, "If-None-Match") is None
+    assert functions.make_etag("a", "b") == functions.make_etag("a", "b")
+    assert functions.make_etag("a", "b") != functions.make_etag("ab")
 
 
 @pytest.mark.parametrize(
@@ -82,6 +235,30 @@ def test_update_metadata_error(mock_bucket):
         )
 
 
+def test_write_metadata_subdocuments(mock_bucket):
+    s3_client = boto3.client("s3")
+    meta_type = enums.JsonFilename.STUDY_PERIODS.value
+    metadata = {"site_a": {"study_a": {"a": 1}, "study_b": {"b": 1}}, "site_b": {"study_a": {}}}
+    functions.write_metadata_subdocuments(
+        s3_client, mock_utils.TEST_BUCKET, metadata, meta_type=meta_type
+    )
+    # removing a study from a site removes its part, without touching other sites
+    metadata["site_a"].pop("study_b")
+    functions.write_metadata_subdocuments(
+        s3_client, mock_utils.TEST_BUCKET, metadata, meta_type=meta_type, sites=["site_a"]
+    )
+    folder = functions.get_metadata_subdocument_key(meta_type, "site_a").rsplit("/", 1)[0]
+    assert sorted(functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, folder)) == [
+        functions.get_metadata_subdocument_key(meta_type, "site_a"),
+        functions.get_metadata_subdocument_key(meta_type, "site_a", "study_a"),
+        functions.get_metadata_subdocument_key(meta_type, "site_b"),
+        functions.get_metadata_subdocument_key(meta_type, "site_b", "study_a"),
+    ]
+    assert functions.get_s3_json_as_dict(
+        mock_utils.TEST_BUCKET, functions.get_metadata_subdocument_key(meta_type, "site_a")
+    ) == {"study_a": {"a": 1}}
+
+
 def test_get_s3_keys(mock_bucket):
     s3_client = boto3.client("s3")
     res = functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, "")
@@ -89,11 +266,188 @@ def test_get_s3_keys(mock_bucket):
     res = functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, "", max_keys=2)
     assert len(res) == mock_utils.ITEM_COUNT
     res = functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, "cache")
-    assert res == ["cache/data_packages.json", "cache/studies.json"]
+    assert res == [
+        "cache/data_package_names.json",
+        "cache/data_packages.json",
+        "cache/data_packages/other_study__document__100.json",
+        "cache/data_packages/study__encounter__099.json",
+        "cache/data_packages/study__encounter__100.json",
+        "cache/studies.json",
+    ]
     res = functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, "nonexistant")
     assert res == []
 
 
+def test_iter_s3_keys(mock_bucket):
+    s3_client = boto3.client("s3")
+    res = functions.iter_s3_keys(s3_client, mock_utils.TEST_BUCKET, "", max_keys=2)
+    assert not isinstance(res, list)
+    assert len(list(res)) == mock_utils.ITEM_COUNT
+
+
+def test_publish_sns_batch():
+    sns_client = mock.MagicMock()
+    sns_client.publish_batch.return_value = {"Successful": [], "Failed": []}
+    messages = [f"key_{i}" for i in range(25)]
+    functions.publish_sns_batch(sns_client, "arn", messages, "subject")
+    calls = sns_client.publish_batch.call_args_list
+    assert [len(c.kwargs["PublishBatchRequestEntries"]) for c in calls] == [10, 10, 5]
+    assert [
+        entry["Message"] for c in calls for entry in c.kwargs["PublishBatchRequestEntries"]
+    ] == messages
+    sns_client.publish_batch.return_value = {"Failed": [{"Id": "1", "Code": "InternalError"}]}
+    with pytest.raises(errors.AggregatorSnsError, match="key_1"):
+        functions.publish_sns_batch(sns_client, "arn", messages[:3], "subject")
+
+
+def test_pointer_layout(mock_bucket):
+    s3_client = boto3.client("s3")
+    key = f"{enums.BucketPath.LATEST}/study/study__dp/site/000/study__dp.cube.parquet"
+    blob = functions.put_s3_blob(
+        s3_client, mock_utils.TEST_BUCKET, "study", "study__dp.cube.parquet", b"data"
+    )
+    assert blob.startswith(f"{enums.BucketPath.BLOB}/study/")
+    assert blob.endswith(".cube.parquet")
+    # identical content is stored once
+    assert blob == functions.put_s3_blob(
+        s3_client, mock_utils.TEST_BUCKET, "study", "other.cube.parquet", b"data"
+    )
+    # streamed payloads land at the same key, without leaving anything in temp
+    assert blob == functions.put_s3_blob(
+        s3_client, mock_utils.TEST_BUCKET, "study", "other.cube.parquet", io.BytesIO(b"data")
+    )
+    streamed = functions.put_s3_blob(
+        s3_client, mock_utils.TEST_BUCKET, "study", "new.cube.parquet", io.BytesIO(b"new data")
+    )
+    assert streamed == functions.put_s3_blob(
+        s3_client, mock_utils.TEST_BUCKET, "study", "new.cube.parquet", b"new data"
+    )
+    assert functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, enums.BucketPath.TEMP) == []
+    functions.put_s3_pointer(s3_client, mock_utils.TEST_BUCKET, key, blob)
+    # the layout is opt in, and is a no-op otherwise
+    assert functions.resolve_s3_pointer(key, s3_client) == key
+    with mock.patch.dict("os.environ", {"STORAGE_LAYOUT": "pointer"}):
+        assert functions.resolve_s3_pointer(key, s3_client) == blob
+        assert (
+            functions.resolve_s3_pointer(f"s3://{mock_utils.TEST_BUCKET}/{key}", s3_client)
+            == f"s3://{mock_utils.TEST_BUCKET}/{blob}"
+        )
+        # pointers survive moves between state folders
+        new_key = key.replace(enums.BucketPath.LATEST, enums.BucketPath.LAST_VALID, 1)
+        functions.move_s3_file(s3_client, mock_utils.TEST_BUCKET, key, new_key)
+        assert functions.resolve_s3_pointer(new_key, s3_client) == blob
+        # non-pointer objects resolve to themselves
+        assert functions.resolve_s3_pointer(blob, s3_client) == blob
+
+
+def test_s3_range_reader(mock_bucket):
+    s3_client = boto3.client("s3")
+    upload = "./tests/test_data/exports/upload.zip"
+    s3_client.upload_file(upload, mock_utils.TEST_BUCKET, "upload.zip")
+    with open(upload, "rb") as f:
+        expected = f.read()
+    reader = functions.S3RangeReader(s3_client, mock_utils.TEST_BUCKET, "upload.zip")
+    assert reader.size == len(expected)
+    assert reader.seek(-10, io.SEEK_END) == len(expected) - 10
+    assert reader.read(100) == expected[-10:]
+    assert reader.read(100) == b""
+    reader.seek(5)
+    reader.seek(5, io.SEEK_CUR)
+    assert reader.read(10) == expected[10:20]
+    with pytest.raises(ValueError):
+        reader.seek(-1)
+    # a small buffer forces zipfile through many ranged reads
+    with (
+        zipfile.ZipFile(upload) as local,
+        zipfile.ZipFile(io.BufferedReader(reader, buffer_size=1024)) as remote,
+    ):
+        assert remote.namelist() == local.namelist()
+        for name in local.namelist():
+            assert remote.read(name) == local.read(name)
+    # reads are pinned to the object as it was when opened
+    s3_client.put_object(Bucket=mock_utils.TEST_BUCKET, Key="upload.zip", Body=b"new")
+    with pytest.raises(botocore.exceptions.ClientError):
+        reader.seek(0)
+        reader.read(10)
+
+
+def test_iter_s3_folders(mock_bucket):
+    s3_client = boto3.client("s3")
+    res = list(functions.iter_s3_folders(s3_client, mock_utils.TEST_BUCKET, "cache"))
+    assert res == ["cache/data_packages/"]
+    res = list(
+        functions.iter_s3_folders(
+            s3_client, mock_utils.TEST_BUCKET, enums.BucketPath.AGGREGATE.value
+        )
+    )
+    assert res == [
+        f"{enums.BucketPath.AGGREGATE.value}/{mock_utils.OTHER_STUDY}/",
+        f"{enums.BucketPath.AGGREGATE.value}/{mock_utils.EXISTING_STUDY}/",
+    ]
+
+
+def test_iter_s3_keys_from_prefixes(mock_bucket):
+    s3_client = boto3.client("s3")
+    res = list(
+        functions.iter_s3_keys_from_prefixes(
+            s3_client,
+            mock_utils.TEST_BUCKET,
+            ["cache", "nonexistant", enums.BucketPath.META.value],
+            max_workers=2,
+        )
+    )
+    assert res == [
+        "cache/data_package_names.json",
+        "cache/data_packages.json",
+        "cache/data_packages/other_study__document__100.json",
+        "cache/data_packages/study__encounter__099.json",
+        "cache/data_packages/study__encounter__100.json",
+        "cache/studies.json",
+        "metadata/column_types.json",
+        "metadata/study_periods.json",
+        "metadata/transactions.json",
+    ]
+    res = list(
+        functions.iter_s3_keys_from_prefixes(
+            s3_client,
+            mock_utils.TEST_BUCKET,
+            [
+                f"{enums.BucketPath.AGGREGATE.value}/{mock_utils.EXISTING_STUDY}",
+                f"{enums.BucketPath.FLAT.value}/{mock_utils.EXISTING_STUDY}",
+            ],
+            folders=True,
+        )
+    )
+    assert res == [
+        f"{enums.BucketPath.AGGREGATE.value}/{mock_utils.EXISTING_STUDY}/"
+        f"{mock_utils.EXISTING_STUDY}__{mock_utils.EXISTING_DATA_P}/",
+        f"{enums.BucketPath.FLAT.value}/{mock_utils.EXISTING_STUDY}/{mock_utils.EXISTING_SITE}/",
+    ]
+
+
+def test_get_glue_table_names(mock_glue):
+    mock_utils.create_glue_tables(mock_glue, ["study__encounter__099"])
+    db = mock_utils.TEST_GLUE_DB
+    assert functions.get_glue_table_names(db) == {"study__encounter__099"}
+    # Within the TTL, the listing is reused
+    mock_utils.create_glue_tables(mock_glue, ["study__encounter__100"])
+    assert functions.get_glue_table_names(db) == {"study__encounter__099"}
+    # unless it's missing a table the caller expects
+    assert functions.get_glue_table_names(db, expected=["study__encounter__100"]) == {
+        "study__encounter__099",
+        "study__encounter__100",
+    }
+    # tables that are still missing after that aren't looked for again within the TTL
+    glue_client = mock.MagicMock(wraps=boto3.client("glue"))
+    expected = ["study__encounter__100", "study__encounter__102"]
+    for _ in range(2):
+        functions.get_glue_table_names(db, expected=expected, glue_client=glue_client)
+    assert glue_client.get_paginator.call_count == 1
+    mock_utils.create_glue_tables(mock_glue, ["study__encounter__101"])
+    with mock.patch.object(functions, "GLUE_TABLE_CACHE_TTL", 0):
+        assert "study__encounter__101" in functions.get_glue_table_names(db)
+
+
 def test_latest_data_package_version(mock_bucket):
     version = functions.get_latest_data_package_version(
         mock_utils.TEST_BUCKET, f"{enums.BucketPath.AGGREGATE.value}/{mock_utils.EXISTING_STUDY}"
@@ -111,6 +465,13 @@ def test_latest_data_package_version(mock_bucket):
     version = functions.get_latest_data_package_version(
         mock_utils.TEST_BUCKET, f"{enums.BucketPath.AGGREGATE.value}/{mock_utils.EXISTING_STUDY}"
     )
+    assert version == mock_utils.NEW_VERSION
+    version = functions.get_latest_data_package_version(
+        mock_utils.TEST_BUCKET,
+        f"{enums.BucketPath.AGGREGATE.value}/{mock_utils.EXISTING_STUDY}/"
+        f"{mock_utils.EXISTING_STUDY}__{mock_utils.EXISTING_DATA_P}/",
+    )
+    assert version == mock_utils.NEW_VERSION
     version = functions.get_latest_data_package_version(
         mock_utils.TEST_BUCKET, f"{enums.BucketPath.AGGREGATE.value}/not_a_study"
     )
@@ -221,6 +582,23 @@ def test_parse_s3_key(key, expected, raises):
         assert key == new_key
 
 
+def test_parse_s3_key_memoized():
+    key = (
+        f"{enums.BucketPath.LATEST.value}/{mock_utils.EXISTING_STUDY}/"
+        f"{mock_utils.EXISTING_STUDY}__{mock_utils.EXISTING_DATA_P}/"
+        f"{mock_utils.EXISTING_SITE}/{mock_utils.EXISTING_VERSION}/file.parquet"
+    )
+    dp_meta = functions.parse_s3_key(key)
+    assert functions.parse_s3_key(key) is dp_meta
+    assert functions.parse_s3_key(f"s3://{mock_utils.TEST_BUCKET}/{key}") == dp_meta
+    assert {dp_meta: True}[functions.parse_s3_key(key)]
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        dp_meta.site = mock_utils.OTHER_SITE
+    new_meta = dataclasses.replace(dp_meta, site=mock_utils.OTHER_SITE)
+    assert new_meta.site == mock_utils.OTHER_SITE
+    assert dp_meta.site == mock_utils.EXISTING_SITE
+
+
 @pytest.mark.parametrize(
     "subbucket,expected,raises",
     [
@@ -1,9 +1,11 @@
 import copy
+import dataclasses
 import datetime
 import json
 import os
 from unittest import mock
 
+import awswrangler
 import boto3
 import botocore
 import pandas
@@ -139,6 +141,46 @@ def test_get_list(mock_bucket):
     ]
 
 
+def test_get_data_package_index(mock_bucket):
+    manager = s3_manager.S3Manager(
+        mock_sns_event(
+            mock_utils.EXISTING_SITE,
+            mock_utils.EXISTING_STUDY,
+            mock_utils.EXISTING_DATA_P,
+            mock_utils.EXISTING_VERSION,
+        )
+    )
+    last_valid_root = (
+        f"{enums.BucketPath.LAST_VALID.value}/{mock_utils.EXISTING_STUDY}/"
+        f"{mock_utils.EXISTING_STUDY}__{mock_utils.EXISTING_DATA_P}"
+    )
+    for site in (mock_utils.EXISTING_SITE, mock_utils.OTHER_SITE):
+        for version in (mock_utils.EXISTING_VERSION, mock_utils.NEW_VERSION):
+            manager.put_file(f"{last_valid_root}/{site}/{version}/file.parquet", "")
+    with mock.patch.object(
+        manager, "get_data_package_sizes", wraps=manager.get_data_package_sizes
+    ) as mock_list:
+        index = manager.get_data_package_index(enums.BucketPath.LAST_VALID.value)
+        assert manager.get_data_package_index(enums.BucketPath.LAST_VALID.value) is index
+        assert mock_list.call_count == 1
+    assert len(index.paths) == 4
+    # sizes come from the same listing, for sizing copies of the files
+    assert index.sizes.keys() == set(index.paths)
+    assert (mock_utils.OTHER_SITE, mock_utils.NEW_VERSION) in index
+    assert (mock_utils.NEW_SITE, mock_utils.NEW_VERSION) not in index
+    matches = index.get(mock_utils.OTHER_SITE, mock_utils.NEW_VERSION)
+    assert [path for path, _ in matches] == [
+        f"s3://{mock_utils.TEST_BUCKET}/{last_valid_root}/{mock_utils.OTHER_SITE}/"
+        f"{mock_utils.NEW_VERSION}/file.parquet"
+    ]
+    assert matches[0][1].site == mock_utils.OTHER_SITE
+    assert index.get(mock_utils.NEW_SITE, mock_utils.NEW_VERSION) == []
+    assert {dp_meta.site for _, dp_meta in index.get_version(mock_utils.EXISTING_VERSION)} == {
+        mock_utils.EXISTING_SITE,
+        mock_utils.OTHER_SITE,
+    }
+
+
 @pytest.mark.parametrize(
     "file,dest",
     [
@@ -177,8 +219,46 @@ def test_move_file(mock_bucket, file, dest):
     )
 
 
+def test_move_and_delete_files(mock_bucket):
+    manager = s3_manager.S3Manager(
+        mock_sns_event(
+            mock_utils.EXISTING_SITE,
+            mock_utils.EXISTING_STUDY,
+            mock_utils.EXISTING_DATA_P,
+            mock_utils.EXISTING_VERSION,
+        )
+    )
+    for i in range(3):
+        manager.put_file(f"{enums.BucketPath.TEMP.value}/old/file_{i}.json", "{}")
+    failures = manager.move_files(
+        [
+            (
+                f"s3://{mock_utils.TEST_BUCKET}/{enums.BucketPath.TEMP.value}/old/file_{i}.json",
+                f"{enums.BucketPath.TEMP.value}/new/file_{i}.json",
+            )
+            for i in range(4)
+        ]
+    )
+    assert list(failures.keys()) == [
+        f"s3://{mock_utils.TEST_BUCKET}/{enums.BucketPath.TEMP.value}/old/file_3.json"
+    ]
+    keys = functions.get_s3_keys(
+        manager.s3_client, manager.s3_bucket_name, enums.BucketPath.TEMP.value
+    )
+    assert keys == [f"{enums.BucketPath.TEMP.value}/new/file_{i}.json" for i in range(3)]
+    failures = manager.delete_files(keys)
+    assert failures == {}
+    assert (
+        functions.get_s3_keys(
+            manager.s3_client, manager.s3_bucket_name, enums.BucketPath.TEMP.value
+        )
+        == []
+    )
+
+
+@mock.patch("src.shared.s3_manager.S3Manager.complete_transaction_file")
 @mock.patch("boto3.client")
-def test_cache_api(mock_client, mock_bucket):
+def test_cache_api(mock_client, mock_complete, mock_bucket):
     manager = s3_manager.S3Manager(
         mock_sns_event(
             mock_utils.EXISTING_SITE,
@@ -187,6 +267,11 @@ def test_cache_api(mock_client, mock_bucket):
             mock_utils.EXISTING_VERSION,
         )
     )
+    # Other files in the upload are still processing
+    mock_complete.return_value = False
+    manager.cache_api()
+    assert not manager.sns_client.publish.called
+    mock_complete.return_value = True
     manager.cache_api()
     publish_args = mock_client.mock_calls[-1][2]
     assert publish_args["TopicArn"] == mock_utils.TEST_COMPLETENESS_ARN
@@ -196,8 +281,55 @@ def test_cache_api(mock_client, mock_bucket):
     assert publish_args["Subject"] == "check_completeness"
 
 
+def test_complete_transaction_file(mock_bucket):
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    managers = [
+        s3_manager.S3Manager(
+            mock_sns_event(
+                mock_utils.EXISTING_SITE,
+                mock_utils.EXISTING_STUDY,
+                data_package,
+                mock_utils.EXISTING_VERSION,
+            )
+        )
+        for data_package in [mock_utils.EXISTING_DATA_P, mock_utils.NEW_DATA_P]
+    ]
+    # No transaction, so there's nothing to complete
+    assert not managers[0].complete_transaction_file()
+    transaction = {
+        "id": "1234",
+        "cube": [
+            f"{mock_utils.EXISTING_STUDY}__{mock_utils.EXISTING_DATA_P}.cube.parquet",
+            f"{mock_utils.EXISTING_STUDY}__{mock_utils.NEW_DATA_P}.cube.parquet",
+        ],
+    }
+    for manager, file in zip(managers, transaction["cube"], strict=True):
+        manager.dp_meta = dataclasses.replace(manager.dp_meta, filename=file)
+    managers[0].put_file(managers[0].transaction, transaction)
+    assert not managers[0].complete_transaction_file()
+    # completing a file twice (i.e. a retried event) does not complete the upload
+    assert not managers[0].complete_transaction_file()
+    assert managers[1].complete_transaction_file()
+    assert functions.get_incomplete_transaction_files(
+        s3_client,
+        mock_utils.TEST_BUCKET,
+        mock_utils.EXISTING_SITE,
+        mock_utils.EXISTING_STUDY,
+        {**transaction, "flat": ["other.flat.parquet"]},
+    ) == {"other.flat.parquet"}
+    managers[0].delete_transaction()
+    assert (
+        list(
+            functions.iter_s3_keys(
+                s3_client, mock_utils.TEST_BUCKET, f"{enums.BucketPath.META}/transactions/"
+            )
+        )
+        == []
+    )
+
+
 @mock.patch("src.shared.s3_manager.S3Manager.cache_api")
-def test_write_parquet(mock_cache, mock_bucket):
+def test_write_parquet(mock_cache, mock_bucket, mock_glue):
     df = pandas.DataFrame(data={"foo": [1, 2], "bar": [11, 22]})
     manager = s3_manager.S3Manager(
         mock_sns_event(
@@ -217,6 +349,103 @@ def test_write_parquet(mock_cache, mock_bucket):
     assert mock_cache.called
 
 
+@mock.patch("src.shared.s3_manager.S3Manager.cache_api")
+def test_write_parquet_generations(mock_cache, mock_bucket, mock_glue):
+    manager = s3_manager.S3Manager(
+        mock_sns_event(
+            mock_utils.EXISTING_SITE,
+            mock_utils.EXISTING_STUDY,
+            mock_utils.EXISTING_DATA_P,
+            mock_utils.EXISTING_VERSION,
+        )
+    )
+    key = (
+        "aggregates/study/study__encounter/"
+        "study__encounter__099/study__encounter__aggregate.parquet"
+    )
+    # a file written to the key before generations existed
+    functions.put_s3_file(manager.s3_client, mock_utils.TEST_BUCKET, key, "stale")
+    generations = []
+    for i in range(functions.GENERATIONS_KEPT + 2):
+        generations.append(manager.write_parquet(pandas.DataFrame(data={"cnt": [i]}), key=key))
+        # the Glue table and the generation record agree after every write
+        record = functions.get_s3_generation(mock_utils.TEST_BUCKET, key)
+        assert record["generation"] == generations[-1]
+        table = mock_glue.get_table(
+            DatabaseName=mock_utils.TEST_GLUE_DB, Name="study__encounter__099"
+        )["Table"]
+        assert table["StorageDescriptor"]["Location"] == (
+            f"s3://{mock_utils.TEST_BUCKET}/{functions.get_folder_from_s3_path(record['key'])}/"
+        )
+        assert awswrangler.s3.read_parquet(
+            functions.resolve_s3_generation(f"s3://{mock_utils.TEST_BUCKET}/{key}")
+        )["cnt"].tolist() == [i]
+    # nothing is written to the key itself, and the stale file is gone
+    assert (
+        functions.get_s3_keys(
+            manager.s3_client, mock_utils.TEST_BUCKET, functions.get_folder_from_s3_path(key)
+        )
+        == []
+    )
+    assert len(set(generations)) == len(generations)
+    # only the newest generations are kept
+    kept = list(
+        functions.iter_s3_folders(
+            manager.s3_client, mock_utils.TEST_BUCKET, functions.get_generation_prefix(key)
+        )
+    )
+    assert len(kept) == functions.GENERATIONS_KEPT
+    assert all(
+        any(gen in folder for folder in kept) for gen in generations[-functions.GENERATIONS_KEPT :]
+    )
+    # aggregates without a generation resolve to themselves
+    other = key.replace("099", "100")
+    assert functions.get_s3_generation(mock_utils.TEST_BUCKET, other) is None
+    assert functions.resolve_s3_generation(other) == other
+
+
+@mock.patch("src.shared.s3_manager.S3Manager.cache_api")
+def test_write_parquet_registers_table(mock_cache, mock_bucket, mock_glue):
+    manager = s3_manager.S3Manager(
+        mock_sns_event(
+            mock_utils.EXISTING_SITE,
+            mock_utils.EXISTING_STUDY,
+            mock_utils.EXISTING_DATA_P,
+            mock_utils.EXISTING_VERSION,
+        )
+    )
+    generation = manager.write_parquet(pandas.DataFrame(data={"cnt": [1], "gender": ["female"]}))
+    table = mock_glue.get_table(DatabaseName=mock_utils.TEST_GLUE_DB, Name="study__encounter__099")[
+        "Table"
+    ]
+    assert table["StorageDescriptor"]["Location"] == (
+        f"s3://{mock_utils.TEST_BUCKET}/generations/aggregates/study/study__encounter/"
+        f"study__encounter__099/{generation}/"
+    )
+    assert {col["Name"]: col["Type"] for col in table["StorageDescriptor"]["Columns"]} == {
+        "cnt": "bigint",
+        "gender": "string",
+    }
+
+    # A schema change updates the existing table
+    manager.write_parquet(pandas.DataFrame(data={"cnt": [1], "race": ["white"]}))
+    table = mock_glue.get_table(DatabaseName=mock_utils.TEST_GLUE_DB, Name="study__encounter__099")[
+        "Table"
+    ]
+    assert [col["Name"] for col in table["StorageDescriptor"]["Columns"]] == ["cnt", "race"]
+
+    # The crawler can't find generations, so registration failures fail the write,
+    # and leave the previous generation published
+    record = functions.get_s3_generation(mock_utils.TEST_BUCKET, manager.parquet_aggregate_key)
+    with mock.patch.dict(os.environ, {"GLUE_DB_NAME": "missing-db"}):
+        with pytest.raises(botocore.exceptions.ClientError):
+            manager.write_parquet(pandas.DataFrame(data={"cnt": [2]}))
+    assert (
+        functions.get_s3_generation(mock_utils.TEST_BUCKET, manager.parquet_aggregate_key) == record
+    )
+    assert mock_cache.call_count == 2
+
+
 def test_presigned_error_handling(mock_bucket):
     manager = s3_manager.S3Manager(
         mock_sns_event(
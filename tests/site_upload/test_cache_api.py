@@ -3,7 +3,6 @@ import os
 from unittest import mock
 
 import boto3
-import pandas
 import pytest
 
 from src.shared import enums, functions
@@ -11,10 +10,6 @@ from src.site_upload.cache_api import cache_api
 from tests import mock_utils
 
 
-def mock_data_packages(*args, **kwargs):
-    return pandas.DataFrame(mock_utils.get_mock_data_packages_cache(), columns=["table_name"])
-
-
 def mock_event(source, subject, message):
     if source == "sns":
         return {"Records": [{"Sns": {"Subject": subject, "Message": message}}]}
@@ -24,38 +19,31 @@ def mock_event(source, subject, message):
 
 
 @pytest.mark.parametrize(
-    "subject,source,message,mock_result,status",
+    "subject,source,message,status",
     [
-        ("data_packages", "sns", "", mock_data_packages, 200),
-        ("nonexistant", "sns", "endpoint", lambda: None, 500),
-        ("", "eventbridge", "Glue Crawler State Change", mock_data_packages, 200),
+        ("data_packages", "sns", "", 200),
+        ("nonexistant", "sns", "endpoint", 500),
+        ("", "eventbridge", "Glue Crawler State Change", 200),
     ],
 )
-def test_cache_api_handler(mocker, mock_bucket, subject, source, message, mock_result, status):
-    mock_query_result = mocker.patch("awswrangler.athena.read_sql_query")
-    mock_query_result.side_effect = mock_result
+def test_cache_api_handler(mock_bucket, mock_glue, subject, source, message, status):
+    mock_utils.create_glue_tables(mock_glue, mock_utils.get_mock_data_packages_cache())
     event = mock_event(source, subject, message)
     res = cache_api.cache_api_handler(event, {})
     assert res["statusCode"] == status
 
 
-@mock.patch(
-    "awswrangler.athena.read_sql_query",
-    lambda query, database, s3_output, workgroup: pandas.DataFrame(
-        data=pandas.DataFrame(
-            {
-                "table_name": [
-                    "study__encounter__098",
-                    "study__encounter__099",
-                    "nonexistent_study__encounter__099",
-                ]
-            }
-        )
-    ),
-)
-def test_cache_api_data(mock_bucket):
+def test_cache_api_data(mock_bucket, mock_glue):
     s3_bucket_name = os.environ.get("BUCKET_NAME")
     s3_client = boto3.client("s3")
+    mock_utils.create_glue_tables(
+        mock_glue,
+        [
+            "study__encounter__098",
+            "study__encounter__099",
+            "nonexistent_study__encounter__099",
+        ],
+    )
     cache_api.cache_api_data(
         s3_client,
         s3_bucket_name,
@@ -91,6 +79,172 @@ def test_cache_api_data(mock_bucket):
             "version": "099",
         }
     ]
+    # Each package is also cached on its own, and packages no longer present are removed
+    assert (
+        functions.get_s3_json_as_dict(
+            s3_bucket_name, functions.get_data_package_cache_key("study__encounter__099"), s3_client
+        )
+        == cache[0]
+    )
+    cached_packages = functions.get_s3_keys(
+        s3_client,
+        s3_bucket_name,
+        f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}/",
+    )
+    assert cached_packages == [functions.get_data_package_cache_key("study__encounter__099")]
+    assert functions.get_s3_json_as_dict(
+        s3_bucket_name,
+        f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGE_NAMES.value}.json",
+        s3_client,
+    ) == {"encounter": ["study__encounter__099"]}
+
+    # Without a full list to compare against, stale packages are found by listing them
+    s3_client.delete_object(
+        Bucket=s3_bucket_name,
+        Key=f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}.json",
+    )
+    functions.put_s3_file(
+        s3_client, s3_bucket_name, functions.get_data_package_cache_key("stale__dp__099"), {}
+    )
+    cache_api.cache_api_data(
+        s3_client,
+        s3_bucket_name,
+        mock_utils.MOCK_ENV["GLUE_DB_NAME"],
+        enums.JsonFilename.DATA_PACKAGES.value,
+    )
+    assert functions.get_s3_keys(
+        s3_client,
+        s3_bucket_name,
+        f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}/",
+    ) == [functions.get_data_package_cache_key("study__encounter__099")]
+
+    # Aggregates published as generations are found by their generation record
+    aggregate_key = cache[0]["s3_path"]
+    functions.put_s3_file(
+        s3_client,
+        s3_bucket_name,
+        f"{functions.get_generation_prefix(aggregate_key)}/{functions.GENERATION_RECORD_FILENAME}",
+        {"generation": "gen", "key": aggregate_key},
+    )
+    s3_client.delete_object(Bucket=s3_bucket_name, Key=aggregate_key)
+    cache_api.cache_api_data(
+        s3_client,
+        s3_bucket_name,
+        mock_utils.MOCK_ENV["GLUE_DB_NAME"],
+        enums.JsonFilename.DATA_PACKAGES.value,
+    )
+    assert functions.get_s3_json_as_dict(
+        s3_bucket_name,
+        f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGE_NAMES.value}.json",
+        s3_client,
+    ) == {"encounter": ["study__encounter__099"]}
+
+
+def test_cache_api_data_study(mock_bucket, mock_glue):
+    s3_bucket_name = os.environ.get("BUCKET_NAME")
+    s3_client = boto3.client("s3")
+    mock_utils.create_glue_tables(
+        mock_glue, ["study__encounter__099", "other_study__encounter__099"]
+    )
+
+    def get_cache(target):
+        return functions.get_s3_json_as_dict(
+            s3_bucket_name, f"{enums.BucketPath.CACHE.value}/{target.value}.json", s3_client
+        )
+
+    before = get_cache(enums.JsonFilename.DATA_PACKAGES)
+    cache_api.cache_api_data(
+        s3_client,
+        s3_bucket_name,
+        mock_utils.MOCK_ENV["GLUE_DB_NAME"],
+        enums.JsonFilename.DATA_PACKAGES.value,
+        study="study",
+    )
+    # Only the requested study is recomputed; other studies keep their cached entries,
+    # even though the bucket would produce something different for them
+    packages = get_cache(enums.JsonFilename.DATA_PACKAGES)
+    assert [dp for dp in packages if dp["study"] != "study"] == [
+        dp for dp in before if dp["study"] != "study"
+    ]
+    assert [dp["id"] for dp in packages if dp["study"] == "study"] == ["study__encounter__099"]
+    cached_packages = functions.get_s3_keys(
+        s3_client,
+        s3_bucket_name,
+        f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}/",
+    )
+    assert cached_packages == [
+        functions.get_data_package_cache_key("other_study__document__100"),
+        functions.get_data_package_cache_key("study__encounter__099"),
+    ]
+    studies = get_cache(enums.JsonFilename.STUDIES)
+    # the bucket only has a 099 manifest for other_study
+    assert list(studies["other_study"]) == ["100"]
+    assert (
+        studies["study"]["099"]["study_owner_display"] == "Princeton Plainsboro Teaching Hospital"
+    )
+
+    # Without an existing cache to update, everything is rebuilt
+    s3_client.delete_object(
+        Bucket=s3_bucket_name,
+        Key=f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.DATA_PACKAGES.value}.json",
+    )
+    cache_api.cache_api_data(
+        s3_client,
+        s3_bucket_name,
+        mock_utils.MOCK_ENV["GLUE_DB_NAME"],
+        enums.JsonFilename.DATA_PACKAGES.value,
+        study="study",
+    )
+    assert {dp["study"] for dp in get_cache(enums.JsonFilename.DATA_PACKAGES)} == {
+        "study",
+        "other_study",
+    }
+
+
+def test_get_manifests(mock_bucket):
+    s3_bucket_name = os.environ.get("BUCKET_NAME")
+    s3_client = boto3.client("s3")
+    studies = [f"study_{i}" for i in range(5)]
+    for study in studies:
+        functions.put_s3_file(
+            s3_client,
+            s3_bucket_name,
+            f"{enums.BucketPath.MANIFEST.value}/{study}/{mock_utils.EXISTING_VERSION}/manifest.json",
+            {"study_prefix": study},
+        )
+    with mock.patch.object(
+        cache_api.functions,
+        "get_s3_json_as_dict",
+        wraps=cache_api.functions.get_s3_json_as_dict,
+    ) as mock_get:
+        manifests = cache_api._get_manifests(s3_client, s3_bucket_name, None, max_workers=4)
+    # every study's manifest is downloaded once, and returned under its own key
+    assert mock_get.call_count == len(manifests)
+    for study in studies:
+        key = (
+            f"{enums.BucketPath.MANIFEST.value}/{study}/{mock_utils.EXISTING_VERSION}/manifest.json"
+        )
+        assert manifests[key] == {"study_prefix": study}
+    assert {functions.parse_s3_key(key).study for key in manifests} == {
+        *studies,
+        mock_utils.EXISTING_STUDY,
+        mock_utils.OTHER_STUDY,
+    }
+
+
+def test_cache_api_data_studies_written_once(mock_bucket, mock_glue):
+    s3_bucket_name = os.environ.get("BUCKET_NAME")
+    s3_client = boto3.client("s3")
+    mock_utils.create_glue_tables(mock_glue, ["study__encounter__099"])
+    studies_key = f"{enums.BucketPath.CACHE.value}/{enums.JsonFilename.STUDIES.value}.json"
+    with mock.patch.object(s3_client, "put_object", wraps=s3_client.put_object) as mock_put:
+        cache_api.cache_api_data(
+            s3_client,
+            s3_bucket_name,
+            mock_utils.MOCK_ENV["GLUE_DB_NAME"],
+            enums.JsonFilename.DATA_PACKAGES.value,
+        )
+    assert [call.kwargs["Key"] for call in mock_put.call_args_list].count(studies_key) == 1
 
 
 def test_cache_study_data(mock_bucket):
@@ -1,9 +1,7 @@
 import json
-import time
 from unittest import mock
 
 import boto3
-import pandas
 import time_machine
 
 from src.shared import enums, functions
@@ -48,12 +46,29 @@ def upload_file(filename, version, s3_client):
     )
 
 
-def reset_state(s3_client, transaction):
+def mark_complete(filename, transaction, s3_client):
+    prefix = functions.get_transaction_completion_prefix(
+        mock_utils.EXISTING_SITE, mock_utils.NEW_STUDY, transaction["id"]
+    )
+    s3_client.put_object(Bucket=mock_utils.TEST_BUCKET, Key=f"{prefix}/{filename}", Body=b"")
+
+
+def reset_state(s3_client, transaction, complete=True):
     s3_client.put_object(
         Bucket=mock_utils.TEST_BUCKET,
         Key=transaction_key,
         Body=json.dumps(transaction).encode("UTF-8"),
     )
+    if complete:
+        for file in transaction["cube"] + transaction["flat"]:
+            mark_complete(file, transaction, s3_client)
+
+
+def get_crawl_requests(sqs_client):
+    """Receives (and so consumes) the queued crawl requests"""
+    return sqs_client.receive_message(
+        QueueUrl=mock_utils.TEST_CRAWL_REQUESTS_URL, MaxNumberOfMessages=10
+    ).get("Messages", [])
 
 
 def delete_transaction():
@@ -62,9 +77,9 @@ def delete_transaction():
 
 
 @time_machine.travel("2020-01-01 12:00:00+00:00", tick=False)
-@mock.patch("src.site_upload.check_if_complete.check_if_complete.sleep", returns=time.sleep(1))
-def test_check_if_complete(mock_wait, mock_bucket, mock_notification, mock_glue):
+def test_check_if_complete(mock_bucket, mock_notification, mock_queue, mock_glue):
     s3_client = boto3.client("s3", region_name="us-east-1")
+    sqs_client = boto3.client("sqs", region_name="us-east-1")
     g_client = boto3.client("glue", region_name="us-east-1")
     transaction = {
         "id": "124e2e63-a28d-4d7c-85ba-afc84e5bc648",
@@ -77,7 +92,7 @@ def test_check_if_complete(mock_wait, mock_bucket, mock_notification, mock_glue)
         "annotated_cube": [],
         "version": mock_utils.EXISTING_VERSION,
     }
-    reset_state(s3_client, transaction)
+    reset_state(s3_client, transaction, complete=False)
     event = {
         "Records": [
             {
@@ -99,97 +114,74 @@ def test_check_if_complete(mock_wait, mock_bucket, mock_notification, mock_glue)
     res = check_if_complete.check_if_complete_handler(event, {})
     assert res["body"] == '"Processing not completed"'
 
-    # Upload a prior run of a study, but without the columns metadata - this function as
-    # if a study has never been crawled before
+    # Aggregates from a prior run of a study exist, but are not part of this transaction
     with time_machine.travel("2019-12-12 12:00+00:00", tick=False):
         for file in transaction["cube"]:
             upload_file(file, mock_utils.EXISTING_VERSION, s3_client)
     res = check_if_complete.check_if_complete_handler(event, {})
     assert res["body"] == '"Processing not completed"'
 
+    # Markers from a previous transaction don't count towards this one
+    mark_complete(transaction["cube"][0], {"id": "previous"}, s3_client)
+    res = check_if_complete.check_if_complete_handler(event, {})
+    assert res["body"] == '"Processing not completed"'
+
     # one aggregate has finished, but another has not
     with time_machine.travel("2020-01-01 12:01:00+00:00", tick=False):
         upload_file(transaction["cube"][0], mock_utils.EXISTING_VERSION, s3_client)
+        mark_complete(transaction["cube"][0], transaction, s3_client)
     res = check_if_complete.check_if_complete_handler(event, {})
     assert res["body"] == '"Processing not completed"'
 
-    # All aggregates have finished, they are not in the db, so kick off a crawl
+    # All aggregates have finished, they are not in the db, so request a crawl
     with time_machine.travel("2020-01-01 12:01:00+00:00", tick=False):
         for file in transaction["cube"] + transaction["flat"]:
             upload_file(file, mock_utils.EXISTING_VERSION, s3_client)
+            mark_complete(file, transaction, s3_client)
     with time_machine.travel("2020-01-01 12:02:00+00:00", tick=False):
-        with mock.patch("awswrangler.athena.read_sql_query") as query:
-            query.return_value = pandas.DataFrame(data={"table_name": []})
-            res = check_if_complete.check_if_complete_handler(event, {})
+        res = check_if_complete.check_if_complete_handler(event, {})
     body = (
         "Crawl for {"
         f"'site': '{mock_utils.EXISTING_SITE}', 'study': '{mock_utils.NEW_STUDY}'"
-        "} initiated"
+        "} requested"
     )
     assert res["body"] == f'"{body}"'
+    completion_prefix = functions.get_transaction_completion_prefix(
+        mock_utils.EXISTING_SITE, mock_utils.NEW_STUDY, transaction["id"]
+    )
+    assert list(functions.iter_s3_keys(s3_client, mock_utils.TEST_BUCKET, completion_prefix)) == []
+    request = json.loads(get_crawl_requests(sqs_client)[0]["Body"])
+    assert request == {
+        "requests": [{"site": mock_utils.EXISTING_SITE, "study": mock_utils.NEW_STUDY}],
+        "requested_at": "2020-01-01 11:59:00+00:00",
+        "attempt": 0,
+    }
+    # The crawler itself is only started by the crawl request queue
+    assert "LastCrawl" not in g_client.get_crawler(Name=mock_utils.TEST_GLUE_CRAWLER)["Crawler"]
 
-    # Throw an error when the crawler is stuck in the running state.
+    # All aggregates have finished, they are not in the db, but a parallel invocation
+    # has already requested a crawl
     reset_state(s3_client, transaction)
     with time_machine.travel("2020-01-01 12:02:00+00:00", tick=False):
-        with mock.patch("awswrangler.athena.read_sql_query") as query:
-            query.return_value = pandas.DataFrame(data={"table_name": []})
+        with mock.patch(
+            "src.site_upload.check_if_complete.check_if_complete.mock_entrypoint"
+        ) as entrypoint:
+            entrypoint.side_effect = delete_transaction
             res = check_if_complete.check_if_complete_handler(event, {})
-    body = "Error requesting crawl"
-    assert res["body"] == f'"{body}"'
-    # All aggregates have finished, they are not in the db, but a crawl has already started
-
-    g_client.list_crawls(CrawlerName="cumulus-aggregator-test-crawler")
-    with time_machine.travel("2020-01-01 12:02:00+00:00", tick=False):
-        with mock.patch("awswrangler.athena.read_sql_query") as query:
-            with mock.patch(
-                "src.site_upload.check_if_complete.check_if_complete.mock_entrypoint"
-            ) as entrypoint:
-                entrypoint.side_effect = delete_transaction
-                query.return_value = pandas.DataFrame(data={"table_name": []})
-                res = check_if_complete.check_if_complete_handler(event, {})
     body = (
         "Processing request for {"
         f"'site': '{mock_utils.EXISTING_SITE}', 'study': '{mock_utils.NEW_STUDY}'"
         "} already sent"
     )
     assert res["body"] == f'"{body}"'
+    assert get_crawl_requests(sqs_client) == []
 
-    g_client.list_crawls(CrawlerName="cumulus-aggregator-test-crawler")
-
-    # The tables are now in the DB, so no crawl is required
-    reset_state(s3_client, transaction)
-    with time_machine.travel("2020-01-01 12:02:00+00:00", tick=False):
-        with mock.patch("awswrangler.athena.read_sql_query") as query:
-            query.return_value = pandas.DataFrame(data={"table_name": expected_tables})
-            res = check_if_complete.check_if_complete_handler(event, {})
-    body = (
-        "Crawl for {"
-        f"'site': '{mock_utils.EXISTING_SITE}', 'study': '{mock_utils.NEW_STUDY}'"
-        "} not required, directly invoked caching"
-    )
-    assert res["body"] == f'"{body}"'
-
-    # A crawl started that covers this data, so we don't need to invoke another
-    # we invoke the list_crawls method here as a way of triggering a state change in
-    # moto's mocking of crawlers
-    reset_state(s3_client, transaction)
-    g_client.list_crawls(CrawlerName="cumulus-aggregator-test-crawler")
-    with time_machine.travel("2020-01-01 12:02:00+00:00", tick=False):
-        with mock.patch("awswrangler.athena.read_sql_query") as query:
-            query.return_value = pandas.DataFrame(data={"table_name": []})
-            res = check_if_complete.check_if_complete_handler(event, {})
-    body = (
-        "Recrawl request for {"
-        f"'site': '{mock_utils.EXISTING_SITE}', 'study': '{mock_utils.NEW_STUDY}'"
-        "} covered by subsequent request"
-    )
-    assert res["body"] == f'"{body}"'
-
-    # There are no new data packages, so we can skip crawling.
+    # The tables have been registered, so there are no new data packages, and we can
+    # skip crawling, once the listing showing them as missing has expired.
+    mock_utils.create_glue_tables(g_client, expected_tables)
     reset_state(s3_client, transaction)
     with time_machine.travel("2020-01-01 12:03:00", tick=False):
-        with mock.patch("awswrangler.athena.read_sql_query") as query:
-            query.return_value = pandas.DataFrame(data={"table_name": expected_tables})
+        with mock.patch.object(check_if_complete.functions, "GLUE_TABLE_CACHE_TTL", 0):
             res = check_if_complete.check_if_complete_handler(event, {})
     body = (
         "Crawl for {"
@@ -197,22 +189,135 @@ def test_check_if_complete(mock_wait, mock_bucket, mock_notification, mock_glue)
         "} not required, directly invoked caching"
     )
     assert res["body"] == f'"{body}"'
+    assert get_crawl_requests(sqs_client) == []
 
     # No new packages and transaction deleted, so this has already been queued by a parallel task.
 
     reset_state(s3_client, transaction)
 
     with time_machine.travel("2020-01-01 12:03:00+00:00", tick=False):
-        with mock.patch("awswrangler.athena.read_sql_query") as query:
-            with mock.patch(
-                "src.site_upload.check_if_complete.check_if_complete.mock_entrypoint"
-            ) as entrypoint:
-                entrypoint.side_effect = delete_transaction
-                query.return_value = pandas.DataFrame(data={"table_name": expected_tables})
-                res = check_if_complete.check_if_complete_handler(event, {})
+        with mock.patch(
+            "src.site_upload.check_if_complete.check_if_complete.mock_entrypoint"
+        ) as entrypoint:
+            entrypoint.side_effect = delete_transaction
+            res = check_if_complete.check_if_complete_handler(event, {})
     body = (
         "Processing request for {"
         f"'site': '{mock_utils.EXISTING_SITE}', 'study': '{mock_utils.NEW_STUDY}'"
         "} already sent"
     )
     assert res["body"] == f'"{body}"'
+
+
+def get_sqs_event(*payloads):
+    return {
+        "Records": [
+            {"messageId": str(i), "body": json.dumps(payload)} for i, payload in enumerate(payloads)
+        ]
+    }
+
+
+# Deferred requests are delayed, so this skips the wait to be able to receive them
+@mock.patch("src.site_upload.check_if_complete.check_if_complete.CRAWL_RETRY_DELAY", 0)
+def test_schedule_crawl(mock_queue, mock_glue):
+    sqs_client = boto3.client("sqs", region_name="us-east-1")
+    requests = [
+        {"site": mock_utils.EXISTING_SITE, "study": mock_utils.NEW_STUDY},
+        {"site": mock_utils.OTHER_SITE, "study": mock_utils.EXISTING_STUDY},
+    ]
+
+    # Two studies finishing together share a single crawl
+    with time_machine.travel("2020-01-01 12:02:00+00:00", tick=False):
+        res = check_if_complete.check_if_complete_handler(
+            get_sqs_event(
+                {
+                    "requests": [requests[0]],
+                    "requested_at": "2020-01-01 12:00:00+00:00",
+                    "attempt": 0,
+                },
+                {
+                    "requests": [requests[1]],
+                    "requested_at": "2020-01-01 12:01:00+00:00",
+                    "attempt": 0,
+                },
+            ),
+            {},
+        )
+    assert res["body"] == json.dumps(f"Crawl for {requests!s} initiated")
+    crawler = mock_glue.get_crawler(Name=mock_utils.TEST_GLUE_CRAWLER)["Crawler"]
+    assert crawler["State"] == "RUNNING"
+    assert get_crawl_requests(sqs_client) == []
+
+    # A request from after the crawl started has to wait for the crawler, and is requeued
+    # with the other pending requests from its batch, rather than waiting in the lambda
+    res = check_if_complete.check_if_complete_handler(
+        get_sqs_event(
+            {
+                "requests": [requests[0]],
+                "requested_at": "2020-01-01 12:02:30+00:00",
+                "attempt": 0,
+            },
+            {
+                "requests": [requests[1]],
+                "requested_at": "2020-01-01 12:02:45+00:00",
+                "attempt": 2,
+            },
+        ),
+        {},
+    )
+    assert res["statusCode"] == 202
+    messages = get_crawl_requests(sqs_client)
+    assert len(messages) == 1
+    assert json.loads(messages[0]["Body"]) == {
+        "requests": requests,
+        "requested_at": "2020-01-01 12:02:30+00:00",
+        "attempt": 3,
+    }
+
+    # Requests made before the latest crawl started are already covered by it
+    res = check_if_complete.check_if_complete_handler(
+        get_sqs_event(
+            {"requests": [requests[0]], "requested_at": "2020-01-01 11:00:00+00:00", "attempt": 0},
+        ),
+        {},
+    )
+    assert res["body"] == json.dumps(
+        f"Crawl requests for {[requests[0]]!s} covered by subsequent request"
+    )
+
+    # Give up if the crawler stays busy
+    res = check_if_complete.check_if_complete_handler(
+        get_sqs_event(
+            {
+                "requests": [requests[0]],
+                "requested_at": "2020-01-01 12:05:00+00:00",
+                "attempt": check_if_complete.CRAWL_MAX_ATTEMPTS - 1,
+            },
+        ),
+        {},
+    )
+    assert res["body"] == '"Error requesting crawl"'
+    assert get_crawl_requests(sqs_client) == []
+    dead_letters = sqs_client.receive_message(
+        QueueUrl=mock_utils.TEST_CRAWL_REQUESTS_DEAD_LETTER_URL
+    )["Messages"]
+    assert json.loads(dead_letters[0]["Body"]) == {
+        "requests": [requests[0]],
+        "requested_at": "2020-01-01 12:05:00+00:00",
+        "attempt": 0,
+    }
+
+    # Once the crawler is free again, a newer request starts another crawl
+    mock_glue.list_crawls(CrawlerName=mock_utils.TEST_GLUE_CRAWLER)
+    with time_machine.travel("2020-01-01 12:10:00+00:00", tick=False):
+        res = check_if_complete.check_if_complete_handler(
+            get_sqs_event(
+                {
+                    "requests": [requests[0]],
+                    "requested_at": "2020-01-01 12:05:00+00:00",
+                    "attempt": 4,
+                },
+            ),
+            {},
+        )
+    assert res["body"] == json.dumps(f"Crawl for {[requests[0]]!s} initiated")
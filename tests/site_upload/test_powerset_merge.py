@@ -1,6 +1,8 @@
+import dataclasses
 import json
 from contextlib import nullcontext as does_not_raise
 from datetime import UTC, datetime
+from unittest import mock
 
 import awswrangler
 import boto3
@@ -28,7 +30,7 @@ from tests import mock_utils
             False,
             False,
             200,
-            mock_utils.ITEM_COUNT + 2,
+            mock_utils.ITEM_COUNT + 3,
             506,
             [1103, pandas.NA, pandas.NA, pandas.NA, pandas.NA],
             [10, pandas.NA, 78, "Not Hispanic or Latino", "princeton_plainsboro_teaching_hospital"],
@@ -43,7 +45,7 @@ from tests import mock_utils
             False,
             False,
             200,
-            mock_utils.ITEM_COUNT + 2,
+            mock_utils.ITEM_COUNT + 3,
             506,
             [1103, pandas.NA, pandas.NA, pandas.NA, pandas.NA],
             [10, pandas.NA, 78, "Not Hispanic or Latino", "chicago_hope"],
@@ -58,7 +60,7 @@ from tests import mock_utils
             True,
             False,
             200,
-            mock_utils.ITEM_COUNT + 1,
+            mock_utils.ITEM_COUNT + 2,
             506,
             [1103, pandas.NA, pandas.NA, pandas.NA, pandas.NA],
             [10, pandas.NA, 78, "Not Hispanic or Latino", "princeton_plainsboro_teaching_hospital"],
@@ -73,7 +75,7 @@ from tests import mock_utils
             True,
             True,
             200,
-            mock_utils.ITEM_COUNT + 1,
+            mock_utils.ITEM_COUNT + 2,
             506,
             [1103, pandas.NA, pandas.NA, pandas.NA, pandas.NA],
             [10, pandas.NA, 78, "Not Hispanic or Latino", "princeton_plainsboro_teaching_hospital"],
@@ -88,7 +90,7 @@ from tests import mock_utils
             True,
             False,
             200,
-            mock_utils.ITEM_COUNT + 1,
+            mock_utils.ITEM_COUNT + 2,
             506,
             [1103, pandas.NA, pandas.NA, pandas.NA, pandas.NA],
             [10, pandas.NA, 78, "Not Hispanic or Latino", "princeton_plainsboro_teaching_hospital"],
@@ -118,7 +120,7 @@ from tests import mock_utils
             False,
             False,
             200,
-            mock_utils.ITEM_COUNT + 2,
+            mock_utils.ITEM_COUNT + 3,
             30,
             [37990, pandas.NA, pandas.NA, pandas.NA],
             [
@@ -139,7 +141,7 @@ from tests import mock_utils
             False,
             False,
             200,
-            mock_utils.ITEM_COUNT + 2,
+            mock_utils.ITEM_COUNT + 3,
             506,
             [1103, pandas.NA, pandas.NA, pandas.NA, pandas.NA],
             [10, pandas.NA, 78, "Not Hispanic or Latino", "princeton_plainsboro_teaching_hospital"],
@@ -175,6 +177,7 @@ def test_powerset_merge_single_upload(
     mock_bucket,
     mock_notification,
     mock_queue,
+    mock_glue,
     expected_rows,
     first_row,
     last_row,
@@ -226,9 +229,10 @@ def test_powerset_merge_single_upload(
     assert len(s3_res["Contents"]) == expected_contents
     for item in s3_res["Contents"]:
         if item["Key"].endswith("aggregate.parquet"):
-            assert item["Key"].startswith(enums.BucketPath.AGGREGATE)
-            # This finds the aggregate that was created/updated - ie it skips mocks
-            if study in item["Key"] and status == 200:
+            # Aggregates are published as generations - the rest are mocks
+            if not item["Key"].startswith(enums.BucketPath.GENERATION):
+                assert item["Key"].startswith(enums.BucketPath.AGGREGATE)
+            elif study in item["Key"] and status == 200:
                 agg_df = awswrangler.s3.read_parquet(f"s3://{mock_utils.TEST_BUCKET}/{item['Key']}")
                 assert (agg_df["site"].eq(site)).any()
                 assert expected_rows == len(agg_df)
@@ -247,6 +251,7 @@ def test_powerset_merge_single_upload(
                 or item["Key"].startswith(enums.BucketPath.STUDY_META)
                 or item["Key"].startswith(enums.BucketPath.META)
                 or item["Key"].startswith(enums.BucketPath.MANIFEST)
+                or item["Key"].startswith(enums.BucketPath.GENERATION)
             )
     if res["statusCode"] == 200:
         sqs_res = sqs_client.receive_message(
@@ -288,6 +293,7 @@ def test_powerset_merge_join_study_data(
     mock_bucket,
     mock_notification,
     mock_queue,
+    mock_glue,
 ):
     s3_client = boto3.client("s3", region_name="us-east-1")
     new_dp_meta = functions.PackageMetadata(
@@ -348,6 +354,51 @@ def test_powerset_merge_join_study_data(
     assert errors == expected_errors
 
 
+@time_machine.travel("2020-01-01", tick=False)
+def test_powerset_merge_rollback_failure(mock_bucket, mock_notification, mock_queue, caplog):
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    dp_meta = functions.PackageMetadata(
+        study=mock_utils.EXISTING_STUDY,
+        site=mock_utils.NEW_SITE,
+        data_package=mock_utils.EXISTING_DATA_P,
+        version=mock_utils.EXISTING_VERSION,
+        filename="encounter.parquet",
+    )
+    latest_key = functions.construct_s3_key(subbucket=enums.BucketPath.LATEST, dp_meta=dp_meta)
+    last_valid_key = functions.construct_s3_key(
+        subbucket=enums.BucketPath.LAST_VALID, dp_meta=dp_meta
+    )
+    s3_client.upload_file(
+        "./tests/test_data/other_schema.parquet", mock_utils.TEST_BUCKET, latest_key
+    )
+    s3_client.upload_file(
+        "./tests/test_data/count_synthea_patient.parquet", mock_utils.TEST_BUCKET, last_valid_key
+    )
+    s3_client.upload_file(
+        "./tests/test_data/count_synthea_patient.parquet",
+        mock_utils.TEST_BUCKET,
+        functions.construct_s3_key(
+            subbucket=enums.BucketPath.LAST_VALID,
+            dp_meta=dataclasses.replace(dp_meta, site=mock_utils.EXISTING_SITE),
+        ),
+    )
+    move_files = powerset_merge.s3_manager.S3Manager.move_files
+
+    def fail_rollback(self, moves, sizes=None):
+        # archiving to temp works, but moving the archive back does not
+        if moves and moves[0][0].startswith(enums.BucketPath.TEMP):
+            return {moves[0][0]: "AccessDenied"}
+        return move_files(self, moves, sizes=sizes)
+
+    event = {"Records": [{"Sns": {"Message": latest_key, "TopicArn": "TOPIC_PROCESS_COUNTS_ARN"}}]}
+    with mock.patch.object(powerset_merge.s3_manager.S3Manager, "move_files", fail_rollback):
+        res = powerset_merge.powerset_merge_handler(event, {})
+    # the fallback to the last valid file fails too, since it is stuck in temp
+    assert res["statusCode"] == 500
+    assert "Error restoring archived files" in caplog.text
+    assert enums.BucketPath.TEMP in caplog.text
+
+
 # Explicitly testing for raising errors during concat due to them being appropriately
 # handled by the generic error handler
 @pytest.mark.parametrize(
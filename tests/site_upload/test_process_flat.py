@@ -1,3 +1,5 @@
+from unittest import mock
+
 import boto3
 
 from src.shared import enums, functions
@@ -5,7 +7,7 @@ from src.site_upload.process_flat import process_flat
 from tests import mock_utils
 
 
-def test_process_flat(mock_bucket, mock_queue):
+def test_process_flat(mock_bucket, mock_queue, mock_glue):
     dp_meta = functions.PackageMetadata(
         study=mock_utils.EXISTING_STUDY,
         site=mock_utils.EXISTING_SITE,
@@ -36,6 +38,13 @@ def test_process_flat(mock_bucket, mock_queue):
         QueueUrl=mock_utils.TEST_METADATA_UPDATE_URL, MaxNumberOfMessages=10
     )
     assert len(sqs_res["Messages"]) == 2
+    # The table is registered directly, rather than waiting on a crawl
+    table = mock_glue.get_table(
+        DatabaseName=mock_utils.TEST_GLUE_DB, Name=dp_meta.get_tablename(enums.BucketPath.FLAT)
+    )["Table"]
+    assert table["StorageDescriptor"]["Location"].endswith(
+        f"/{dp_meta.get_tablename(enums.BucketPath.FLAT)}/"
+    )
 
     s3_client.upload_file(
         Bucket=mock_utils.TEST_BUCKET,
@@ -48,3 +57,38 @@ def test_process_flat(mock_bucket, mock_queue):
         QueueUrl=mock_utils.TEST_METADATA_UPDATE_URL, MaxNumberOfMessages=10
     )
     assert len(sqs_res["Messages"]) == 2
+
+
+def test_process_flat_archive_sizes(mock_bucket, mock_queue, mock_glue):
+    dp_meta = functions.PackageMetadata(
+        study=mock_utils.EXISTING_STUDY,
+        site=mock_utils.EXISTING_SITE,
+        data_package=mock_utils.EXISTING_DATA_P,
+        version=mock_utils.EXISTING_VERSION,
+    )
+    latest_flat_key = functions.construct_s3_key(
+        enums.BucketPath.LATEST_FLAT, dp_meta=dp_meta, filename="file.parquet"
+    )
+    event = {"Records": [{"Sns": {"TopicArn": "arn", "Message": latest_flat_key}}]}
+    s3_client = boto3.client("s3")
+    for _ in range(2):
+        s3_client.upload_file(
+            Bucket=mock_utils.TEST_BUCKET,
+            Key=latest_flat_key,
+            Filename="./tests/test_data/count_synthea_patient_agg.parquet",
+        )
+        # The sizes of the flat files being archived come from their listing, so
+        # large ones are copied in parts without the caller looking them up
+        with (
+            mock.patch.object(process_flat.functions, "MULTIPART_COPY_THRESHOLD", 0),
+            mock.patch.object(
+                process_flat.functions,
+                "multipart_copy_s3_file",
+                wraps=process_flat.functions.multipart_copy_s3_file,
+            ) as multipart_copy,
+        ):
+            process_flat.process_flat_handler(event, {})
+    assert len(multipart_copy.call_args_list) == 1
+    assert multipart_copy.call_args.args[3].startswith(
+        f"{enums.BucketPath.ARCHIVE.value}/{mock_utils.EXISTING_STUDY}/"
+    )
@@ -1,5 +1,6 @@
 import json
 from datetime import UTC, datetime
+from unittest import mock
 
 import boto3
 import pytest
@@ -216,3 +217,89 @@ def test_process_upload(
             ]["last_upload"]
             == datetime.now(UTC).isoformat()
         )
+
+
+def test_process_upload_message_payload(mock_bucket, mock_notification, mock_queue):
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    sqs_client = boto3.client("sqs", region_name="us-east-1")
+    upload_key = functions.construct_s3_key(
+        subbucket=enums.BucketPath.UPLOAD,
+        site=mock_utils.EXISTING_SITE,
+        study=mock_utils.EXISTING_STUDY,
+        data_package=mock_utils.NEW_DATA_P,
+        version=mock_utils.EXISTING_VERSION,
+        filename="document.cube.parquet",
+    )
+    with open("./tests/test_data/cube_simple_example.parquet", "rb") as f:
+        body = f.read()
+    etag = s3_client.put_object(Bucket=mock_utils.TEST_BUCKET, Key=upload_key, Body=body)["ETag"]
+    uploaded_at = datetime(2021, 2, 3, tzinfo=UTC)
+    message = functions.parse_upload_message(
+        functions.get_upload_message(upload_key, uploaded_at=uploaded_at, size=len(body), etag=etag)
+    )
+    assert message == {
+        "key": upload_key,
+        "uploaded_at": uploaded_at,
+        "size": len(body),
+        "etag": etag,
+    }
+    assert functions.parse_upload_message(upload_key) == {"key": upload_key}
+    wrapped_client = mock.MagicMock(wraps=s3_client)
+    process_upload.process_upload(
+        wrapped_client,
+        boto3.client("sns", region_name="us-east-1"),
+        sqs_client,
+        mock_utils.TEST_BUCKET,
+        upload_key,
+        uploaded_at=uploaded_at,
+        size=len(body),
+        etag=etag,
+    )
+    # everything needed to move the file came from the message
+    assert not wrapped_client.head_object.called
+    assert wrapped_client.copy_object.call_args.kwargs["CopySourceIfMatch"] == etag
+    latest_key = functions.construct_s3_key(
+        enums.BucketPath.LATEST, dp_meta=functions.parse_s3_key(upload_key)
+    )
+    assert s3_client.head_object(Bucket=mock_utils.TEST_BUCKET, Key=latest_key)
+    sqs_res = sqs_client.receive_message(QueueUrl=mock_utils.TEST_METADATA_UPDATE_URL)
+    update = json.loads(json.loads(sqs_res["Messages"][0]["Body"])["updates"])
+    assert (
+        update[mock_utils.EXISTING_SITE][mock_utils.EXISTING_STUDY][mock_utils.NEW_DATA_P][
+            f"{mock_utils.NEW_DATA_P}__{mock_utils.EXISTING_VERSION}"
+        ]["last_upload"]
+        == uploaded_at.isoformat()
+    )
+
+
+def test_process_upload_sqs_batch(mock_bucket, mock_notification, mock_queue):
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    records = []
+    for i, filename in enumerate(["document.cube.parquet", "document.flat.parquet", None]):
+        upload_key = functions.construct_s3_key(
+            subbucket=enums.BucketPath.UPLOAD,
+            site=mock_utils.EXISTING_SITE,
+            study=mock_utils.EXISTING_STUDY,
+            data_package=mock_utils.NEW_DATA_P,
+            version=mock_utils.EXISTING_VERSION,
+            filename=filename or "missing.cube.parquet",
+        )
+        if filename:
+            s3_client.upload_file(
+                "./tests/test_data/cube_simple_example.parquet", mock_utils.TEST_BUCKET, upload_key
+            )
+        records.append({"messageId": str(i), "body": upload_key})
+
+    res = process_upload.process_upload_handler({"Records": records}, {})
+    # only the message for the missing file should be retried
+    assert res == {"batchItemFailures": [{"itemIdentifier": "2"}]}
+    assert len(functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, "site_upload")) == 0
+    assert len(functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, "latest/")) == 1
+    assert len(functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, "latest_flat/")) == 1
+
+    # A malformed batch fails the whole invocation, so that SQS retries it
+    with pytest.raises(KeyError):
+        process_upload.process_upload_handler({"Records": [{"body": records[0]["body"]}]}, {})
+    # while SNS events still get an error response
+    res = process_upload.process_upload_handler({"Records": [{"Sns": {}}]}, {})
+    assert res["statusCode"] == 500
@@ -1,5 +1,9 @@
 import json
+import os
+import zipfile
+from unittest import mock
 
+import awswrangler
 import boto3
 import pytest
 import time_machine
@@ -103,3 +107,301 @@ def test_unzip_upload(
     payload = json.load(s3_res["Body"])
     assert payload["uploaded_at"] == "2020-01-01T00:00:00+00:00"
     assert payload["cube"] == ["upload__count_synthea_patient.cube.parquet"]
+
+
+# members over the single put size are streamed to the blob store
+@pytest.mark.parametrize("single_put_size", [unzip_upload.SINGLE_PUT_SIZE, 0])
+def test_unzip_upload_pointer_layout(mock_bucket, mock_notification, single_put_size):
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    upload_key = functions.construct_s3_key(
+        enums.BucketPath.UPLOAD_STAGING,
+        study=mock_utils.EXISTING_STUDY,
+        site=mock_utils.EXISTING_SITE,
+        version=mock_utils.EXISTING_VERSION,
+        filename="upload.zip",
+    )
+    mock_utils.put_mock_transaction(
+        s3_client=s3_client,
+        site=mock_utils.EXISTING_SITE,
+        study=mock_utils.EXISTING_STUDY,
+        transaction=mock_utils.get_mock_transaction(),
+    )
+    s3_client.upload_file(
+        "./tests/test_data/exports/upload.zip", mock_utils.TEST_BUCKET, upload_key
+    )
+    event = {"Records": [{"awsRegion": "us-east-1", "s3": {"object": {"key": upload_key}}}]}
+    with (
+        mock.patch.dict("os.environ", {"STORAGE_LAYOUT": "pointer"}),
+        mock.patch.object(unzip_upload, "SINGLE_PUT_SIZE", single_put_size),
+    ):
+        res = unzip_upload.unzip_upload_handler(event, {})
+        assert res["statusCode"] == 200
+        uploads = functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, enums.BucketPath.UPLOAD)
+        blobs = functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, enums.BucketPath.BLOB)
+        assert len(blobs) == 1
+        for key in uploads:
+            path = f"s3://{mock_utils.TEST_BUCKET}/{key}"
+            if key.endswith(".cube.parquet"):
+                # count data is stored as a blob, with a pointer in site_upload
+                assert (
+                    functions.resolve_s3_pointer(path)
+                    == f"s3://{mock_utils.TEST_BUCKET}/{blobs[0]}"
+                )
+            else:
+                # everything else is stored as is
+                assert functions.resolve_s3_pointer(path) == path
+        assert not awswrangler.s3.read_parquet(f"s3://{mock_utils.TEST_BUCKET}/{blobs[0]}").empty
+
+
+# Small members are checked before they're written, and large ones from what was written
+@pytest.mark.parametrize(
+    "single_put_size,storage_layout",
+    [(unzip_upload.SINGLE_PUT_SIZE, "default"), (0, "default"), (0, "pointer")],
+)
+def test_unzip_upload_validation(
+    tmp_path, mock_bucket, mock_notification, mock_queue, single_put_size, storage_layout
+):
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    upload_key = functions.construct_s3_key(
+        enums.BucketPath.UPLOAD_STAGING,
+        study=mock_utils.EXISTING_STUDY,
+        site=mock_utils.EXISTING_SITE,
+        version=mock_utils.EXISTING_VERSION,
+        filename="upload.zip",
+    )
+    mock_utils.put_mock_transaction(
+        s3_client=s3_client,
+        site=mock_utils.EXISTING_SITE,
+        study=mock_utils.EXISTING_STUDY,
+        transaction=mock_utils.get_mock_transaction(),
+    )
+    study = mock_utils.EXISTING_STUDY
+    members = {
+        # matches the registered schema of the existing aggregate
+        f"{study}__{mock_utils.EXISTING_DATA_P}.cube.parquet": "count_synthea_patient.parquet",
+        # new data packages have nothing to check against
+        f"{study}__{mock_utils.NEW_DATA_P}.cube.parquet": "cube_simple_example.parquet",
+        f"{study}__empty.cube.parquet": "count_synthea_empty.parquet",
+        f"{study}__bad.annotated_cube.parquet": None,
+        "manifest.toml": None,
+    }
+    with zipfile.ZipFile(tmp_path / "upload.zip", "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, source in members.items():
+            if source:
+                archive.write(f"./tests/test_data/{source}", name)
+            else:
+                archive.writestr(name, b"not parquet")
+        # the registry expects different columns for these. Only the first also has
+        # data from another site; the uploading site is free to change the second.
+        for data_package in ["drifted", "resubmitted"]:
+            archive.write(
+                "./tests/test_data/cube_simple_example.parquet",
+                f"{study}__{mock_utils.EXISTING_DATA_P}_{data_package}.cube.parquet",
+            )
+    column_types = mock_utils.get_mock_column_types_metadata()
+    for data_package, site in [
+        ("drifted", mock_utils.NEW_SITE),
+        ("resubmitted", mock_utils.EXISTING_SITE),
+    ]:
+        data_package = f"{mock_utils.EXISTING_DATA_P}_{data_package}"
+        column_types[study][data_package] = {
+            f"{study}__{data_package}__{mock_utils.EXISTING_VERSION}": (
+                column_types[study][mock_utils.EXISTING_DATA_P][
+                    f"{study}__{mock_utils.EXISTING_DATA_P}__{mock_utils.EXISTING_VERSION}"
+                ]
+            )
+        }
+        s3_client.upload_file(
+            "./tests/test_data/count_synthea_patient.parquet",
+            mock_utils.TEST_BUCKET,
+            functions.construct_s3_key(
+                subbucket=enums.BucketPath.LAST_VALID,
+                study=study,
+                site=site,
+                data_package=data_package,
+                version=mock_utils.EXISTING_VERSION,
+                filename="encounter.parquet",
+            ),
+        )
+    functions.put_s3_file(
+        s3_client, mock_utils.TEST_BUCKET, "metadata/column_types.json", column_types
+    )
+    s3_client.upload_file(tmp_path / "upload.zip", mock_utils.TEST_BUCKET, upload_key)
+    with (
+        mock.patch.object(unzip_upload.functions, "publish_sns_batch") as mock_publish,
+        mock.patch.object(unzip_upload, "SINGLE_PUT_SIZE", single_put_size),
+        mock.patch.dict("os.environ", {"STORAGE_LAYOUT": storage_layout}),
+    ):
+        unzip_upload.unzip_upload(s3_client, None, mock_utils.TEST_BUCKET, upload_key)
+    published = [
+        functions.parse_upload_message(message)["key"] for message in mock_publish.call_args.args[2]
+    ]
+    uploads = functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, enums.BucketPath.UPLOAD)
+    errored = functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, enums.BucketPath.ERROR)
+    valid = [
+        f"{study}__{mock_utils.EXISTING_DATA_P}.cube.parquet",
+        f"{study}__{mock_utils.NEW_DATA_P}.cube.parquet",
+        f"{study}__{mock_utils.EXISTING_DATA_P}_resubmitted.cube.parquet",
+        "manifest.toml",
+    ]
+    assert sorted(published) == sorted(uploads)
+    assert sorted(functions.get_filename_from_s3_path(key) for key in uploads) == sorted(valid)
+    assert sorted(functions.get_filename_from_s3_path(key) for key in errored) == sorted(
+        [
+            f"{study}__empty.cube.parquet",
+            f"{study}__bad.annotated_cube.parquet",
+            f"{study}__{mock_utils.EXISTING_DATA_P}_drifted.cube.parquet",
+        ]
+    )
+    for key in errored:
+        # rejected files are stored where the later stages would have put them
+        dp_meta = functions.parse_s3_key(key)
+        assert key == functions.construct_s3_key(subbucket=enums.BucketPath.ERROR, dp_meta=dp_meta)
+        assert dp_meta.site == mock_utils.EXISTING_SITE
+        # with the member's contents, rather than a pointer to them
+        head = s3_client.head_object(Bucket=mock_utils.TEST_BUCKET, Key=key)
+        assert functions.POINTER_METADATA_KEY not in head["Metadata"]
+        assert head["ContentLength"] > 0
+    sqs_client = boto3.client("sqs", region_name="us-east-1")
+    sqs_res = sqs_client.receive_message(
+        QueueUrl=mock_utils.TEST_METADATA_UPDATE_URL, MaxNumberOfMessages=10
+    )
+    updates = [
+        json.loads(json.loads(message["Body"])["updates"]) for message in sqs_res["Messages"]
+    ]
+    assert sorted(
+        version
+        for update in updates
+        for data_package in update[mock_utils.EXISTING_SITE][study].values()
+        for version, transaction in data_package.items()
+        if transaction["last_error"] is not None
+    ) == sorted(
+        f"{study}__{data_package}__{mock_utils.EXISTING_VERSION}"
+        for data_package in ["empty", "bad", f"{mock_utils.EXISTING_DATA_P}_drifted"]
+    )
+    transaction = functions.get_s3_json_as_dict(
+        mock_utils.TEST_BUCKET,
+        f"{enums.BucketPath.META}/transactions/{mock_utils.EXISTING_SITE}__{study}.json",
+    )
+    assert sorted(transaction["cube"]) == sorted(valid[:3])
+    assert transaction["annotated_cube"] == []
+
+
+@pytest.mark.parametrize("other_site_data", [False, True])
+def test_unzip_upload_inline(
+    other_site_data, mock_bucket, mock_notification, mock_queue, mock_glue
+):
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    upload_key = functions.construct_s3_key(
+        enums.BucketPath.UPLOAD_STAGING,
+        study=mock_utils.EXISTING_STUDY,
+        site=mock_utils.EXISTING_SITE,
+        version=mock_utils.EXISTING_VERSION,
+        filename="upload.zip",
+    )
+    mock_utils.put_mock_transaction(
+        s3_client=s3_client,
+        site=mock_utils.EXISTING_SITE,
+        study=mock_utils.EXISTING_STUDY,
+        transaction=mock_utils.get_mock_transaction(),
+    )
+    s3_client.upload_file(
+        "./tests/test_data/exports/upload.zip", mock_utils.TEST_BUCKET, upload_key
+    )
+    study = mock_utils.EXISTING_STUDY
+    dp = "count_synthea_patient"
+    version = mock_utils.EXISTING_VERSION
+    if other_site_data:
+        s3_client.upload_file(
+            "./tests/test_data/count_synthea_patient.parquet",
+            mock_utils.TEST_BUCKET,
+            f"{enums.BucketPath.LAST_VALID}/{study}/{study}__{dp}/{mock_utils.OTHER_SITE}/"
+            f"{version}/{dp}.cube.parquet",
+        )
+    sns_client = mock.MagicMock()
+    # The archive fits under this on its own, but not with another site's data
+    with (
+        mock.patch.dict("os.environ", {"INLINE_PIPELINE_MAX_SIZE": "5000"}),
+        mock.patch.object(unzip_upload.functions, "publish_sns_batch") as mock_publish,
+    ):
+        unzip_upload.unzip_upload(s3_client, sns_client, mock_utils.TEST_BUCKET, upload_key)
+    assert not mock_publish.called
+    # every file has been routed and processed without the process_upload hop
+    assert functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, enums.BucketPath.UPLOAD) == []
+    assert functions.get_s3_keys(
+        s3_client, mock_utils.TEST_BUCKET, f"{enums.BucketPath.MANIFEST}/{study}/{version}/"
+    )
+    aggregates = functions.get_s3_keys(
+        s3_client, mock_utils.TEST_BUCKET, f"{enums.BucketPath.GENERATION}/"
+    )
+    latest = functions.get_s3_keys(
+        s3_client,
+        mock_utils.TEST_BUCKET,
+        f"{enums.BucketPath.LATEST}/{study}/{study}__{dp}/{mock_utils.EXISTING_SITE}/",
+    )
+    if other_site_data:
+        # a merge that would also read another site's data is left to the merge lambda
+        assert len(latest) == 1
+        assert not any(f"{study}__{dp}" in key for key in aggregates)
+        sns_client.publish.assert_called_once_with(
+            TopicArn=os.environ["TOPIC_PROCESS_COUNTS_ARN"],
+            Message=latest[0],
+            Subject="Process counts upload event",
+        )
+    else:
+        assert latest == []
+        assert any(f"{study}__{dp}" in key for key in aggregates)
+        assert functions.get_s3_keys(
+            s3_client,
+            mock_utils.TEST_BUCKET,
+            f"{enums.BucketPath.LAST_VALID}/{study}/{study}__{dp}/{mock_utils.EXISTING_SITE}/",
+        )
+        assert not any(
+            call.kwargs["TopicArn"] == os.environ["TOPIC_PROCESS_COUNTS_ARN"]
+            for call in sns_client.publish.call_args_list
+        )
+    assert not functions.get_s3_keys(
+        s3_client, mock_utils.TEST_BUCKET, enums.BucketPath.UPLOAD_STAGING
+    )
+    assert functions.get_s3_keys(s3_client, mock_utils.TEST_BUCKET, enums.BucketPath.ARCHIVE)
+
+
+def test_unzip_upload_inline_failure(mock_bucket, mock_notification, mock_queue):
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    upload_key = functions.construct_s3_key(
+        enums.BucketPath.UPLOAD_STAGING,
+        study=mock_utils.EXISTING_STUDY,
+        site=mock_utils.EXISTING_SITE,
+        version=mock_utils.EXISTING_VERSION,
+        filename="upload.zip",
+    )
+    mock_utils.put_mock_transaction(
+        s3_client=s3_client,
+        site=mock_utils.EXISTING_SITE,
+        study=mock_utils.EXISTING_STUDY,
+        transaction=mock_utils.get_mock_transaction(),
+    )
+    s3_client.upload_file(
+        "./tests/test_data/exports/upload.zip", mock_utils.TEST_BUCKET, upload_key
+    )
+    process_upload_message = unzip_upload.process_upload.process_upload_message
+
+    def fail_manifest(s3_client, sns_client, sqs_client, s3_bucket_name, message):
+        if "manifest.toml" in message:
+            raise Exception("Out of time")
+        process_upload_message(s3_client, sns_client, sqs_client, s3_bucket_name, message)
+
+    with (
+        mock.patch.dict("os.environ", {"INLINE_PIPELINE_MAX_SIZE": "1000000"}),
+        mock.patch.object(unzip_upload.functions, "publish_sns_batch") as mock_publish,
+        mock.patch.object(unzip_upload.process_upload, "process_upload_message", fail_manifest),
+    ):
+        unzip_upload.unzip_upload(s3_client, mock.MagicMock(), mock_utils.TEST_BUCKET, upload_key)
+    # files that couldn't be processed inline are sent the usual way instead
+    published = [
+        functions.parse_upload_message(message)["key"] for message in mock_publish.call_args.args[2]
+    ]
+    assert published == functions.get_s3_keys(
+        s3_client, mock_utils.TEST_BUCKET, enums.BucketPath.UPLOAD
+    )
+    assert [functions.get_filename_from_s3_path(key) for key in published] == ["manifest.toml"]
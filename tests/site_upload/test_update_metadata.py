@@ -373,6 +373,7 @@ from tests import mock_utils
 )
 def test_update_metadata(mock_bucket, mock_env, mock_queue, messages, assertions, delete):
     records = []
+    updated_sites = set()
     if delete:
         s3_client = boto3.client("s3")
         s3_client.delete_object(
@@ -382,6 +383,8 @@ def test_update_metadata(mock_bucket, mock_env, mock_queue, messages, assertions
     for message in messages:
         dest = message["dest"]
         del message["dest"]
+        if dest in functions.SITE_KEYED_METADATA:
+            updated_sites |= {(dest, site) for site in message}
         records.append(
             mock_utils.get_mock_sqs_event_record(
                 {
@@ -400,3 +403,22 @@ def test_update_metadata(mock_bucket, mock_env, mock_queue, messages, assertions
         for key in assertion[1]:
             metadata = metadata.get(key, {})
         assert metadata == assertion[2]
+    # Updated sites, and their studies, are also written as their own documents
+    for dest, site in updated_sites:
+        metadata = functions.get_s3_json_as_dict(
+            mock_utils.TEST_BUCKET, f"{enums.BucketPath.META.value}/{dest}.json"
+        )
+        assert (
+            functions.get_s3_json_as_dict(
+                mock_utils.TEST_BUCKET, functions.get_metadata_subdocument_key(dest, site)
+            )
+            == metadata[site]
+        )
+        for study in metadata[site]:
+            assert (
+                functions.get_s3_json_as_dict(
+                    mock_utils.TEST_BUCKET,
+                    functions.get_metadata_subdocument_key(dest, site, study),
+                )
+                == metadata[site][study]
+            )
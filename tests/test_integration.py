@@ -23,6 +23,7 @@ from moto.core import DEFAULT_ACCOUNT_ID
 from moto.sns import sns_backends
 
 from scripts import reset_data_package_cache
+from shared import document_cache as shared_document_cache
 from src.dashboard.get_chart_data import get_chart_data
 from src.dashboard.get_data_packages import get_data_packages
 from src.dashboard.get_from_parquet import get_from_parquet
@@ -129,6 +130,7 @@ def test_integration(
     mock_bucket,
     mock_notification,
     mock_queue,
+    mock_glue,
     upload_file,
     upload_type,
     study,
@@ -176,6 +178,8 @@ def test_integration(
         f"{mock_utils.OTHER_STUDY}__{mock_utils.EXISTING_FLAT_DATA_P}__{mock_utils.EXISTING_SITE}__{mock_utils.EXISTING_VERSION}",
     ]
 
+    mock_utils.create_glue_tables(mock_glue, tables)
+
     # Get a copy of the uploaded file into memory for reference later
     reference_df = pandas.read_parquet(upload_file)
 
@@ -183,13 +187,9 @@ def test_integration(
     # or if not running, ensure that the test bucket configuration is behaving
     # the same way
     if run_migration:
-        with mock.patch(
-            "awswrangler.athena.read_sql_query",
-            lambda query, database, s3_output, workgroup: pandas.DataFrame(
-                data=pandas.DataFrame({"table_name": tables})
-            ),
-        ):
-            reset_data_package_cache.reset_data_package_cache(mock_utils.TEST_BUCKET, "mock_db")
+        reset_data_package_cache.reset_data_package_cache(
+            mock_utils.TEST_BUCKET, mock_utils.TEST_GLUE_DB
+        )
 
     # grab the data packages list before modifications for later validation
     dp_before_event = {
@@ -265,24 +265,15 @@ def test_integration(
     # The cache is triggered by an S3 event set up in the cloudformation template. We'll have
     # to mock this event as well by expected file path
     cache_event = {"Records": [{"Sns": {"Subject": enums.JsonFilename.DATA_PACKAGES}}]}
-    # Add an extra table to the list if we've created one, and mock the table list for cache_api
-    if upload_type == enums.UploadTypes.CUBE:
-        if f"{study}__{data_package}__{version}" not in tables:
-            tables.append(f"{study}__{data_package}__{version}")
-    elif upload_type == enums.UploadTypes.FLAT:
-        if f"{study}__{data_package}__{site}__{version}" not in tables:
-            tables.append(f"{study}__{data_package}__{site}__{version}")
-    with mock.patch(
-        "awswrangler.athena.read_sql_query",
-        lambda query, database, s3_output, workgroup: pandas.DataFrame(
-            data=pandas.DataFrame({"table_name": tables})
-        ),
-    ):
-        cache_res = cache_api.cache_api_handler(cache_event, {})
-        assert cache_res["statusCode"] == 200
+    # The merge registered the data package's table directly, so no crawl is needed
+    # before caching
+    cache_res = cache_api.cache_api_handler(cache_event, {})
+    assert cache_res["statusCode"] == 200
 
     # Then do some comparisons to the pre-processed version to make sure things ended up
     # in the right place
+    # (the list from before the update would be served until a warm lambda's copy expires)
+    shared_document_cache.clear()
     dp_after = json.loads(get_data_packages.data_packages_handler({}, [])["body"])
     if existing:
         len(dp_after) == len(dp_before)
@@ -343,7 +334,8 @@ def test_integration(
     with open(tmp_path / "processed.parquet", "wb") as f:
         f.write(
             s3_client.get_object(
-                Bucket=mock_utils.TEST_BUCKET, Key=functions.get_s3_key_from_path(s3_path)
+                Bucket=mock_utils.TEST_BUCKET,
+                Key=functions.get_s3_key_from_path(functions.resolve_s3_generation(s3_path)),
             )["Body"].read()
         )
     post_process_df = pandas.read_parquet(tmp_path / "processed.parquet")